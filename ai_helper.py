@@ -8,11 +8,15 @@ import os
 import logging
 import aiohttp
 import asyncio
+import random
+import time
 import uuid
-from typing import Optional, Dict, Any
-from openai import AsyncOpenAI
+from collections import OrderedDict, deque
+from typing import Optional, Dict, Any, Awaitable, Callable, BinaryIO, Union
+from openai import AsyncOpenAI, RateLimitError
 
 import config
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -26,12 +30,231 @@ if config.OPENAI_API_KEY:
 pending_requests: Dict[str, Dict[str, Any]] = {}
 
 
-async def transcribe_voice(voice_file_path: str) -> Optional[str]:
+# ============================================================
+# ОБЩАЯ HTTP-СЕССИЯ ДЛЯ n8n
+# ============================================================
+# Одна сессия на весь процесс: соединения переиспользуются (keep-alive),
+# без TCP/TLS-рукопожатия на каждый запрос генерации.
+# Создаётся в main() через start_http_session() и закрывается при остановке бота.
+
+_http_session: Optional[aiohttp.ClientSession] = None
+
+# Статистика запросов к n8n (для мониторинга пула)
+n8n_http_stats = {
+    "requests": 0,
+    "errors": 0,
+    "total_latency": 0.0,
+    "max_latency": 0.0,
+}
+
+
+async def start_http_session() -> aiohttp.ClientSession:
+    """Создаёт общую HTTP-сессию с пулом соединений"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=config.N8N_POOL_LIMIT,
+            keepalive_timeout=60,
+            ttl_dns_cache=300
+        )
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=10)
+        )
+        logger.info(f"HTTP-сессия для n8n создана (пул: {config.N8N_POOL_LIMIT} соединений)")
+    return _http_session
+
+
+async def close_http_session():
+    """Закрывает общую HTTP-сессию (вызывается при остановке бота)"""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """Возвращает общую HTTP-сессию (создаёт при первом обращении, если main() её не создал)"""
+    if _http_session is None or _http_session.closed:
+        return await start_http_session()
+    return _http_session
+
+
+def get_http_pool_stats() -> Dict[str, Any]:
+    """
+    Статистика пула соединений и запросов к n8n
+    
+    Returns:
+        limit, in_use (занятые соединения), idle (свободные keep-alive),
+        requests, errors, avg_latency, max_latency (секунды)
+    """
+    stats = {"limit": config.N8N_POOL_LIMIT, "in_use": 0, "idle": 0}
+    if _http_session is not None and not _http_session.closed:
+        connector = _http_session.connector
+        stats["in_use"] = len(getattr(connector, "_acquired", ()))
+        stats["idle"] = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+    
+    requests = n8n_http_stats["requests"]
+    stats.update(
+        requests=requests,
+        errors=n8n_http_stats["errors"],
+        avg_latency=n8n_http_stats["total_latency"] / requests if requests else 0.0,
+        max_latency=n8n_http_stats["max_latency"],
+    )
+    return stats
+
+
+# ============================================================
+# СЕРВИС ТРАНСКРИБАЦИИ
+# ============================================================
+# Не больше TRANSCRIPTION_MAX_CONCURRENT запросов к Whisper одновременно,
+# при 429 (лимит OpenAI) - повтор с экспоненциальной задержкой.
+# Результаты запоминаются по file_unique_id голосового: повторно присланное
+# или повторно обработанное сообщение не распознаётся второй раз, а
+# одновременные запросы с одним file_unique_id ждут один общий результат.
+
+class TranscriptionService:
+    """Транскрибация с ограничением параллелизма, повторами и кэшем результатов"""
+
+    def __init__(self, max_concurrent: int, max_retries: int, cache_size: int):
+        self.max_retries = max_retries
+        self.cache_size = cache_size
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._in_progress: Dict[str, asyncio.Future] = {}
+
+    def get_cached(self, file_unique_id: Optional[str]) -> Optional[str]:
+        """Возвращает сохранённый текст голосового или None"""
+        if not file_unique_id or file_unique_id not in self._cache:
+            return None
+        self._cache.move_to_end(file_unique_id)
+        return self._cache[file_unique_id]
+
+    def _remember(self, file_unique_id: str, text: str):
+        self._cache[file_unique_id] = text
+        self._cache.move_to_end(file_unique_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def transcribe(
+        self,
+        audio: Union[str, BinaryIO],
+        filename: str = "voice.ogg",
+        file_unique_id: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        Распознаёт голосовое (из кэша, если file_unique_id уже распознавался)
+
+        Returns:
+            Распознанный текст или None
+        """
+        from monitoring import monitor
+
+        cached = self.get_cached(file_unique_id)
+        if cached is not None:
+            monitor.record_transcription(0.0, ok=True, cached=True)
+            return cached
+
+        # Тот же голосовой уже распознаётся - ждём его результат
+        if file_unique_id and file_unique_id in self._in_progress:
+            text = await asyncio.shield(self._in_progress[file_unique_id])
+            monitor.record_transcription(0.0, ok=text is not None, cached=True)
+            return text
+
+        shared = None
+        if file_unique_id:
+            shared = asyncio.get_running_loop().create_future()
+            self._in_progress[file_unique_id] = shared
+
+        text = None
+        retries = 0
+        started_at = time.monotonic()
+        try:
+            async with self._semaphore:
+                text, retries = await self._transcribe_with_retries(audio, filename)
+        finally:
+            latency = time.monotonic() - started_at
+            monitor.record_transcription(latency, ok=text is not None, retries=retries)
+            metrics.whisper_seconds.observe(latency, status="ok" if text is not None else "error")
+            if shared is not None:
+                self._in_progress.pop(file_unique_id, None)
+                shared.set_result(text)
+
+        if text is not None and file_unique_id:
+            self._remember(file_unique_id, text)
+        return text
+
+    async def _transcribe_with_retries(self, audio: Union[str, BinaryIO], filename: str) -> tuple:
+        """Запрос к Whisper с повторами при 429. Возвращает (текст или None, число повторов)"""
+        # Повторы делаем сами, встроенные повторы клиента OpenAI отключены
+        client = openai_client.with_options(max_retries=0)
+        attempt = 0
+        while True:
+            try:
+                if isinstance(audio, str):
+                    with open(audio, "rb") as audio_file:
+                        transcript = await client.audio.transcriptions.create(
+                            model="whisper-1",
+                            file=audio_file,
+                            language="ru"
+                        )
+                else:
+                    # Буфер передаётся как есть - без записи на диск и лишнего копирования
+                    audio.seek(0)
+                    transcript = await client.audio.transcriptions.create(
+                        model="whisper-1",
+                        file=(filename, audio),
+                        language="ru"
+                    )
+                return transcript.text, attempt
+
+            except RateLimitError as e:
+                if attempt >= self.max_retries:
+                    logger.error(f"Лимит OpenAI: транскрибация не удалась после {attempt} повторов: {e}")
+                    return None, attempt
+                delay = _retry_after(e) or min(2 ** attempt, 30) + random.uniform(0, 0.5)
+                attempt += 1
+                logger.warning(f"Лимит OpenAI (429), повтор транскрибации {attempt}/{self.max_retries} через {delay:.1f}с")
+                await asyncio.sleep(delay)
+
+            except Exception as e:
+                logger.error(f"Ошибка при транскрибации: {e}")
+                return None, attempt
+
+
+def _retry_after(error: RateLimitError) -> Optional[float]:
+    """Задержка из заголовка Retry-After ответа OpenAI (если есть)"""
+    try:
+        return min(float(error.response.headers.get("retry-after")), 60.0)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+transcription_service = TranscriptionService(
+    max_concurrent=config.TRANSCRIPTION_MAX_CONCURRENT,
+    max_retries=config.TRANSCRIPTION_MAX_RETRIES,
+    cache_size=config.TRANSCRIPTION_CACHE_SIZE
+)
+
+
+def get_cached_transcription(file_unique_id: Optional[str]) -> Optional[str]:
+    """Текст уже распознанного голосового (по file_unique_id) или None"""
+    return transcription_service.get_cached(file_unique_id)
+
+
+async def transcribe_voice(
+    audio: Union[str, BinaryIO],
+    filename: str = "voice.ogg",
+    file_unique_id: Optional[str] = None
+) -> Optional[str]:
     """
     Транскрибирует голосовое сообщение с помощью OpenAI Whisper
     
     Args:
-        voice_file_path: Путь к аудиофайлу
+        audio: Путь к аудиофайлу или открытый файловый объект (BytesIO,
+            SpooledTemporaryFile), позиция в начале
+        filename: Имя файла для OpenAI (по расширению определяется формат)
+        file_unique_id: file_unique_id голосового в Telegram (для кэша результатов)
         
     Returns:
         Распознанный текст или None
@@ -40,19 +263,7 @@ async def transcribe_voice(voice_file_path: str) -> Optional[str]:
         logger.error("OpenAI клиент не инициализирован")
         return None
     
-    try:
-        with open(voice_file_path, "rb") as audio_file:
-            transcript = await openai_client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="ru"
-            )
-        
-        return transcript.text
-        
-    except Exception as e:
-        logger.error(f"Ошибка при транскрибации: {e}")
-        return None
+    return await transcription_service.transcribe(audio, filename, file_unique_id)
 
 
 async def send_to_n8n(
@@ -82,26 +293,117 @@ async def send_to_n8n(
             "chat_id": chat_id,
             "request_id": request_id
         }
+        if config.N8N_CALLBACK_URL:
+            # Ответ должен прийти в эту копию бота: только она ждёт request_id
+            payload["callback_url"] = config.N8N_CALLBACK_URL
         
-        # Отправляем POST запрос
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                config.N8N_WEBHOOK_URL,
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=10)
-            ) as response:
+        # Отправляем POST запрос через общую сессию (соединение из пула)
+        session = await get_http_session()
+        started_at = time.monotonic()
+        n8n_http_stats["requests"] += 1
+        status = "error"
+        try:
+            async with session.post(config.N8N_WEBHOOK_URL, json=payload) as response:
                 if response.status == 200:
+                    status = "ok"
                     logger.info(f"Запрос {request_id} отправлен в n8n")
                     return True
                 else:
+                    n8n_http_stats["errors"] += 1
                     logger.error(f"n8n вернул статус {response.status}")
                     return False
+        finally:
+            latency = time.monotonic() - started_at
+            n8n_http_stats["total_latency"] += latency
+            n8n_http_stats["max_latency"] = max(n8n_http_stats["max_latency"], latency)
+            metrics.n8n_request_seconds.observe(latency, status=status)
                     
     except Exception as e:
+        n8n_http_stats["errors"] += 1
         logger.error(f"Ошибка при отправке в n8n: {e}")
         return False
 
 
+# ============================================================
+# ОЧЕРЕДЬ ГЕНЕРАЦИИ ПОСТОВ
+# ============================================================
+# После рассылки в 10:00 сотни пользователей заканчивают отвечать почти одновременно.
+# Одновременно в n8n уходит не больше N8N_MAX_IN_FLIGHT генераций,
+# остальные ждут своей очереди (FIFO) и узнают свой номер.
+
+class GenerationQueue:
+    """Очередь генераций с ограничением числа одновременных запросов"""
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._waiters: deque = deque()
+
+    @property
+    def depth(self) -> int:
+        """Сколько генераций ждёт в очереди"""
+        return len(self._waiters)
+
+    def _position(self, waiter: asyncio.Future) -> int:
+        for position, queued in enumerate(self._waiters, 1):
+            if queued is waiter:
+                return position
+        return 0
+
+    async def acquire(self, on_queued: Optional[Callable[[int], Awaitable[None]]] = None) -> float:
+        """
+        Занимает место для генерации (ждёт в очереди, если все места заняты)
+
+        Args:
+            on_queued: Корутина, вызываемая с номером в очереди, если пришлось ждать
+
+        Returns:
+            Время ожидания в очереди (секунды)
+        """
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            return 0.0
+
+        started_at = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+
+        try:
+            if on_queued:
+                try:
+                    await on_queued(self._position(waiter))
+                except Exception as e:
+                    logger.warning(f"Не удалось сообщить номер в очереди: {e}")
+
+            # Место передаётся из release() - in_flight при этом не меняется
+            await waiter
+        except BaseException:
+            # Отмена (или ошибка) во время уведомления или ожидания
+            if waiter.done() and not waiter.cancelled():
+                # Место уже передано этому ожидающему - отдаём его следующему
+                self.release()
+            else:
+                waiter.cancel()
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            raise
+        return time.monotonic() - started_at
+
+    def release(self):
+        """Освобождает место (передаёт его следующему в очереди)"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+generation_queue = GenerationQueue(config.N8N_MAX_IN_FLIGHT)
+
+
 def generate_request_id() -> str:
     """Генерирует уникальный ID запроса"""
     return str(uuid.uuid4())
@@ -171,10 +473,11 @@ async def generate_post_with_ai(
     answer_2: str,
     answer_3: str,
     chat_id: int,
-    task_number: int = 0
+    task_number: int = 0,
+    on_queued: Optional[Callable[[int], Awaitable[None]]] = None
 ) -> Optional[str]:
     """
-    Генерирует пост с помощью AI через n8n
+    Генерирует пост с помощью AI через n8n (через очередь generation_queue)
     
     Args:
         digest_data: Данные из таблицы digest_day_X
@@ -183,6 +486,7 @@ async def generate_post_with_ai(
         answer_3: Ответ на вопрос 3
         chat_id: ID чата пользователя
         task_number: Номер задания (для мониторинга)
+        on_queued: Корутина, получающая номер в очереди (если генерация не началась сразу)
         
     Returns:
         Сгенерированный текст поста или None
@@ -213,18 +517,34 @@ async def generate_post_with_ai(
     # Генерируем уникальный ID запроса
     request_id = generate_request_id()
     
-    # Отправляем в n8n
-    success = await send_to_n8n(prompt, chat_id, request_id)
-    
-    if not success:
-        return None
+    # Ждём свободное место в очереди генераций
+    from monitoring import monitor
+    depth = generation_queue.depth
+    wait_time = await generation_queue.acquire(on_queued)
+    monitor.record_generation_queue(wait_time, depth)
+    if wait_time:
+        logger.info(f"Генерация {request_id} ждала в очереди {wait_time:.1f}с (очередь: {depth})")
     
-    # Ждем ответ
-    generated_text = await wait_for_n8n_response(request_id)
+    generated_text = None
+    started_at = time.monotonic()
+    try:
+        # Отправляем в n8n
+        success = await send_to_n8n(prompt, chat_id, request_id)
+        
+        if not success:
+            return None
+        
+        # Ждем ответ
+        generated_text = await wait_for_n8n_response(request_id)
+    finally:
+        generation_queue.release()
+        metrics.n8n_generation_seconds.observe(
+            time.monotonic() - started_at,
+            status="ok" if generated_text is not None else "error"
+        )
     
     # Если таймаут - отправляем отчет в мониторинг
     if generated_text is None and task_number > 0:
-        from monitoring import monitor
         # Импортируем bot из главного модуля
         from bot import bot
         await monitor.report_n8n_timeout(bot, chat_id, task_number)
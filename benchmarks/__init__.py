@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарки рассылок (запуск: python -m benchmarks.broadcasts --help)
+"""
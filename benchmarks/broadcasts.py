@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк рассылок планировщика
+
+Запускает локальную заглушку Bot API (benchmarks/mock_bot_api.py), подменяет
+Supabase счётчиком в памяти (tests/fake_supabase.py) и прогоняет настоящие
+функции рассылок на синтетических когортах:
+- task      - send_task_to_users (задание в 10:00)
+- reminder  - send_reminder (напоминание)
+- penalties - check_tasks_completion (проверка 9:50 и сообщения о штрафах)
+- final     - send_final_message_to_all (финальное сообщение)
+
+Для каждой пары (когорта, сценарий) выводится: доставлено сообщений, сообщений
+в секунду, время до последней доставки, ответы 429 и 403, запросы к БД.
+
+Запуск из корня репозитория:
+    python -m benchmarks.broadcasts
+    python -m benchmarks.broadcasts --users 1000 --scenarios task,final --latency 0.05
+    python -m benchmarks.broadcasts --rate-limit 25   # лимит как в продакшене
+
+Заглушка и бот работают в одном event loop, поэтому на больших когортах
+числа включают и накладные расходы самой заглушки.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List
+
+from benchmarks.cohorts import make_finished_users, make_users
+from benchmarks.mock_bot_api import MockBotAPI
+
+SCENARIOS = ("task", "reminder", "penalties", "final")
+
+# День курса, на котором идут рассылки заданий, напоминаний и штрафов
+BENCHMARK_DAY = 5
+
+
+def configure_environment(args: argparse.Namespace) -> None:
+    """
+    Переменные окружения для config.py - до импорта модулей бота
+
+    Значения задаются явно (а не из .env), чтобы бенчмарк не отправлял отчёты
+    в мониторинг, не исключал из чата и не обращался к настоящей БД.
+    """
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCHMARK",
+        "SUPABASE_URL": "http://127.0.0.1:9",
+        "SUPABASE_KEY": "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.benchmark",
+        "MONITORING_CHAT_ID": "",
+        "COURSE_CHAT_ID": "",
+        "BROADCAST_SHARDS": "1",
+        "BROADCAST_SHARD_INDEX": "0",
+        "BROADCAST_RATE_LIMIT": str(args.rate_limit),
+    })
+    if args.concurrency:
+        os.environ["BROADCAST_CONCURRENCY"] = str(args.concurrency)
+
+
+def prepare_database(fake_db, users: List[Dict[str, Any]]) -> None:
+    """Подменяет клиент Supabase и загружает состояние курса и контент, как после старта бота"""
+    import database
+    import final_messages_handlers
+
+    fake_db.tables["users"] = users
+    fake_db.invalidate_index("users")
+    database.supabase = fake_db
+    final_messages_handlers.supabase = fake_db
+    database.user_cache.clear()
+    database._course_state_snapshot = {"id": 1, "is_active": True, "current_day": BENCHMARK_DAY}
+
+    cache = database.content_cache
+    cache.tasks = {
+        day: {"zadanie": f"Задание дня {day}", "vopros_1": "?", "vopros_2": "?", "vopros_3": "?", "prompt": ""}
+        for day in range(1, 15)
+    }
+    cache.final_messages = {(15, 1): {"course_day": 15, "message_number": 1, "message_text": "Финал"}}
+    cache.version += 1
+    cache.loaded_at = time.monotonic()
+
+
+def disable_media() -> None:
+    """Рассылки без картинок: иначе в media/.file_id_cache.json попадут file_id заглушки"""
+    import course
+
+    for name in ("get_task_image_path", "get_reminder_image_path", "get_penalty_image_path"):
+        setattr(course, name, lambda *args, **kwargs: None)
+
+
+async def run_scenario(scenario: str, size: int, bot, mock: MockBotAPI, args: argparse.Namespace) -> Dict[str, Any]:
+    """Прогоняет один сценарий на свежей когорте и возвращает метрики"""
+    import broadcast as broadcast_module
+    from course import check_tasks_completion, send_reminder, send_task_to_users
+    from final_messages_handlers import send_final_message_to_all
+    from tests.fake_supabase import FakeSupabase
+
+    fake_db = FakeSupabase()
+    if scenario == "final":
+        prepare_database(fake_db, make_finished_users(size, seed=args.seed))
+    else:
+        prepare_database(fake_db, make_users(size, BENCHMARK_DAY, seed=args.seed))
+    fake_db.reset_counter()
+    mock.reset()
+
+    started_at = time.monotonic()
+    if scenario == "task":
+        await send_task_to_users(bot, BENCHMARK_DAY + 1)
+    elif scenario == "reminder":
+        await send_reminder(bot, "reminder_1")
+    elif scenario == "penalties":
+        await check_tasks_completion(bot)
+    else:
+        await send_final_message_to_all(bot, 15, 1)
+    finished_at = time.monotonic()
+
+    # Фоновое удаление вчерашних заданий (после рассылки задания)
+    cleanup = list(broadcast_module._background_tasks)
+    cleanup_seconds = None
+    if cleanup:
+        if args.wait_cleanup:
+            await asyncio.gather(*cleanup, return_exceptions=True)
+            cleanup_seconds = time.monotonic() - finished_at
+        else:
+            for task in cleanup:
+                task.cancel()
+            await asyncio.gather(*cleanup, return_exceptions=True)
+
+    stats = mock.stats
+    last_delivery = (stats.last_delivery_at - started_at) if stats.last_delivery_at else 0.0
+    return {
+        "users": size,
+        "scenario": scenario,
+        "delivered": stats.delivered,
+        "msgs_per_sec": stats.delivered / last_delivery if last_delivery > 0 else 0.0,
+        "time_to_last_delivery": last_delivery,
+        "wall_time": finished_at - started_at,
+        "retry_after": stats.retry_after,
+        "blocked": stats.blocked,
+        "api_requests": dict(stats.requests),
+        "db_calls": fake_db.round_trips,
+        "db_calls_by_kind": fake_db.summary(),
+        "cleanup_seconds": cleanup_seconds,
+    }
+
+
+def print_results(results: List[Dict[str, Any]]) -> None:
+    header = f"{'users':>7} {'scenario':<10} {'delivered':>9} {'msg/s':>8} {'last, s':>8} {'wall, s':>8} {'429':>5} {'403':>5} {'db':>6}"
+    print(header)
+    print("-" * len(header))
+    for row in results:
+        print(
+            f"{row['users']:>7} {row['scenario']:<10} {row['delivered']:>9} {row['msgs_per_sec']:>8.1f} "
+            f"{row['time_to_last_delivery']:>8.2f} {row['wall_time']:>8.2f} {row['retry_after']:>5} "
+            f"{row['blocked']:>5} {row['db_calls']:>6}"
+        )
+    print()
+    for row in results:
+        kinds = ", ".join(f"{kind}={count}" for kind, count in sorted(row["db_calls_by_kind"].items()))
+        cleanup = f", удаление старых заданий {row['cleanup_seconds']:.2f}с" if row["cleanup_seconds"] is not None else ""
+        print(f"{row['users']:>7} {row['scenario']:<10} БД: {kinds}{cleanup}")
+
+
+async def main(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    configure_environment(args)
+
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.enums import ParseMode
+
+    disable_media()
+
+    mock = MockBotAPI(
+        latency=args.latency,
+        jitter=args.jitter,
+        retry_after_rate=args.retry_after_rate,
+        retry_after=args.retry_after,
+        blocked_rate=args.blocked_rate,
+        seed=args.seed
+    )
+    url = await mock.start()
+    bot = Bot(
+        token=os.environ["BOT_TOKEN"],
+        session=AiohttpSession(api=TelegramAPIServer.from_base(url)),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+    )
+
+    results = []
+    try:
+        for size in args.users:
+            for scenario in args.scenarios:
+                result = await run_scenario(scenario, size, bot, mock, args)
+                results.append(result)
+                print(
+                    f"✓ {size} пользователей, {scenario}: {result['delivered']} сообщений, "
+                    f"{result['msgs_per_sec']:.1f} сообщ/с, {result['db_calls']} запросов к БД",
+                    flush=True
+                )
+    finally:
+        await bot.session.close()
+        await mock.stop()
+
+    print()
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк рассылок с локальной заглушкой Bot API")
+    parser.add_argument("--users", default="1000,10000,50000",
+                        help="размеры когорт через запятую (по умолчанию 1000,10000,50000)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"сценарии через запятую: {', '.join(SCENARIOS)}")
+    parser.add_argument("--latency", type=float, default=0.03, help="задержка ответа Bot API, с")
+    parser.add_argument("--jitter", type=float, default=0.01, help="разброс задержки, с")
+    parser.add_argument("--retry-after-rate", type=float, default=0.001, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+    parser.add_argument("--blocked-rate", type=float, default=0.02, help="доля пользователей, заблокировавших бота")
+    parser.add_argument("--rate-limit", type=float, default=1000,
+                        help="BROADCAST_RATE_LIMIT, сообщ/с (25 - как с настоящим Telegram)")
+    parser.add_argument("--concurrency", type=int, default=0, help="BROADCAST_CONCURRENCY (0 - из config)")
+    parser.add_argument("--wait-cleanup", action="store_true",
+                        help="дождаться фонового удаления старых заданий и показать его время")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    parser.add_argument("--log-level", default="ERROR")
+    args = parser.parse_args(argv)
+
+    args.users = [int(size) for size in args.users.split(",") if size.strip()]
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    logging.basicConfig(level=getattr(logging, arguments.log_level.upper(), logging.ERROR))
+    asyncio.run(main(arguments))
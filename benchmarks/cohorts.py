@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Синтетические когорты пользователей для бенчмарка рассылок
+
+Строки таблицы users в том виде, в каком их видит бот в середине курса.
+Распределение фиксировано генератором с seed, поэтому прогоны сравнимы.
+"""
+
+import random
+from typing import Any, Dict, List
+
+# telegram_id пользователей когорты начинаются с этого числа
+FIRST_TELEGRAM_ID = 100_000_000
+
+# Доля ограниченных участников (опоздали на день 2+)
+LIMITED_SHARE = 0.05
+
+# Доля участников, не сдавших задание текущего дня
+NOT_SUBMITTED_SHARE = 0.6
+
+
+def make_users(size: int, current_day: int, seed: int = 42) -> List[Dict[str, Any]]:
+    """
+    Участники курса на дне current_day
+
+    - LIMITED_SHARE - limited (задание получают, напоминаний и штрафов нет)
+    - NOT_SUBMITTED_SHARE - in_progress с current_task = current_day (не сдали)
+    - остальные - waiting_task_{current_day + 1} (сдали и ждут следующее)
+    У всех есть last_task_message_id (вчерашнее задание удаляется после рассылки).
+    """
+    rng = random.Random(seed)
+    users = []
+    for i in range(size):
+        telegram_id = FIRST_TELEGRAM_ID + i
+        roll = rng.random()
+        if roll < LIMITED_SHARE:
+            course_state, current_task = "limited", current_day
+        elif roll < LIMITED_SHARE + NOT_SUBMITTED_SHARE:
+            course_state, current_task = "in_progress", current_day
+        else:
+            course_state, current_task = f"waiting_task_{current_day + 1}", current_day + 1
+        users.append({
+            "id": i + 1,
+            "telegram_id": telegram_id,
+            "email": f"user{i}@example.com",
+            "state": "registered",
+            "course_state": course_state,
+            "current_task": current_task,
+            "penalties": rng.choice((0, 0, 0, 1, 2)),
+            "channel_link": f"@channel_{i}",
+            "last_task_message_id": 10_000 + i,
+            "messages_to_delete": "",
+            "is_blocked": False,
+            "blocked_at": None,
+            "is_writing_post": False,
+            "final_message_15_sent": False,
+            "final_message_1_sent": False,
+            "final_message_2_sent": False,
+            "final_message_3_sent": False,
+        })
+    return users
+
+
+def make_finished_users(size: int, seed: int = 42) -> List[Dict[str, Any]]:
+    """Участники, сдавшие 14 задание (получатели финальных сообщений)"""
+    users = make_users(size, current_day=14, seed=seed)
+    for user in users:
+        user["current_task"] = 15
+        user["course_state"] = "completed"
+    return users
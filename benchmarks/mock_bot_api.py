@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Локальная замена Telegram Bot API на aiohttp для бенчмарка рассылок
+
+Отвечает на методы, которые вызывают рассылки (sendMessage, sendPhoto,
+deleteMessage, deleteMessages, banChatMember), и добавляет:
+- задержку каждого ответа (latency ± jitter)
+- ответы 429 Too Many Requests с retry_after (доля запросов retry_after_rate)
+- ответы 403 "bot was blocked by the user" для доли пользователей blocked_rate
+  (одни и те же chat_id при каждом запуске)
+"""
+
+import asyncio
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Optional
+
+from aiohttp import web
+
+# Методы, успешный ответ на которые - доставленное пользователю сообщение
+DELIVERY_METHODS = {"sendMessage", "sendPhoto"}
+
+
+@dataclass
+class MockStats:
+    """Счётчики запросов к заглушке (обнуляются перед каждым сценарием)"""
+    requests: Counter = field(default_factory=Counter)
+    delivered: int = 0
+    retry_after: int = 0
+    blocked: int = 0
+    first_delivery_at: Optional[float] = None
+    last_delivery_at: Optional[float] = None
+
+
+class MockBotAPI:
+    """Заглушка Bot API: web-приложение и счётчики"""
+
+    def __init__(
+        self,
+        latency: float = 0.03,
+        jitter: float = 0.01,
+        retry_after_rate: float = 0.0,
+        retry_after: int = 1,
+        blocked_rate: float = 0.0,
+        seed: int = 42
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.blocked_rate = blocked_rate
+        self.stats = MockStats()
+        self._random = random.Random(seed)
+        self._message_id = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+
+    def reset(self):
+        self.stats = MockStats()
+
+    def is_blocked(self, chat_id: int) -> bool:
+        """Пользователь заблокировал бота (детерминированно по chat_id)"""
+        if self.blocked_rate <= 0:
+            return False
+        return (chat_id * 2654435761) % 10000 < self.blocked_rate * 10000
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        self.stats.requests[method] += 1
+
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self.retry_after_rate and self._random.random() < self.retry_after_rate:
+            self.stats.retry_after += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            })
+
+        chat_id = int(data.get("chat_id") or data.get("user_id") or 0)
+        if method in DELIVERY_METHODS and self.is_blocked(chat_id):
+            self.stats.blocked += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 403,
+                "description": "Forbidden: bot was blocked by the user"
+            })
+
+        if method not in DELIVERY_METHODS:
+            return web.json_response({"ok": True, "result": True})
+
+        now = time.monotonic()
+        self.stats.delivered += 1
+        if self.stats.first_delivery_at is None:
+            self.stats.first_delivery_at = now
+        self.stats.last_delivery_at = now
+
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        if method == "sendPhoto":
+            message["photo"] = [{
+                "file_id": "benchmark-photo",
+                "file_unique_id": "benchmark-photo",
+                "width": 1280,
+                "height": 720
+            }]
+            message["caption"] = data.get("caption", "")
+        else:
+            message["text"] = data.get("text", "")
+        return web.json_response({"ok": True, "result": message})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер (port=0 - свободный порт) и возвращает базовый адрес"""
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
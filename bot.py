@@ -4,10 +4,12 @@
 """
 
 import asyncio
+import functools
 import logging
 import re
 import os
 from datetime import datetime, timedelta
+from typing import Optional
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, FSInputFile, CallbackQuery
@@ -15,6 +17,7 @@ from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 import pytz
 import validators
 
@@ -26,19 +29,18 @@ from media_helper import (
     get_welcome_image_path,
     get_channel_request_image_path,
     get_final_image_path,
-    get_instruction_video_path
+    get_instruction_video_path,
+    send_photo_cached
 )
 from database import (
     check_email_exists,
     get_user_by_telegram_id,
     update_user_data,
     update_user_channel,
-    get_user_state,
     update_user_state,
     UserState,
     get_user_current_task,
     mark_task_completed,
-    get_user_course_state,
     CourseState,
     get_task_by_number,
     fix_users_after_task_2
@@ -61,12 +63,13 @@ from post_handlers import (
     handle_post_link,
     handle_question_answer
 )
-from user_states import get_user_state as get_dialog_state, clear_user_state as clear_dialog_state
 from ai_helper import handle_n8n_response
 from monitoring import monitor
+from broadcast import broadcast
+from middlewares import UserContext, UserContextMiddleware
+from metrics import HandlerMetricsMiddleware, TelegramRequestMetrics, register_gauges
 from final_messages_handlers import (
     send_final_message_to_all,
-    should_ignore_user_input,
     mark_course_finished
 )
 
@@ -84,6 +87,16 @@ bot = Bot(
 )
 dp = Dispatcher()
 
+# Контекст пользователя (строка из БД + состояние курса) загружается один раз на апдейт
+dp.message.outer_middleware(UserContextMiddleware())
+dp.callback_query.outer_middleware(UserContextMiddleware())
+
+# Метрики: длительность обработчиков и запросов к Telegram Bot API (/metrics)
+if config.METRICS_ENABLED:
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    bot.session.middleware(TelegramRequestMetrics())
+
 # Планировщик задач
 scheduler = AsyncIOScheduler(timezone=pytz.timezone(config.TIMEZONE))
 
@@ -218,8 +231,7 @@ async def cmd_start(message: Message):
     welcome_image = get_welcome_image_path()
     if welcome_image:
         try:
-            photo = FSInputFile(welcome_image)
-            await message.answer_photo(photo, caption=messages.MSG_ASK_EMAIL)
+            await send_photo_cached(bot, message.chat.id, welcome_image, caption=messages.MSG_ASK_EMAIL)
         except Exception as e:
             logger.error(f"Ошибка при отправке приветственной картинки: {e}")
             # Если картинка не отправилась, отправляем только текст
@@ -402,11 +414,11 @@ async def cmd_fix_excluded(message: Message):
     if not is_admin(user_id):
         return
     
-    from database import supabase, TABLE_NAME, CourseState
+    from database import supabase, TABLE_NAME, CourseState, update_user_fields
     
     try:
         # Находим всех excluded пользователей
-        response = supabase.table(TABLE_NAME).select("telegram_id, penalties").eq("course_state", "excluded").execute()
+        response = await supabase.table(TABLE_NAME).select("telegram_id, penalties").eq("course_state", "excluded").execute()
         excluded_users = response.data if response.data else []
         
         if not excluded_users:
@@ -418,14 +430,11 @@ async def cmd_fix_excluded(message: Message):
         for user in excluded_users:
             tid = user.get("telegram_id")
             penalties = user.get("penalties", 0)
-            try:
-                supabase.table(TABLE_NAME).update({
-                    "course_state": CourseState.IN_PROGRESS
-                }).eq("telegram_id", tid).execute()
+            if await update_user_fields(tid, {"course_state": CourseState.IN_PROGRESS}):
                 fixed_count += 1
                 logger.info(f"✅ Пользователь {tid} переведён из excluded в in_progress (штрафов: {penalties})")
-            except Exception as e:
-                logger.error(f"❌ Ошибка при исправлении {tid}: {e}")
+            else:
+                logger.error(f"❌ Ошибка при исправлении {tid}")
         
         report = f"""✅ /fix_excluded
 
@@ -440,6 +449,88 @@ async def cmd_fix_excluded(message: Message):
         await monitor.send_admin_report(bot, f"❌ /fix_excluded\n\nОшибка: {e}")
 
 
+@dp.message(Command("reload_content"))
+async def cmd_reload_content(message: Message):
+    """
+    Команда /reload_content - перезагружает кэш заданий (digest_day_N) и финальных сообщений
+    
+    Используется после редактирования текстов в Supabase, чтобы не ждать CONTENT_CACHE_TTL.
+    """
+    user_id = message.from_user.id
+    
+    if not is_admin(user_id):
+        return
+    
+    from database import refresh_content_cache, content_cache
+    
+    ok = await refresh_content_cache(config.COURSE_DAYS)
+    
+    report = f"""{"✅" if ok else "⚠️"} /reload_content
+
+Версия кэша: {content_cache.version}
+Заданий: {len(content_cache.tasks)} из {config.COURSE_DAYS}
+Финальных сообщений: {len(content_cache.final_messages)}"""
+    if not ok:
+        report += "\n\nЧасть контента не загрузилась, оставлены прежние значения (см. логи)"
+    
+    await message.answer(report)
+    await monitor.send_admin_report(bot, report)
+    logger.info(f"Админ {user_id} перезагрузил кэш контента (v{content_cache.version})")
+
+
+@dp.message(Command("resume_broadcast"))
+async def cmd_resume_broadcast(message: Message):
+    """
+    Команда /resume_broadcast - продолжает сегодняшнюю рассылку после сбоя
+    
+    Форматы:
+        /resume_broadcast task [failed]              - задание текущего дня
+        /resume_broadcast final <день> <номер> [failed] - финальное сообщение
+    
+    Без failed отправляет тем, кому рассылка ещё не доставлена (по журналу рассылок),
+    с failed - только тем, кому отправка не удалась.
+    """
+    user_id = message.from_user.id
+    
+    if not is_admin(user_id):
+        return
+    
+    parts = message.text.split()[1:]
+    only_failed = bool(parts) and parts[-1].lower() == "failed"
+    if only_failed:
+        parts = parts[:-1]
+    mode = "только ошибки" if only_failed else "недоставленные"
+    
+    if parts == ["task"]:
+        course_state = await get_global_course_state()
+        current_day = course_state.get("current_day", 0) if course_state else 0
+        if not course_state or not course_state.get("is_active") or not 1 <= current_day <= config.COURSE_DAYS:
+            await message.answer("⚠️ Курс не активен - рассылать задание нечего")
+            return
+        
+        await message.answer(f"📤 Продолжаю рассылку задания {current_day} ({mode})...")
+        await send_task_to_users(bot, current_day, only_failed=only_failed)
+        report = f"🔁 /resume_broadcast: задание {current_day} ({mode})"
+    
+    elif len(parts) == 3 and parts[0] == "final" and parts[1].isdigit() and parts[2].isdigit():
+        course_day, message_number = int(parts[1]), int(parts[2])
+        await message.answer(f"📤 Продолжаю рассылку финального сообщения {course_day}/{message_number} ({mode})...")
+        await send_final_message_to_all(bot, course_day=course_day, message_number=message_number, only_failed=only_failed)
+        report = f"🔁 /resume_broadcast: финальное сообщение {course_day}/{message_number} ({mode})"
+    
+    else:
+        await message.answer(
+            "Формат:\n"
+            "/resume_broadcast task [failed]\n"
+            "/resume_broadcast final <день> <номер> [failed]"
+        )
+        return
+    
+    await message.answer("✅ Готово")
+    await monitor.send_admin_report(bot, report)
+    logger.info(f"Админ {user_id}: {report}")
+
+
 @dp.message(Command("final15"))
 async def handle_final15_command(message: Message):
     """Админ команда: отправить единственное финальное сообщение дня 15 вручную"""
@@ -598,7 +689,7 @@ async def cmd_cancel(message: Message):
         # Сбрасываем флаг
         await set_user_writing_post(user_id, False)
         # Очищаем состояние диалога
-        clear_user_state(user_id)
+        await clear_user_state(user_id)
         
         logger.info(f"✅ Пользователь {user_id} отменил написание поста через /cancel")
         await message.answer(
@@ -661,16 +752,12 @@ async def cmd_group(message: Message):
         return
     
     # Отправляем сообщение всем пользователям группы
-    success_count = 0
-    error_count = 0
+    async def send_to_user(tid: int):
+        await bot.send_message(chat_id=tid, text=group_text)
     
-    for tid in telegram_ids:
-        try:
-            await bot.send_message(chat_id=tid, text=group_text)
-            success_count += 1
-        except Exception as e:
-            logger.error(f"Ошибка отправки группе {group_number} пользователю {tid}: {e}")
-            error_count += 1
+    result = await broadcast(f"group_{group_number}", telegram_ids, send_to_user)
+    success_count = result.success
+    error_count = result.failed
     
     # Отчёт в мониторинговый чат
     report = f"""📨 /group {group_number}
@@ -701,7 +788,7 @@ async def cmd_test_check_950(message: Message):
     # Получаем статистику до проверки
     from database import get_all_active_users_in_course, get_users_by_current_task
     current_day = course_state.get("current_day", 0)
-    all_users_before = await get_all_active_users_in_course()
+    all_users_before = await get_all_active_users_in_course(columns="telegram_id")
     users_not_completed = await get_users_by_current_task(current_day)
     
     # Выполняем проверку и выдачу штрафов (как в 9:50)
@@ -729,7 +816,7 @@ async def handle_send_digest_all(message: Message, current_day: int):
     from database import get_users_in_course
     
     # Получаем всех пользователей в курсе
-    users = await get_users_in_course()
+    users = await get_users_in_course(columns="telegram_id")
     
     if not users:
         return
@@ -750,7 +837,7 @@ async def handle_send_digest_one(message: Message, current_day: int, target_user
     ВАЖНО: Работает как send_task_to_users, но для одного пользователя
     - Обновляет current_task пользователя
     """
-    from database import get_user_by_telegram_id, get_user_course_state, get_task_by_number, supabase, TABLE_NAME
+    from database import get_user_by_telegram_id, get_user_course_state, get_task_by_number, update_user_fields
     from course import get_task_keyboard
     
     # Проверяем, существует ли пользователь
@@ -787,10 +874,10 @@ async def handle_send_digest_one(message: Message, current_day: int, target_user
     # Отправляем пользователю
     try:
         if os.path.exists(image_path):
-            photo = FSInputFile(image_path)
-            await bot.send_photo(
-                chat_id=target_user_id,
-                photo=photo,
+            await send_photo_cached(
+                bot,
+                target_user_id,
+                image_path,
                 caption=message_text,
                 reply_markup=keyboard
             )
@@ -802,10 +889,10 @@ async def handle_send_digest_one(message: Message, current_day: int, target_user
             )
         
         # ВАЖНО: Обновляем current_task и course_state (как в send_task_to_users)
-        supabase.table(TABLE_NAME).update({
+        await update_user_fields(target_user_id, {
             'current_task': current_day,
             'course_state': CourseState.IN_PROGRESS  # Пользователь получил задание
-        }).eq('telegram_id', target_user_id).execute()
+        })
         
         # Отчёт в мониторинговый чат
         await monitor.send_admin_report(bot, f"📤 /send_digest {target_user_id}\n\nЗадание {current_day} отправлено пользователю {target_user_id}")
@@ -820,12 +907,16 @@ async def handle_send_digest_one(message: Message, current_day: int, target_user
 # ============================================================
 
 @dp.callback_query(F.data == "write_post")
-async def callback_write_post(callback: CallbackQuery):
+async def callback_write_post(callback: CallbackQuery, ctx: Optional[UserContext]):
     """Обработчик кнопки 'Напиши пост'"""
+    # Контекст не загружается, если у апдейта нет пользователя
+    if ctx is None:
+        return
+    
     user_id = callback.from_user.id
     
     # Проверяем, не завершил ли пользователь 14 задание (игнорируем до конца 15 дня)
-    if await should_ignore_user_input(user_id):
+    if ctx.should_ignore_input:
         try:
             await callback.answer("Курс завершен. Ожидайте финальные сообщения.", show_alert=True)
         except Exception:
@@ -833,8 +924,7 @@ async def callback_write_post(callback: CallbackQuery):
         return
     
     # Проверяем, не заблокирован ли пользователь
-    from database import is_user_blocked
-    if await is_user_blocked(user_id):
+    if ctx.is_blocked:
         try:
             await callback.answer(messages.MSG_USER_BLOCKED, show_alert=True)
         except Exception:
@@ -842,7 +932,7 @@ async def callback_write_post(callback: CallbackQuery):
         return
     
     # Проверяем, участвует ли пользователь в курсе
-    course_state = await get_user_course_state(user_id)
+    course_state = ctx.course_state
     
     if course_state not in [CourseState.IN_PROGRESS] and not course_state.startswith("waiting_task"):
         try:
@@ -871,12 +961,16 @@ async def callback_write_post(callback: CallbackQuery):
 
 
 @dp.callback_query(F.data == "submit_task")
-async def callback_submit_task(callback: CallbackQuery):
+async def callback_submit_task(callback: CallbackQuery, ctx: Optional[UserContext]):
     """Обработчик кнопки 'Сдать задание'"""
+    # Контекст не загружается, если у апдейта нет пользователя
+    if ctx is None:
+        return
+    
     user_id = callback.from_user.id
     
     # Проверяем, не завершил ли пользователь 14 задание (игнорируем до конца 15 дня)
-    if await should_ignore_user_input(user_id):
+    if ctx.should_ignore_input:
         try:
             await callback.answer("Курс завершен. Ожидайте финальные сообщения.", show_alert=True)
         except Exception:
@@ -884,8 +978,7 @@ async def callback_submit_task(callback: CallbackQuery):
         return
     
     # Проверяем, не заблокирован ли пользователь
-    from database import is_user_blocked
-    if await is_user_blocked(user_id):
+    if ctx.is_blocked:
         try:
             await callback.answer(messages.MSG_USER_BLOCKED, show_alert=True)
         except Exception:
@@ -893,8 +986,7 @@ async def callback_submit_task(callback: CallbackQuery):
         return
     
     # НОВАЯ ПРОВЕРКА: Блокируем если пользователь пишет пост через AI
-    from database import is_user_writing_post
-    if await is_user_writing_post(user_id):
+    if ctx.is_writing_post:
         try:
             await callback.answer(
                 "⚠️ Сначала завершите написание поста!",
@@ -905,7 +997,7 @@ async def callback_submit_task(callback: CallbackQuery):
         return
     
     # Проверяем, участвует ли пользователь в курсе И находится в активном состоянии
-    course_state = await get_user_course_state(user_id)
+    course_state = ctx.course_state
     
     # Кнопки работают:
     # - В состоянии IN_PROGRESS (все пользователи)
@@ -943,28 +1035,26 @@ async def callback_submit_task(callback: CallbackQuery):
 # ============================================================
 
 @dp.message(F.text)
-async def handle_text_message(message: Message):
+async def handle_text_message(message: Message, ctx: Optional[UserContext]):
     """Обработчик всех текстовых сообщений"""
-    # Игнорируем сообщения из групповых чатов
-    if message.chat.type != "private":
+    # Игнорируем сообщения из групповых чатов (и апдейты без пользователя - контекста нет)
+    if message.chat.type != "private" or ctx is None:
         return
     
-    user_id = message.from_user.id
     text = message.text.strip()
     
     # Проверяем, не завершил ли пользователь 14 задание (игнорируем до конца 15 дня)
-    if await should_ignore_user_input(user_id):
+    if ctx.should_ignore_input:
         # Игнорируем сообщения, не отвечаем
         return
     
     # Проверяем, не заблокирован ли пользователь
-    from database import is_user_blocked
-    if await is_user_blocked(user_id):
+    if ctx.is_blocked:
         await message.answer(messages.MSG_USER_BLOCKED)
         return
     
     # Проверяем состояние диалога (вопросы или ожидание ссылки на пост)
-    dialog_state = get_dialog_state(user_id)
+    dialog_state = ctx.dialog
     
     if dialog_state.state in ["question_1", "question_2", "question_3"]:
         # Пользователь отвечает на вопрос
@@ -978,7 +1068,7 @@ async def handle_text_message(message: Message):
     # Проверяем, не пытается ли пользователь отправить ссылку на пост без нажатия кнопки
     if text.startswith("https://t.me/") and "/" in text[13:]:
         # Похоже на ссылку на пост
-        course_state = await get_user_course_state(user_id)
+        course_state = ctx.course_state
         if course_state == CourseState.IN_PROGRESS or course_state.startswith("waiting_task"):
             # Пользователь в курсе, но не нажал кнопку
             from course import get_task_keyboard
@@ -986,8 +1076,8 @@ async def handle_text_message(message: Message):
             await message.answer(messages.MSG_NEED_PRESS_BUTTON, reply_markup=keyboard)
             return
     
-    # Получаем текущее состояние пользователя из БД (регистрация)
-    state = await get_user_state(user_id)
+    # Текущее состояние пользователя (регистрация)
+    state = ctx.state
     
     if state == UserState.NEW or state == UserState.WAITING_EMAIL:
         # Ожидаем email
@@ -997,10 +1087,10 @@ async def handle_text_message(message: Message):
         await handle_channel_input(message, text)
     elif state == UserState.REGISTERED:
         # Пользователь зарегистрирован - проверяем состояние курса
-        await handle_registered_user_message(message, user_id)
+        await handle_registered_user_message(message, ctx)
 
 
-async def handle_registered_user_message(message: Message, user_id: int):
+async def handle_registered_user_message(message: Message, ctx: UserContext):
     """
     Обработка сообщений от зарегистрированных пользователей
     Отвечает в зависимости от состояния курса
@@ -1009,17 +1099,15 @@ async def handle_registered_user_message(message: Message, user_id: int):
     - course_state = in_progress → получил задание, не сдал → "используйте кнопки"
     - course_state = waiting_task_X → сдал задание, ждёт следующее → "ждите 10:00"
     """
-    from database import get_global_course_state, get_user_course_state, get_user_current_task
+    user_id = ctx.telegram_id
     
     # Проверяем глобальное состояние курса
-    global_state = await get_global_course_state()
-    
-    if not global_state or not global_state.get("is_active"):
+    if not ctx.course_is_active:
         # Курс не активен - ждём старта
         await message.answer(messages.MSG_STATE_WAITING_COURSE_START)
         return
     
-    current_day = global_state.get("current_day", 0)
+    current_day = ctx.current_day
     
     if current_day == 0:
         # Курс запущен, но ждём первую рассылку в 10:00
@@ -1027,7 +1115,7 @@ async def handle_registered_user_message(message: Message, user_id: int):
         return
     
     # Проверяем состояние пользователя в курсе
-    user_course_state = await get_user_course_state(user_id)
+    user_course_state = ctx.course_state
     
     if user_course_state == CourseState.EXCLUDED:
         # Пользователь исключён
@@ -1048,7 +1136,7 @@ async def handle_registered_user_message(message: Message, user_id: int):
     if user_course_state == CourseState.IN_PROGRESS:
         # Пользователь ПОЛУЧИЛ задание и ещё НЕ сдал - отправляем задание заново
         from course import get_task_keyboard, send_task_to_single_user
-        user_current_task = await get_user_current_task(user_id)
+        user_current_task = ctx.current_task
         
         # Отправляем задание текущего дня
         await send_task_to_single_user(bot, user_id, user_current_task)
@@ -1065,27 +1153,24 @@ async def handle_registered_user_message(message: Message, user_id: int):
 
 
 @dp.message(F.voice)
-async def handle_voice_message(message: Message):
+async def handle_voice_message(message: Message, ctx: Optional[UserContext]):
     """Обработчик голосовых сообщений"""
-    # Игнорируем сообщения из групповых чатов
-    if message.chat.type != "private":
+    # Игнорируем сообщения из групповых чатов (и апдейты без пользователя - контекста нет)
+    if message.chat.type != "private" or ctx is None:
         return
     
-    user_id = message.from_user.id
-    
     # Проверяем, не завершил ли пользователь 14 задание (игнорируем до конца 15 дня)
-    if await should_ignore_user_input(user_id):
+    if ctx.should_ignore_input:
         # Игнорируем сообщения, не отвечаем
         return
     
     # Проверяем, не заблокирован ли пользователь
-    from database import is_user_blocked
-    if await is_user_blocked(user_id):
+    if ctx.is_blocked:
         await message.answer(messages.MSG_USER_BLOCKED)
         return
     
     # Проверяем, отвечает ли пользователь на вопрос
-    dialog_state = get_dialog_state(user_id)
+    dialog_state = ctx.dialog
     
     if dialog_state.state in ["question_1", "question_2", "question_3"]:
         await handle_question_answer(message, bot)
@@ -1138,9 +1223,10 @@ async def handle_email_input(message: Message, email: str):
         channel_image = get_channel_request_image_path()
         if channel_image:
             try:
-                photo = FSInputFile(channel_image)
-                await message.answer_photo(
-                    photo=photo,
+                await send_photo_cached(
+                    bot,
+                    message.chat.id,
+                    channel_image,
                     caption=messages.MSG_EMAIL_SUCCESS
                 )
             except Exception as e:
@@ -1204,15 +1290,14 @@ async def handle_channel_input(message: Message, text: str):
             await message.answer(messages.MSG_LIMITED_REGISTRATION)
             
             # Устанавливаем статус LIMITED
-            from database import supabase, TABLE_NAME, CourseState
-            try:
-                supabase.table(TABLE_NAME).update({
-                    'course_state': CourseState.LIMITED,
-                    'current_task': current_day  # Текущий день курса
-                }).eq('telegram_id', user_id).execute()
+            from database import update_user_fields, CourseState
+            if await update_user_fields(user_id, {
+                'course_state': CourseState.LIMITED,
+                'current_task': current_day  # Текущий день курса
+            }):
                 logger.info(f"✅ Установлен статус LIMITED для {user_id}")
-            except Exception as e:
-                logger.error(f"❌ Ошибка установки LIMITED статуса: {e}")
+            else:
+                logger.error(f"❌ Ошибка установки LIMITED статуса для {user_id}")
             
             await asyncio.sleep(1)
             
@@ -1235,8 +1320,7 @@ async def handle_channel_input(message: Message, text: str):
             final_image = get_final_image_path()
             if final_image:
                 try:
-                    photo = FSInputFile(final_image)
-                    await message.answer_photo(photo=photo, caption=messages.MSG_CHANNEL_SUCCESS)
+                    await send_photo_cached(bot, message.chat.id, final_image, caption=messages.MSG_CHANNEL_SUCCESS)
                 except Exception as e:
                     logger.error(f"Ошибка при отправке финальной картинки: {e}")
                     await message.answer(messages.MSG_CHANNEL_SUCCESS)
@@ -1494,6 +1578,48 @@ async def scheduled_final_message_3():
     logger.info("✅ Финальное сообщение дня 16 №3 отправлено")
 
 
+def single_replica_job(job_id: str, func, hour: int, minute: int, per_shard: bool = False):
+    """
+    Оборачивает задачу планировщика так, чтобы каждый её запуск выполняла
+    только одна копия бота (аренда в БД, см. database.try_acquire_job_lease)
+    
+    hour, minute - запланированное время задачи (как в её CronTrigger): из него
+    и сегодняшней даты строится ключ аренды. Время фактического запуска для ключа
+    не подходит - из-за расхождения часов или задержки планировщика копии
+    могут оказаться по разные стороны границы минуты и обе выполнят задачу
+    
+    per_shard=True - аренда берётся на каждый шард рассылки (BROADCAST_SHARDS),
+    то есть задачу выполняет по одной копии бота на шард
+    
+    Перед запуском снимок состояния курса перечитывается из БД: день курса
+    мог сменить другая копия (например, переход дня в 9:50)
+    """
+    @functools.wraps(func)
+    async def wrapper():
+        from database import try_acquire_job_lease, refresh_global_course_state
+        
+        # Ключ запуска - id задачи, дата и запланированное время (одинаковый у всех копий)
+        today = datetime.now(pytz.timezone(config.TIMEZONE)).strftime("%Y-%m-%d")
+        run_key = f"{job_id}:{today} {hour:02d}:{minute:02d}"
+        if per_shard and config.BROADCAST_SHARDS > 1:
+            run_key += f":shard{config.BROADCAST_SHARD_INDEX}"
+        
+        acquired = await try_acquire_job_lease(run_key, config.REPLICA_ID, config.SCHEDULER_LEASE_TTL)
+        if acquired is False:
+            logger.info(f"⏭️ {run_key}: выполняется другой копией бота, пропускаем")
+            return
+        if acquired is None:
+            # Без аренды (миграция не применена) работаем как единственная копия
+            logger.warning(f"⚠️ {run_key}: аренда недоступна, задача выполняется без блокировки")
+        
+        if await refresh_global_course_state() is None:
+            logger.warning(f"⚠️ {run_key}: не удалось перечитать состояние курса, используется снимок в памяти")
+        
+        await func()
+    
+    return wrapper
+
+
 def setup_scheduler():
     """Настройка планировщика задач"""
     
@@ -1505,7 +1631,7 @@ def setup_scheduler():
     # Время рассылки задания (10:00)
     task_hour, task_minute = map(int, config.TASK_SEND_TIME.split(":"))
     scheduler.add_job(
-        scheduled_send_task,
+        single_replica_job("send_task", scheduled_send_task, task_hour, task_minute, per_shard=True),
         CronTrigger(hour=task_hour, minute=task_minute, timezone=config.TIMEZONE),
         id="send_task"
     )
@@ -1523,7 +1649,7 @@ def setup_scheduler():
             func = scheduled_reminder_3
         
         scheduler.add_job(
-            func,
+            single_replica_job(f"reminder_{i}", func, hour, minute),
             CronTrigger(hour=hour, minute=minute, timezone=config.TIMEZONE),
             id=f"reminder_{i}"
         )
@@ -1532,13 +1658,14 @@ def setup_scheduler():
     # Проверка выполнения (9:50)
     check_hour, check_minute = map(int, config.CHECK_TIME.split(":"))
     scheduler.add_job(
-        scheduled_check_completion,
+        single_replica_job("check_completion", scheduled_check_completion, check_hour, check_minute),
         CronTrigger(hour=check_hour, minute=check_minute, timezone=config.TIMEZONE),
         id="check_completion"
     )
     logger.info(f"Планировщик: проверка выполнения в {config.CHECK_TIME}")
     
-    # Ежедневная сводка (23:59)
+    # Ежедневная сводка (23:59) - на каждой копии бота: счётчики мониторинга
+    # у каждого процесса свои, каждая копия отправляет и сбрасывает свою сводку
     scheduler.add_job(
         scheduled_daily_summary,
         CronTrigger(hour=23, minute=59, timezone=config.TIMEZONE),
@@ -1549,7 +1676,7 @@ def setup_scheduler():
     # Финальные сообщения: день 15 (одно) и день 16 (три)
     # День 15: одно сообщение в 10:00
     scheduler.add_job(
-        scheduled_final_message_day15,
+        single_replica_job("final_message_day15", scheduled_final_message_day15, 10, 0),
         CronTrigger(hour=10, minute=0, timezone=config.TIMEZONE),
         id="final_message_day15"
     )
@@ -1557,26 +1684,36 @@ def setup_scheduler():
     
     # День 16: три сообщения в 10:00, 15:00, 15:55
     scheduler.add_job(
-        scheduled_final_message_1,
+        single_replica_job("final_message_16_1", scheduled_final_message_1, 10, 0),
         CronTrigger(hour=10, minute=0, timezone=config.TIMEZONE),
         id="final_message_16_1"
     )
     logger.info("Планировщик: финальное сообщение дня 16 №1 в 10:00")
     
     scheduler.add_job(
-        scheduled_final_message_2,
+        single_replica_job("final_message_16_2", scheduled_final_message_2, 15, 0),
         CronTrigger(hour=15, minute=0, timezone=config.TIMEZONE),
         id="final_message_16_2"
     )
     logger.info("Планировщик: финальное сообщение дня 16 №2 в 15:00")
     
     scheduler.add_job(
-        scheduled_final_message_3,
+        single_replica_job("final_message_16_3", scheduled_final_message_3, 15, 55),
         CronTrigger(hour=15, minute=55, timezone=config.TIMEZONE),
         id="final_message_16_3"
     )
     logger.info("Планировщик: финальное сообщение дня 16 №3 в 15:55")
     
+    # Перечитывание состояния курса из БД (если ботов несколько)
+    from database import COURSE_STATE_POLL_SECONDS, refresh_global_course_state
+    if COURSE_STATE_POLL_SECONDS > 0:
+        scheduler.add_job(
+            refresh_global_course_state,
+            IntervalTrigger(seconds=COURSE_STATE_POLL_SECONDS),
+            id="refresh_course_state"
+        )
+        logger.info(f"Планировщик: обновление состояния курса каждые {COURSE_STATE_POLL_SECONDS} сек")
+    
     scheduler.start()
     logger.info("Планировщик запущен!")
 
@@ -1594,9 +1731,16 @@ async def main():
     logger.info("=" * 50)
     
     # Проверяем и восстанавливаем состояние курса из БД
-    from database import ensure_course_state_exists, get_global_course_state
+    from database import ensure_course_state_exists, get_global_course_state, refresh_content_cache
     await ensure_course_state_exists()
     
+    # Прогреваем кэш заданий и финальных сообщений
+    await refresh_content_cache(config.COURSE_DAYS)
+    
+    # Хранилище состояний диалогов (SQLite открывается в отдельном потоке)
+    from user_states import init_dialog_storage
+    await init_dialog_storage()
+    
     # Логируем текущее состояние курса
     course_state = await get_global_course_state()
     if course_state:
@@ -1612,22 +1756,56 @@ async def main():
             logger.info(f"   ⏸️ Курс НЕ активен")
         logger.info("=" * 50)
     
+    # Общая HTTP-сессия для запросов к n8n (пул соединений с keep-alive)
+    from ai_helper import start_http_session, close_http_session
+    await start_http_session()
+    
     # Настраиваем планировщик
     setup_scheduler()
     
-    # Запускаем webhook сервер для n8n (если настроен)
+    # Запускаем веб-сервер: вебхук n8n, метрики и (в режиме webhook) обновления Telegram
+    use_telegram_webhook = bool(config.TELEGRAM_WEBHOOK_URL)
     webhook_runner = None
-    if config.N8N_WEBHOOK_URL:
+    if config.METRICS_ENABLED:
+        register_gauges()
+    if config.N8N_WEBHOOK_URL or use_telegram_webhook or config.METRICS_ENABLED:
         from webhook_server import start_webhook_server
-        webhook_runner = await start_webhook_server(host='0.0.0.0', port=8080)
-        logger.info("Webhook сервер для n8n запущен на порту 8080")
+        webhook_runner = await start_webhook_server(
+            host=config.WEBHOOK_SERVER_HOST,
+            port=config.WEBHOOK_SERVER_PORT,
+            bot=bot if use_telegram_webhook else None,
+            dispatcher=dp if use_telegram_webhook else None
+        )
+        logger.info(f"Webhook сервер запущен на порту {config.WEBHOOK_SERVER_PORT}")
     
     try:
-        await dp.start_polling(bot)
+        if use_telegram_webhook:
+            # Все копии бота регистрируют один и тот же адрес - повторный вызов безопасен.
+            # При остановке webhook не удаляется: обновления продолжают принимать другие копии
+            await bot.set_webhook(
+                url=config.TELEGRAM_WEBHOOK_URL + config.TELEGRAM_WEBHOOK_PATH,
+                secret_token=config.TELEGRAM_WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            logger.info(f"Режим webhook: {config.TELEGRAM_WEBHOOK_URL}{config.TELEGRAM_WEBHOOK_PATH}")
+            logger.info(
+                "Состояния диалогов и ожидание ответов n8n хранятся в этой копии бота: "
+                "при нескольких копиях нужна sticky-маршрутизация по chat_id и N8N_CALLBACK_URL"
+            )
+            if config.N8N_WEBHOOK_URL and not config.N8N_CALLBACK_URL:
+                logger.warning("⚠️ N8N_CALLBACK_URL не задан: при нескольких копиях ответ n8n может прийти не в ту копию")
+            await asyncio.Event().wait()
+        else:
+            # Long polling: снимаем webhook, если он остался от запуска в режиме webhook
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     finally:
         scheduler.shutdown()
         if webhook_runner:
             await webhook_runner.cleanup()
+        await close_http_session()
+        from database import close_database
+        await close_database()
         await bot.session.close()
 
 
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Движок массовых рассылок
+- Ограничение параллельности (пул воркеров)
+- Глобальный лимит скорости (token bucket, лимит Telegram ~30 сообщений/сек)
+- Обработка TelegramRetryAfter (флуд-контроль)
+- Статистика скорости каждой рассылки
+- Получатели списком или асинхронным генератором (постранично из БД)
+- Шардирование рассылки задания между копиями бота (telegram_id % BROADCAST_SHARDS, отбор в БД)
+- Журнал доставки: повторный запуск продолжает с места остановки (доставка "хотя бы один раз")
+- Фоновое удаление старых сообщений после рассылки (deleteMessages пачками)
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+import pytz
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель скорости: не более rate операций в секунду (с запасом burst)"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Приостанавливает выдачу токенов (после TelegramRetryAfter)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        # Пополнение начнётся только после паузы: время паузы не считается простоем,
+        # иначе сразу после неё ушла бы пачка в capacity сообщений
+        self.updated_at = self.paused_until
+
+    async def acquire(self):
+        """Ждёт, пока не появится свободный токен"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                # Пополняем токены пропорционально прошедшему времени
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+@dataclass
+class BroadcastResult:
+    """Итог рассылки"""
+    name: str
+    total: int = 0
+    success: int = 0
+    failed: int = 0
+    skipped: int = 0
+    retries: int = 0
+    resumed: int = 0  # Уже доставлено при прошлом запуске (по журналу)
+    incomplete: Optional[str] = None  # Причина, если список получателей оборвался (ошибка БД)
+    blocked_ids: List[int] = field(default_factory=list)
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        """Длительность рассылки в секундах"""
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    @property
+    def rate(self) -> float:
+        """Скорость рассылки (успешных сообщений в секунду)"""
+        return self.success / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        text = (
+            f"Рассылка '{self.name}': всего={self.total}, успешно={self.success}, "
+            f"ошибок={self.failed}, пропущено={self.skipped}, заблокировали={len(self.blocked_ids)}, "
+            f"повторов={self.retries}, доставлено ранее={self.resumed}, время={self.elapsed:.1f}с, скорость={self.rate:.1f} сообщ/с"
+        )
+        if self.incomplete:
+            text += f", ПРЕРВАНА: {self.incomplete}"
+        return text
+
+
+def make_broadcast_id(name: str) -> str:
+    """Ключ рассылки на сегодня (одинаковый у всех копий бота и при повторном запуске)"""
+    today = datetime.now(pytz.timezone(config.TIMEZONE)).strftime("%Y-%m-%d")
+    return f"{name}:{today}"
+
+
+def is_blocked_error(error: Exception) -> bool:
+    """Проверяет, означает ли ошибка, что пользователь недоступен (заблокировал бота и т.п.)"""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    text = str(error).lower()
+    return "bot was blocked" in text or "user is deactivated" in text or "chat not found" in text
+
+
+def _default_get_id(item: Any) -> Optional[int]:
+    if isinstance(item, dict):
+        return item.get("telegram_id")
+    return item
+
+
+# Глобальный ограничитель скорости - общий для всех рассылок процесса (полный лимит
+# Telegram): напоминания, штрафы, финальные сообщения, /group, удаления выполняет
+# одна копия бота (аренда задачи)
+global_limiter = TokenBucket(config.BROADCAST_RATE_LIMIT)
+
+# Ограничитель шардированной рассылки задания: её одновременно ведут BROADCAST_SHARDS
+# копий бота, каждая получает свою долю лимита
+shard_limiter = (
+    TokenBucket(config.BROADCAST_RATE_LIMIT / config.BROADCAST_SHARDS)
+    if config.BROADCAST_SHARDS > 1 else global_limiter
+)
+
+
+def own_shard() -> Optional[tuple]:
+    """Шард этой копии бота для выборки получателей: (количество шардов, номер) или None"""
+    if config.BROADCAST_SHARDS <= 1:
+        return None
+    return (config.BROADCAST_SHARDS, config.BROADCAST_SHARD_INDEX)
+
+
+def _filter_items(
+    items: Union[Iterable[Any], AsyncIterable[Any]],
+    keep: Callable[[Optional[int]], bool],
+    get_id: Callable[[Any], Optional[int]]
+) -> Union[Iterable[Any], AsyncIterable[Any]]:
+    if hasattr(items, "__aiter__"):
+        async def filtered():
+            async for item in items:
+                if keep(get_id(item)):
+                    yield item
+        return filtered()
+
+    return [item for item in items if keep(get_id(item))]
+
+
+def filter_recipients(
+    items: Union[Iterable[Any], AsyncIterable[Any]],
+    telegram_ids: set,
+    get_id: Callable[[Any], Optional[int]] = _default_get_id
+) -> Union[Iterable[Any], AsyncIterable[Any]]:
+    """Оставляет только получателей из telegram_ids (повтор ошибок рассылки)"""
+    return _filter_items(items, lambda telegram_id: telegram_id in telegram_ids, get_id)
+
+
+async def broadcast(
+    name: str,
+    items: Union[Iterable[Any], AsyncIterable[Any]],
+    send: Callable[[Any], Awaitable[Optional[bool]]],
+    concurrency: Optional[int] = None,
+    limiter: Optional[TokenBucket] = None,
+    max_retries: Optional[int] = None,
+    get_id: Callable[[Any], Optional[int]] = _default_get_id,
+    journal: Optional[Any] = None,
+    observe_metrics: bool = True
+) -> BroadcastResult:
+    """
+    Выполняет рассылку с ограничением параллельности и скорости
+
+    Args:
+        name: Название рассылки (для логов)
+        items: Получатели (telegram_id или словари пользователей): список или асинхронный
+               генератор - тогда отправка начинается до загрузки всех страниц
+        send: Корутина отправки одному получателю. Возвращает False, если получатель пропущен;
+              исключение означает ошибку отправки
+        concurrency: Количество одновременных отправок (по умолчанию из config)
+        limiter: Ограничитель скорости (по умолчанию глобальный)
+        max_retries: Количество повторов после TelegramRetryAfter (по умолчанию из config)
+        get_id: Функция получения telegram_id из элемента
+        journal: Журнал рассылки (database.BroadcastJournal): получатели, которым уже
+                 доставлено, пропускаются, результат каждой отправки записывается
+        observe_metrics: Учитывать рассылку в метриках bot_broadcast_* (False - служебные
+                 прогоны, например фоновое удаление старых сообщений)
+
+    Returns:
+        BroadcastResult со статистикой
+    """
+    concurrency = concurrency or config.BROADCAST_CONCURRENCY
+    limiter = limiter or global_limiter
+    if max_retries is None:
+        max_retries = config.BROADCAST_MAX_RETRIES
+
+    result = BroadcastResult(name=name)
+    done = object()
+
+    if hasattr(items, "__aiter__"):
+        # Асинхронный генератор нельзя продвигать из нескольких воркеров одновременно
+        aiterator = items.__aiter__()
+        iterator_lock = asyncio.Lock()
+
+        async def next_item():
+            async with iterator_lock:
+                if result.incomplete:
+                    return done
+                try:
+                    return await aiterator.__anext__()
+                except StopAsyncIteration:
+                    return done
+                except Exception as e:
+                    # Получатели не догрузились (например, ошибка БД): останавливаемся
+                    # и помечаем рассылку прерванной, а не завершённой
+                    result.incomplete = str(e) or type(e).__name__
+                    logger.error(f"[{name}] Рассылка прервана: не удалось получить получателей: {e}")
+                    return done
+    else:
+        iterator = iter(items)
+
+        async def next_item():
+            return next(iterator, done)
+
+    async def record(telegram_id: int, status: str, error: Optional[str] = None):
+        if journal is not None:
+            await journal.record(telegram_id, status, error)
+
+    async def send_one(item: Any):
+        telegram_id = get_id(item)
+        if not telegram_id:
+            result.skipped += 1
+            return
+
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            try:
+                sent = await send(item)
+                if sent is False:
+                    result.skipped += 1
+                    await record(telegram_id, "skipped")
+                else:
+                    result.success += 1
+                    await record(telegram_id, "sent")
+                return
+            except TelegramRetryAfter as e:
+                # Флуд-контроль: останавливаем ВСЕ отправки на retry_after секунд
+                limiter.pause(e.retry_after)
+                result.retries += 1
+                attempt += 1
+                logger.warning(f"⏱️ [{name}] Флуд-контроль, пауза {e.retry_after}с (попытка {attempt}/{max_retries}) для {telegram_id}")
+                if attempt > max_retries:
+                    result.failed += 1
+                    logger.error(f"[{name}] Не удалось отправить {telegram_id}: превышено число повторов")
+                    await record(telegram_id, "failed", "превышено число повторов после флуд-контроля")
+                    return
+            except Exception as e:
+                result.failed += 1
+                if is_blocked_error(e):
+                    result.blocked_ids.append(telegram_id)
+                    logger.warning(f"[{name}] Пользователь {telegram_id} заблокировал бота")
+                    await record(telegram_id, "blocked", str(e))
+                else:
+                    logger.error(f"[{name}] Ошибка при отправке пользователю {telegram_id}: {e}")
+                    await record(telegram_id, "failed", str(e))
+                return
+
+    async def worker():
+        while True:
+            item = await next_item()
+            if item is done:
+                return
+            if journal is not None and journal.is_done(get_id(item)):
+                result.resumed += 1
+                continue
+            result.total += 1
+            await send_one(item)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    result.finished_at = time.monotonic()
+    if result.incomplete:
+        logger.error(f"📊 {result.summary()}")
+    else:
+        logger.info(f"📊 {result.summary()}")
+    if observe_metrics:
+        metrics.observe_broadcast(result)
+    return result
+
+
+# Максимум сообщений в одном вызове deleteMessages (ограничение Bot API)
+DELETE_MESSAGES_BATCH_SIZE = 100
+
+# Фоновые задачи удаления (ссылки держим, чтобы задачи не собрал сборщик мусора)
+_background_tasks: set = set()
+
+
+async def delete_messages_batched(bot, chat_id: int, message_ids: list, raise_retry_after: bool = False) -> int:
+    """
+    Удаляет сообщения пачками через deleteMessages (до 100 ID за вызов)
+    
+    Args:
+        raise_retry_after: Пробрасывать TelegramRetryAfter (внутри broadcast(): движок
+                           ставит паузу на весь лимит и повторяет удаление)
+    
+    Returns:
+        Количество сообщений в успешно обработанных пачках
+    """
+    deleted = 0
+    for i in range(0, len(message_ids), DELETE_MESSAGES_BATCH_SIZE):
+        batch = message_ids[i:i + DELETE_MESSAGES_BATCH_SIZE]
+        try:
+            # Уже удалённые / недоступные сообщения Telegram пропускает сам
+            await bot.delete_messages(chat_id=chat_id, message_ids=batch)
+            deleted += len(batch)
+        except TelegramRetryAfter as e:
+            if raise_retry_after:
+                raise
+            logger.warning(f"Флуд-контроль при удалении {len(batch)} сообщений у {chat_id}: {e}")
+        except Exception as e:
+            logger.warning(f"Не удалось удалить {len(batch)} сообщений у {chat_id}: {e}")
+    return deleted
+
+
+def delete_in_background(name: str, bot, messages_by_chat: Dict[int, List[int]]) -> Optional[asyncio.Task]:
+    """
+    Удаляет сообщения в фоне после рассылки (низкий приоритет)
+    
+    Удаление идёт через тот же движок рассылок (лимит скорости, флуд-контроль),
+    но с небольшой параллельностью BROADCAST_CLEANUP_CONCURRENCY и уже после того,
+    как новые сообщения доставлены.
+    
+    Args:
+        name: Название (для логов)
+        bot: Экземпляр бота
+        messages_by_chat: {chat_id: [message_id, ...]}
+    
+    Returns:
+        Фоновая задача или None, если удалять нечего
+    """
+    if not messages_by_chat:
+        return None
+    
+    async def delete_chat(item):
+        chat_id, message_ids = item
+        # Повтор после флуд-контроля удаляет пачки чата заново - уже удалённые Telegram пропустит
+        await delete_messages_batched(bot, chat_id, message_ids, raise_retry_after=True)
+    
+    # Удаления не учитываются в метриках рассылок (bot_broadcast_*)
+    task = asyncio.create_task(broadcast(
+        name,
+        list(messages_by_chat.items()),
+        delete_chat,
+        concurrency=config.BROADCAST_CLEANUP_CONCURRENCY,
+        get_id=lambda item: item[0],
+        observe_metrics=False
+    ))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
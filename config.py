@@ -3,7 +3,9 @@
 Конфигурационный файл бота
 """
 
+import hashlib
 import os
+import socket
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -71,6 +73,32 @@ COURSE_DAYS = 14
 CHECK_POST_AGE = os.getenv("CHECK_POST_AGE", "false").lower() == "true"
 MAX_POST_AGE_HOURS = int(os.getenv("MAX_POST_AGE_HOURS", "23"))
 
+# ============================================================
+# НАСТРОЙКИ РАССЫЛОК
+# ============================================================
+
+# Количество одновременных отправок в одной рассылке
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+
+# Глобальный лимит скорости рассылок (сообщений в секунду, лимит Telegram ~30/сек)
+BROADCAST_RATE_LIMIT = float(os.getenv("BROADCAST_RATE_LIMIT", "25"))
+
+# Сколько раз повторять отправку после флуд-контроля (TelegramRetryAfter)
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+
+# Количество одновременных удалений старых сообщений после рассылки (фоновая очистка)
+BROADCAST_CLEANUP_CONCURRENCY = int(os.getenv("BROADCAST_CLEANUP_CONCURRENCY", "5"))
+
+# Шардирование рассылки заданий между копиями бота: копия с BROADCAST_SHARD_INDEX=i
+# рассылает пользователям с telegram_id % BROADCAST_SHARDS == i (1 = без шардирования).
+# Шардируется только рассылка задания (10:00): остальные рассылки выполняет одна копия
+# с полным лимитом BROADCAST_RATE_LIMIT
+BROADCAST_SHARDS = max(1, int(os.getenv("BROADCAST_SHARDS", "1")))
+BROADCAST_SHARD_INDEX = int(os.getenv("BROADCAST_SHARD_INDEX", "0"))
+
+if not 0 <= BROADCAST_SHARD_INDEX < BROADCAST_SHARDS:
+    raise ValueError(f"BROADCAST_SHARD_INDEX должен быть от 0 до {BROADCAST_SHARDS - 1}")
+
 # Пути к картинкам для курса
 TASK_IMAGE_DIR = "media/tasks"  # Директория с картинками заданий (task_1.jpg/.png, task_2.jpg/.png и т.д.)
 
@@ -104,9 +132,29 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 # n8n Webhook URL (для генерации постов)
 N8N_WEBHOOK_URL = os.getenv("N8N_WEBHOOK_URL", "")
 
+# Адрес /webhook/n8n именно этой копии бота (например http://10.0.0.5:8080/webhook/n8n).
+# Передаётся в n8n как callback_url: ответ на генерацию должен прийти в ту копию,
+# которая его ждёт. Пусто - n8n отвечает на адрес из своего workflow (одна копия бота)
+N8N_CALLBACK_URL = os.getenv("N8N_CALLBACK_URL", "")
+
 # Таймаут ожидания ответа от n8n (в секундах)
 N8N_TIMEOUT = int(os.getenv("N8N_TIMEOUT", "300"))  # 5 минут = 300 секунд
 
+# Максимум одновременных HTTP-соединений с n8n (общий пул с keep-alive)
+N8N_POOL_LIMIT = int(os.getenv("N8N_POOL_LIMIT", "20"))
+
+# Максимум одновременных генераций постов в n8n (остальные ждут в очереди)
+N8N_MAX_IN_FLIGHT = int(os.getenv("N8N_MAX_IN_FLIGHT", "10"))
+
+# Голосовые до этого размера (байт) скачиваются в память, большие - во временный файл
+VOICE_MEMORY_LIMIT = int(os.getenv("VOICE_MEMORY_LIMIT", str(5 * 1024 * 1024)))
+
+# Транскрибация: максимум одновременных запросов к Whisper, повторов при 429
+# и сколько распознанных голосовых помнить (по file_unique_id)
+TRANSCRIPTION_MAX_CONCURRENT = int(os.getenv("TRANSCRIPTION_MAX_CONCURRENT", "4"))
+TRANSCRIPTION_MAX_RETRIES = int(os.getenv("TRANSCRIPTION_MAX_RETRIES", "3"))
+TRANSCRIPTION_CACHE_SIZE = int(os.getenv("TRANSCRIPTION_CACHE_SIZE", "1000"))
+
 # Проверка интеграций
 if not OPENAI_API_KEY:
     print("⚠️  ВНИМАНИЕ: OPENAI_API_KEY не установлен! Транскрибация голоса не будет работать.")
@@ -116,6 +164,46 @@ if not N8N_WEBHOOK_URL:
     print("⚠️  ВНИМАНИЕ: N8N_WEBHOOK_URL не установлен! Генерация постов не будет работать.")
     print("   Добавьте в .env: N8N_WEBHOOK_URL=https://your-n8n.com/webhook/...")
 
+# ============================================================
+# ПРИЁМ ОБНОВЛЕНИЙ TELEGRAM
+# ============================================================
+# Если TELEGRAM_WEBHOOK_URL задан, бот получает обновления через webhook
+# на том же веб-сервере, что и ответы n8n (вместо long polling).
+# Состояния диалогов и ожидание ответов n8n живут в процессе:
+# несколько копий за балансировщиком работают, только если апдейты одного чата
+# всегда попадают в одну копию (sticky-маршрутизация по chat_id), а ответы n8n -
+# в копию, отправившую запрос (N8N_CALLBACK_URL). Иначе обновления Telegram
+# должна принимать одна копия.
+
+# Публичный адрес веб-сервера бота (например https://bot.example.com), пусто = long polling
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip("/")
+
+# Путь, на который Telegram присылает обновления
+TELEGRAM_WEBHOOK_PATH = os.getenv("TELEGRAM_WEBHOOK_PATH", "/webhook/telegram")
+
+# Секрет для проверки заголовка X-Telegram-Bot-Api-Secret-Token
+# (если не задан - вычисляется из BOT_TOKEN, одинаковый у всех копий бота)
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+
+# Адрес и порт веб-сервера (вебхуки n8n и Telegram)
+WEBHOOK_SERVER_HOST = os.getenv("WEBHOOK_SERVER_HOST", "0.0.0.0")
+WEBHOOK_SERVER_PORT = int(os.getenv("WEBHOOK_SERVER_PORT", "8080"))
+
+# Идентификатор копии бота (для аренды задач планировщика, по умолчанию хост:pid)
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+# Через сколько секунд аренда задачи планировщика считается брошенной
+SCHEDULER_LEASE_TTL = int(os.getenv("SCHEDULER_LEASE_TTL", "3600"))
+
+# Метрики в формате Prometheus на веб-сервере (GET METRICS_PATH), по умолчанию выключены.
+# Если включены, веб-сервер запускается даже без вебхуков n8n и Telegram
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+
+# Токен доступа к метрикам: запрос должен содержать "Authorization: Bearer <токен>".
+# Пусто - без проверки (тогда закройте порт файрволом)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
 # ============================================================
 # КАРТИНКИ ДЛЯ ЛОГИКИ ПОСТОВ
 # ============================================================
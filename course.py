@@ -8,11 +8,12 @@ import os
 from datetime import datetime
 from typing import Optional
 from aiogram import Bot
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 import config
 import messages
-from media_helper import get_task_image_path, get_reminder_image_path, get_penalty_image_path
+from media_helper import get_task_image_path, get_reminder_image_path, get_penalty_image_path, send_photo_cached
 from database import (
     get_global_course_state,
     update_global_course_state,
@@ -20,7 +21,6 @@ from database import (
     get_task_by_number,
     get_users_by_current_task,
     get_all_registered_users,
-    add_penalty,
     get_user_by_telegram_id,
     get_user_course_state,
     CourseState,
@@ -30,6 +30,7 @@ from database import (
     get_user_penalties
 )
 from monitoring import monitor
+from broadcast import broadcast, delete_in_background, filter_recipients, make_broadcast_id, own_shard, shard_limiter, BroadcastResult
 
 logger = logging.getLogger(__name__)
 
@@ -78,8 +79,8 @@ async def stop_course(bot: Bot, admin_id: int) -> dict:
         Словарь с результатом: {'success': bool, 'message': str, 'users_count': int}
     """
     try:
-        # Проверяем, активен ли курс
-        course_state = await get_global_course_state()
+        # Проверяем, активен ли курс (свежее значение из БД, а не снимок)
+        course_state = await get_global_course_state(refresh=True)
         
         if not course_state or not course_state.get("is_active"):
             return {
@@ -89,7 +90,7 @@ async def stop_course(bot: Bot, admin_id: int) -> dict:
             }
         
         # Получаем всех пользователей в курсе
-        from database import get_all_active_users_in_course, supabase, TABLE_NAME
+        from database import get_all_active_users_in_course, supabase, TABLE_NAME, user_cache
         users = await get_all_active_users_in_course()
         
         # Очищаем данные пользователей
@@ -135,7 +136,8 @@ async def stop_course(bot: Bot, admin_id: int) -> dict:
                         update_data['last_reminder_sent_at'] = None
                     
                     # Сбрасываем данные курса
-                    supabase.table(TABLE_NAME).update(update_data).eq('telegram_id', telegram_id).execute()
+                    await supabase.table(TABLE_NAME).update(update_data).eq('telegram_id', telegram_id).execute()
+                    user_cache.update(telegram_id, update_data)
                 except Exception as e:
                     logger.warning(f"Не удалось обновить пользователя {telegram_id}: {e}")
                     # Продолжаем со следующим пользователем
@@ -175,8 +177,8 @@ async def start_course(bot: Bot, admin_id: int) -> str:
         Сообщение о результате
     """
     try:
-        # Проверяем, не запущен ли курс уже
-        course_state = await get_global_course_state()
+        # Проверяем, не запущен ли курс уже (свежее значение из БД, а не снимок)
+        course_state = await get_global_course_state(refresh=True)
         
         if course_state and course_state.get("is_active"):
             current_day = course_state.get("current_day", 0)
@@ -201,17 +203,19 @@ async def start_course(bot: Bot, admin_id: int) -> str:
         return f"❌ Ошибка при запуске курса: {e}"
 
 
-async def send_task_to_users(bot: Bot, task_number: int):
+async def send_task_to_users(bot: Bot, task_number: int, only_failed: bool = False):
     """
     Отправляет задание пользователям
     
     ВАЖНО:
     - Удаляет предыдущее сообщение с заданием
     - Сохраняет message_id нового задания
+    - Повторный запуск в тот же день пропускает тех, кому задание уже доставлено (журнал рассылок)
     
     Args:
         bot: Экземпляр бота
         task_number: Номер задания (1-14)
+        only_failed: Отправить только тем, кому сегодняшняя рассылка не удалась
     """
     try:
         # Получаем задание из БД (из таблицы digest_day_X)
@@ -221,17 +225,23 @@ async def send_task_to_users(bot: Bot, task_number: int):
             logger.error(f"Задание {task_number} не найдено в БД (таблица digest_day_{task_number})!")
             return
         
-        # Получаем ВСЕХ активных пользователей в курсе (не только на текущем задании!)
-        from database import get_all_active_users_in_course, get_user_last_task_message_id, save_user_last_task_message_id
-        users = await get_all_active_users_in_course()
+        # ВСЕ активные пользователи в курсе (не только на текущем задании!)
+        # Загружаются постранично прямо во время рассылки, только нужные колонки
+        from database import iter_active_users_in_course
+        # При шардировании эта копия бота загружает и рассылает только свою часть пользователей
+        users = iter_active_users_in_course(
+            columns="telegram_id,course_state,last_task_message_id",
+            shard=own_shard()
+        )
         
-        logger.info(f"📊 Получено пользователей для задания {task_number}: {len(users)}")
-        if users:
-            logger.info(f"📋 Список telegram_id: {[u.get('telegram_id') for u in users]}")
-        
-        if not users:
-            logger.warning(f"❌ Нет пользователей для задания {task_number}")
-            return
+        broadcast_id = make_broadcast_id(f"task_{task_number}")
+        if only_failed:
+            from database import get_broadcast_failures
+            failed_ids = await get_broadcast_failures(broadcast_id)
+            if not failed_ids:
+                logger.info(f"Нет ошибок рассылки {broadcast_id} для повтора")
+                return
+            users = filter_recipients(users, failed_ids)
         
         # Получаем текст задания из колонки "zadanie"
         zadanie_text = task.get("zadanie", "")
@@ -248,14 +258,13 @@ async def send_task_to_users(bot: Bot, task_number: int):
         # Путь к картинке задания (универсальный поиск .jpg/.png/.jpeg)
         image_path = get_task_image_path(task_number, config.TASK_IMAGE_DIR)
         
-        # Отправляем каждому пользователю
-        success_count = 0
-        failed_count = 0
+        from database import UserUpdateBatch, BroadcastJournal
         
-        for user in users:
+        # Старые задания удаляются в фоне после рассылки: {telegram_id: [message_id]}
+        old_task_messages = {}
+        
+        async def send_to_user(user: dict):
             telegram_id = user.get("telegram_id")
-            if not telegram_id:
-                continue
             
             # Проверяем, является ли пользователь ограниченным участником
             user_course_state = user.get("course_state", "")
@@ -269,81 +278,109 @@ async def send_task_to_users(bot: Bot, task_number: int):
                 user_message = message_text
                 user_keyboard = keyboard
             
-            try:
-                # 1. Удаляем предыдущее сообщение с заданием
-                old_message_id = await get_user_last_task_message_id(telegram_id)
-                if old_message_id:
-                    try:
-                        await bot.delete_message(chat_id=telegram_id, message_id=old_message_id)
-                        logger.info(f"🗑️ Удалено старое задание (msg_id={old_message_id}) у {telegram_id}")
-                    except Exception as del_error:
-                        logger.warning(f"Не удалось удалить старое задание у {telegram_id}: {del_error}")
-                
-                # 2. Отправляем новое задание
-                sent_message = None
-                if image_path:
-                    photo = FSInputFile(image_path)
-                    sent_message = await bot.send_photo(
-                        chat_id=telegram_id,
-                        photo=photo,
-                        caption=user_message,
-                        reply_markup=user_keyboard
-                    )
-                else:
-                    # Если картинки нет, отправляем просто текст
-                    logger.warning(f"Картинка не найдена: {image_path}")
-                    sent_message = await bot.send_message(
-                        chat_id=telegram_id,
-                        text=user_message,
-                        reply_markup=user_keyboard
-                    )
-                
-                # 3. Сохраняем message_id нового задания
-                if sent_message:
-                    await save_user_last_task_message_id(telegram_id, sent_message.message_id)
-                
-                # 4. Обновляем current_task (course_state НЕ меняем для limited)
-                from database import supabase, TABLE_NAME
-                try:
-                    if is_limited:
-                        # Для limited только обновляем current_task
-                        logger.info(f"Обновляем current_task={task_number} для LIMITED {telegram_id}")
-                        response = supabase.table(TABLE_NAME).update({
-                            'current_task': task_number
-                        }).eq('telegram_id', telegram_id).execute()
-                    else:
-                        # Для обычных пользователей обновляем и task и state
-                        logger.info(f"Обновляем current_task={task_number}, course_state=in_progress для {telegram_id}")
-                        response = supabase.table(TABLE_NAME).update({
-                            'current_task': task_number,
-                            'course_state': CourseState.IN_PROGRESS
-                        }).eq('telegram_id', telegram_id).execute()
-                    logger.info(f"✅ Данные обновлены для {telegram_id}")
-                except Exception as update_error:
-                    logger.error(f"❌ Не удалось обновить данные для {telegram_id}: {update_error}")
-                
-                success_count += 1
-                logger.info(f"Задание {task_number} отправлено пользователю {telegram_id}")
-                
-            except Exception as e:
-                failed_count += 1
-                # Если пользователь заблокировал бота
-                if "bot was blocked" in str(e).lower() or "user is deactivated" in str(e).lower() or "chat not found" in str(e).lower():
-                    logger.warning(f"Пользователь {telegram_id} заблокировал бота")
-                    from database import mark_user_as_blocked
-                    await mark_user_as_blocked(telegram_id)
-                else:
-                    logger.error(f"Ошибка при отправке задания пользователю {telegram_id}: {e}")
+            # 1. Сначала отправляем новое задание
+            sent_message = None
+            if image_path:
+                sent_message = await send_photo_cached(
+                    bot,
+                    telegram_id,
+                    image_path,
+                    caption=user_message,
+                    reply_markup=user_keyboard
+                )
+            else:
+                # Если картинки нет, отправляем просто текст
+                logger.warning(f"Картинка не найдена: {image_path}")
+                sent_message = await bot.send_message(
+                    chat_id=telegram_id,
+                    text=user_message,
+                    reply_markup=user_keyboard
+                )
+            
+            # 2. Предыдущее задание (message_id из уже загруженной строки) удалим в фоне
+            old_message_id = user.get("last_task_message_id")
+            if old_message_id and (not sent_message or old_message_id != sent_message.message_id):
+                old_task_messages[telegram_id] = [old_message_id]
+            
+            # 3. Сохраняем message_id и current_task (course_state НЕ меняем для limited)
+            # Запись идёт пачками через UserUpdateBatch, а не UPDATE на каждого пользователя
+            update_fields = {'current_task': task_number}
+            if not is_limited:
+                update_fields['course_state'] = CourseState.IN_PROGRESS
+            if sent_message:
+                update_fields['last_task_message_id'] = sent_message.message_id
+            await batch.add(telegram_id, **update_fields)
+            
+            logger.info(f"Задание {task_number} отправлено пользователю {telegram_id}")
+        
+        # Рассылка с ограничением параллельности и скорости
+        async with UserUpdateBatch() as batch, BroadcastJournal(broadcast_id, batch) as journal:
+            result = await broadcast(
+                f"task_{task_number}", users, send_to_user,
+                limiter=shard_limiter, journal=journal
+            )
+            
+            # Отмечаем пользователей, заблокировавших бота
+            for telegram_id in result.blocked_ids:
+                await batch.add(telegram_id, is_blocked=True)
+        logger.info(f"💾 Данные обновлены для {batch.flushed_count} пользователей")
+        
+        if result.incomplete:
+            await monitor.report_broadcast_incomplete(bot, result)
         
-        logger.info(f"Задание {task_number} разослано: успешно={success_count}, ошибок={failed_count}")
+        # Новые задания доставлены - удаляем вчерашние в фоне, не задерживая отчёт
+        if delete_in_background(f"cleanup_task_{task_number}", bot, old_task_messages):
+            logger.info(f"🗑️ Удаление {len(old_task_messages)} старых заданий запущено в фоне")
+        
+        if config.BROADCAST_SHARDS > 1:
+            # Итог шарда записывается даже без получателей - иначе общий отчёт не соберётся
+            await report_task_shard(bot, task_number, result)
+            return
+        
+        if not result.total:
+            if result.resumed:
+                logger.info(f"Задание {task_number} уже доставлено всем ({result.resumed} чел.)")
+            else:
+                logger.warning(f"❌ Нет пользователей для задания {task_number}")
+            return
+        
+        logger.info(f"Задание {task_number} разослано: успешно={result.success}, ошибок={result.failed}")
         
         # Отправляем отчет в мониторинг
-        await monitor.report_task_sent(bot, task_number, success_count, failed_count)
+        await monitor.report_task_sent(bot, task_number, result.success, result.failed, elapsed=result.elapsed)
         
     except Exception as e:
         logger.error(f"Ошибка при рассылке задания: {e}")
 
 
+async def report_task_shard(bot: Bot, task_number: int, result: BroadcastResult):
+    """
+    Записывает итог шарда рассылки задания; копия, закончившая последней,
+    отправляет в мониторинг один общий отчёт по всем шардам
+    """
+    from database import report_broadcast_shard
+    
+    shard = config.BROADCAST_SHARD_INDEX
+    logger.info(
+        f"Задание {task_number}, шард {shard}/{config.BROADCAST_SHARDS}: "
+        f"успешно={result.success}, ошибок={result.failed}"
+    )
+    
+    totals = await report_broadcast_shard(
+        make_broadcast_id(f"task_{task_number}"), shard, config.BROADCAST_SHARDS,
+        result.success, result.failed, result.elapsed
+    )
+    
+    if totals is None:
+        # Итоги шардов не собираются (миграция не применена) - отчёт только по своему шарду
+        await monitor.report_task_sent(bot, task_number, result.success, result.failed, elapsed=result.elapsed)
+    elif totals:
+        logger.info(f"Задание {task_number} разослано всеми шардами: успешно={totals['success']}, ошибок={totals['failed']}")
+        await monitor.report_task_sent(bot, task_number, totals["success"], totals["failed"], elapsed=totals["elapsed"])
+    else:
+        logger.info(f"Задание {task_number}: ждём итоги остальных шардов для общего отчёта")
+
+
 async def send_task_to_single_user(bot: Bot, telegram_id: int, task_number: int) -> bool:
     """
     Отправляет задание одному пользователю (для опоздавших регистраций)
@@ -364,7 +401,7 @@ async def send_task_to_single_user(bot: Bot, telegram_id: int, task_number: int)
             logger.error(f"Задание {task_number} не найдено в БД!")
             return False
         
-        from database import save_user_last_task_message_id, supabase, TABLE_NAME, CourseState
+        from database import save_user_last_task_message_id, update_user_fields, CourseState
         
         # Получаем текст задания
         zadanie_text = task.get("zadanie", "")
@@ -384,10 +421,10 @@ async def send_task_to_single_user(bot: Bot, telegram_id: int, task_number: int)
         # Отправляем задание
         sent_message = None
         if os.path.exists(image_path):
-            photo = FSInputFile(image_path)
-            sent_message = await bot.send_photo(
-                chat_id=telegram_id,
-                photo=photo,
+            sent_message = await send_photo_cached(
+                bot,
+                telegram_id,
+                image_path,
                 caption=message_text,
                 reply_markup=keyboard
             )
@@ -404,14 +441,13 @@ async def send_task_to_single_user(bot: Bot, telegram_id: int, task_number: int)
             await save_user_last_task_message_id(telegram_id, sent_message.message_id)
         
         # Обновляем current_task и course_state у пользователя
-        try:
-            supabase.table(TABLE_NAME).update({
-                'current_task': task_number,
-                'course_state': CourseState.IN_PROGRESS
-            }).eq('telegram_id', telegram_id).execute()
+        if await update_user_fields(telegram_id, {
+            'current_task': task_number,
+            'course_state': CourseState.IN_PROGRESS
+        }):
             logger.info(f"✅ Опоздавший {telegram_id}: отправлено задание {task_number}, статус=in_progress")
-        except Exception as update_error:
-            logger.error(f"❌ Ошибка обновления данных опоздавшего {telegram_id}: {update_error}")
+        else:
+            logger.error(f"❌ Ошибка обновления данных опоздавшего {telegram_id}")
         
         return True
         
@@ -465,10 +501,10 @@ async def send_task_to_limited_user(bot: Bot, telegram_id: int, task_number: int
         # Отправляем задание
         sent_message = None
         if os.path.exists(image_path):
-            photo = FSInputFile(image_path)
-            sent_message = await bot.send_photo(
-                chat_id=telegram_id,
-                photo=photo,
+            sent_message = await send_photo_cached(
+                bot,
+                telegram_id,
+                image_path,
                 caption=message_text,
                 reply_markup=keyboard
             )
@@ -557,50 +593,41 @@ async def send_reminder(bot: Bot, reminder_type: str):
             message_text = messages.MSG_REMINDER_3
             reminder_image = get_reminder_image_path(3)
         
-        # Отправляем каждому
-        success_count = 0
-        failed_count = 0
-        
-        for user in users:
+        async def send_to_user(user: dict):
             telegram_id = user.get("telegram_id")
             user_course_state = user.get("course_state", "")
             
-            if not telegram_id:
-                continue
-            
             # LIMITED пользователи НЕ получают напоминания (у них нет обязательств сдавать)
             if user_course_state == CourseState.LIMITED:
                 logger.info(f"⏭️ Пропуск напоминания для LIMITED {telegram_id}")
-                continue
+                return False
             
-            try:
-                if reminder_image:
-                    photo = FSInputFile(reminder_image)
-                    await bot.send_photo(
-                        chat_id=telegram_id,
-                        photo=photo,
-                        caption=message_text,
-                        reply_markup=keyboard
-                    )
-                else:
-                    await bot.send_message(
-                        chat_id=telegram_id,
-                        text=message_text,
-                        reply_markup=keyboard
-                    )
-                
-                success_count += 1
-                logger.info(f"Напоминание отправлено пользователю {telegram_id}")
-                
-            except Exception as e:
-                failed_count += 1
-                # Если пользователь заблокировал бота
-                if "bot was blocked" in str(e).lower() or "user is deactivated" in str(e).lower() or "chat not found" in str(e).lower():
-                    logger.warning(f"Пользователь {telegram_id} заблокировал бота")
-                    from database import mark_user_as_blocked
-                    await mark_user_as_blocked(telegram_id)
-                else:
-                    logger.error(f"Ошибка при отправке напоминания пользователю {telegram_id}: {e}")
+            if reminder_image:
+                await send_photo_cached(
+                    bot,
+                    telegram_id,
+                    reminder_image,
+                    caption=message_text,
+                    reply_markup=keyboard
+                )
+            else:
+                await bot.send_message(
+                    chat_id=telegram_id,
+                    text=message_text,
+                    reply_markup=keyboard
+                )
+            
+            logger.info(f"Напоминание отправлено пользователю {telegram_id}")
+        
+        # Рассылка с ограничением параллельности и скорости
+        result = await broadcast(reminder_type, users, send_to_user)
+        success_count = result.success
+        failed_count = result.failed
+        
+        # Отмечаем пользователей, заблокировавших бота (пачками)
+        if result.blocked_ids:
+            from database import mark_users_as_blocked
+            await mark_users_as_blocked(result.blocked_ids)
         
         logger.info(f"Напоминание ({reminder_type}) отправлено: успешно={success_count}, ошибок={failed_count}")
         
@@ -613,7 +640,7 @@ async def send_reminder(bot: Bot, reminder_type: str):
         reminder_num, reminder_time = reminder_mapping.get(reminder_type, (1, ""))
         
         # Отправляем отчет в мониторинг
-        await monitor.report_reminder_sent(bot, reminder_num, reminder_time, success_count, failed_count)
+        await monitor.report_reminder_sent(bot, reminder_num, reminder_time, success_count, failed_count, elapsed=result.elapsed)
         
     except Exception as e:
         logger.error(f"Ошибка при отправке напоминаний: {e}")
@@ -627,6 +654,9 @@ async def check_tasks_completion(bot: Bot):
     - current_task == current_day → НЕ сдал → ШТРАФ + перевод на следующий день
     - current_task > current_day → уже сдал → ничего не делаем
     - current_task == 0 → не получал задание (курс только запущен) → перевод без штрафа
+    
+    Штрафы и перевод считаются в БД одной операцией (RPC apply_daily_penalties),
+    бот только рассылает сообщения о штрафах и исключает из чата.
     """
     try:
         # Получаем текущий день курса
@@ -644,91 +674,68 @@ async def check_tasks_completion(bot: Bot):
             logger.info(f"⏭️ Проверка пропущена: current_day={current_day} вне диапазона 1-{config.COURSE_DAYS}")
             return
         
-        # Получаем ВСЕХ активных пользователей в курсе
-        from database import get_all_active_users_in_course
-        all_users = await get_all_active_users_in_course()
+        # Штрафы и перевод на следующее задание - одной операцией в БД
+        from database import apply_daily_penalties
+        changed = await apply_daily_penalties(current_day)
         
-        if not all_users:
-            logger.info(f"⏭️ Нет активных пользователей в курсе")
-            return
+        if changed is None:
+            # RPC не установлена (migrations/apply_daily_penalties.sql) - считаем на стороне бота
+            logger.warning("⚠️ RPC apply_daily_penalties недоступна, штрафы считаются в боте")
+            changed = await _apply_penalties_in_python(current_day)
         
-        logger.info(f"👥 Найдено {len(all_users)} активных пользователей для проверки")
+        penalized = [row for row in changed if row.get("penalized")]
+        
+        logger.info(
+            f"👥 Переведено на задание {current_day + 1}: {len(changed)} пользователей, "
+            f"из них оштрафовано: {len(penalized)}"
+        )
         
         # Словарь для сбора статистики штрафов: {1: [user_ids], 2: [user_ids], ...}
         penalties_by_count = {1: [], 2: [], 3: [], 4: []}
+        for row in penalized:
+            penalties_by_count[min(row.get("penalties") or 1, 4)].append(row.get("telegram_id"))
         
-        # Проверяем каждого пользователя
-        for user in all_users:
-            telegram_id = user.get("telegram_id")
-            user_current_task = user.get("current_task", 0)
-            user_course_state = user.get("course_state", "")
+        async def notify_user(row: dict):
+            telegram_id = row.get("telegram_id")
+            penalties = row.get("penalties") or 1
             
-            if not telegram_id:
-                continue
-            
-            # LIMITED пользователи не получают штрафы (только пишут посты)
-            if user_course_state == CourseState.LIMITED:
-                logger.info(f"⏭️ Пропуск LIMITED пользователя {telegram_id} (без штрафов)")
-                continue
-            
-            logger.info(f"👤 Пользователь {telegram_id}: current_task={user_current_task}, current_day={current_day}")
+            logger.info(f"🚫 Пользователь {telegram_id} НЕ сдал задание {current_day}. Штраф #{penalties}")
             
+            # Отправляем сообщение о штрафе
+            delivery_error = None
             try:
-                # Случай 1: НЕ сдал задание (current_task == current_day) → ШТРАФ
-                if user_current_task == current_day:
-                    penalties = await add_penalty(telegram_id)
-                    
-                    logger.info(f"🚫 Пользователь {telegram_id} НЕ сдал задание {current_day}. Штраф #{penalties}")
-                    
-                    # Статистика для мониторинга
-                    if penalties <= 4:
-                        penalties_by_count[penalties].append(telegram_id)
-                    else:
-                        penalties_by_count[4].append(telegram_id)
-                    
-                    # Отправляем сообщение о штрафе
-                    await send_penalty_message(bot, telegram_id, penalties)
-                    
-                    # Если 3 штрафа - исключаем из чата
-                    if penalties == 3 and config.COURSE_CHAT_ID:
-                        try:
-                            await bot.ban_chat_member(
-                                chat_id=config.COURSE_CHAT_ID,
-                                user_id=telegram_id
-                            )
-                            logger.info(f"Пользователь {telegram_id} исключен из чата")
-                        except Exception as e:
-                            logger.error(f"Ошибка при исключении из чата: {e}")
-                    
-                    # Переводим на следующее задание
-                    from database import supabase, TABLE_NAME
-                    next_task = current_day + 1
-                    supabase.table(TABLE_NAME).update({
-                        "current_task": next_task
-                    }).eq("telegram_id", telegram_id).execute()
-                    
-                    logger.info(f"➡️ Переведен на задание {next_task}")
-                
-                # Случай 2: Уже сдал (current_task > current_day) → ничего не делаем
-                elif user_current_task > current_day:
-                    logger.info(f"✅ Пользователь {telegram_id} уже сдал задание {current_day}")
-                
-                # Случай 3: Не получал задание (current_task == 0) → перевод без штрафа
-                elif user_current_task == 0:
-                    logger.warning(f"⚠️ Пользователь {telegram_id} не получал задание (current_task=0). Перевод без штрафа.")
-                    
-                    from database import supabase, TABLE_NAME
-                    next_task = current_day + 1
-                    supabase.table(TABLE_NAME).update({
-                        "current_task": next_task
-                    }).eq("telegram_id", telegram_id).execute()
-                    
-                    logger.info(f"➡️ Переведен на задание {next_task} (без штрафа)")
-                
+                await _send_penalty(bot, telegram_id, penalties)
+            except TelegramRetryAfter:
+                # Флуд-контроль: рассылка повторит вызов целиком
+                raise
             except Exception as e:
-                logger.error(f"Ошибка при обработке пользователя {telegram_id}: {e}")
+                # Ошибка доставки (например, бот заблокирован) не отменяет исключение из чата
+                delivery_error = e
+            
+            # Если 3 штрафа - исключаем из чата
+            if penalties == 3 and config.COURSE_CHAT_ID:
+                try:
+                    await bot.ban_chat_member(
+                        chat_id=config.COURSE_CHAT_ID,
+                        user_id=telegram_id
+                    )
+                    logger.info(f"Пользователь {telegram_id} исключен из чата")
+                except Exception as e:
+                    logger.error(f"Ошибка при исключении из чата: {e}")
+            
+            # Рассылка засчитывает недоставленное сообщение (и отмечает заблокировавших)
+            if delivery_error is not None:
+                raise delivery_error
+        
+        result = await broadcast("penalties", penalized, notify_user)
         
-        logger.info(f"✅ Проверка завершена. Обработано: {len(all_users)} пользователей")
+        # Помечаем заблокировавших бота (пачками)
+        if result.blocked_ids:
+            from database import mark_users_as_blocked
+            logger.warning(f"{len(result.blocked_ids)} пользователей заблокировали бота при отправке штрафа")
+            await mark_users_as_blocked(result.blocked_ids)
+        
+        logger.info(f"✅ Проверка завершена. Обработано: {len(changed)} пользователей")
         
         # Отправляем отчет о штрафах в мониторинг
         await monitor.report_penalties(bot, penalties_by_count)
@@ -737,37 +744,83 @@ async def check_tasks_completion(bot: Bot):
         logger.error(f"Ошибка при проверке выполнения заданий: {e}")
 
 
+async def _apply_penalties_in_python(current_day: int) -> list:
+    """
+    Запасной вариант apply_daily_penalties, если RPC не установлена в БД.
+    
+    Returns:
+        Список {telegram_id, penalties, penalized} в том же формате, что и RPC
+    """
+    from database import iter_active_users_in_course, UserUpdateBatch
+    
+    changed = []
+    
+    # Изменения пользователей пишутся пачками (один RPC на BULK_UPDATE_CHUNK_SIZE пользователей)
+    async with UserUpdateBatch() as batch:
+        async for user in iter_active_users_in_course(columns="telegram_id,course_state,current_task,penalties"):
+            telegram_id = user.get("telegram_id")
+            user_current_task = user.get("current_task") or 0
+            
+            if not telegram_id:
+                continue
+            
+            # LIMITED пользователи не получают штрафы (только пишут посты)
+            if user.get("course_state") == CourseState.LIMITED:
+                continue
+            
+            next_task = current_day + 1
+            
+            # НЕ сдал задание (current_task == current_day) → ШТРАФ
+            if user_current_task == current_day:
+                # Штраф считаем по уже загруженной строке - без повторного SELECT
+                penalties = (user.get("penalties") or 0) + 1
+                await batch.add(telegram_id, penalties=penalties, current_task=next_task)
+                changed.append({"telegram_id": telegram_id, "penalties": penalties, "penalized": True})
+            
+            # Не получал задание (current_task == 0) → перевод без штрафа
+            elif user_current_task == 0:
+                await batch.add(telegram_id, current_task=next_task)
+                changed.append({"telegram_id": telegram_id, "penalties": user.get("penalties") or 0, "penalized": False})
+    
+    return changed
+
+
+async def _send_penalty(bot: Bot, telegram_id: int, penalties: int):
+    """Отправляет сообщение о штрафе (ошибки отправки пробрасываются)"""
+    # Выбираем сообщение в зависимости от количества штрафов
+    if penalties == 1:
+        message_text = messages.MSG_PENALTY_1
+    elif penalties == 2:
+        message_text = messages.MSG_PENALTY_2
+    elif penalties == 3:
+        message_text = messages.MSG_PENALTY_3
+    else:
+        message_text = messages.MSG_PENALTY_4
+    
+    # Используем одну картинку для всех штрафов (универсальный поиск)
+    image_path = get_penalty_image_path()
+    
+    # Отправляем
+    if image_path:
+        await send_photo_cached(
+            bot,
+            telegram_id,
+            image_path,
+            caption=message_text
+        )
+    else:
+        await bot.send_message(
+            chat_id=telegram_id,
+            text=message_text
+        )
+    
+    logger.info(f"Сообщение о штрафе {penalties} отправлено пользователю {telegram_id}")
+
+
 async def send_penalty_message(bot: Bot, telegram_id: int, penalties: int):
     """Отправляет сообщение о штрафе"""
     try:
-        # Выбираем сообщение в зависимости от количества штрафов
-        if penalties == 1:
-            message_text = messages.MSG_PENALTY_1
-        elif penalties == 2:
-            message_text = messages.MSG_PENALTY_2
-        elif penalties == 3:
-            message_text = messages.MSG_PENALTY_3
-        else:
-            message_text = messages.MSG_PENALTY_4
-        
-        # Используем одну картинку для всех штрафов (универсальный поиск)
-        image_path = get_penalty_image_path()
-        
-        # Отправляем
-        if image_path:
-            photo = FSInputFile(image_path)
-            await bot.send_photo(
-                chat_id=telegram_id,
-                photo=photo,
-                caption=message_text
-            )
-        else:
-            await bot.send_message(
-                chat_id=telegram_id,
-                text=message_text
-            )
-        
-        logger.info(f"Сообщение о штрафе {penalties} отправлено пользователю {telegram_id}")
+        await _send_penalty(bot, telegram_id, penalties)
         
     except Exception as e:
         # Если пользователь заблокировал бота
@@ -787,7 +840,8 @@ async def advance_course_day(bot: Bot):
     Она только увеличивает current_day - задания отправляются в 10:00 через scheduled_send_task()!
     """
     try:
-        course_state = await get_global_course_state()
+        # current_day увеличивается от значения в БД, а не от снимка в памяти
+        course_state = await get_global_course_state(refresh=True)
         
         if not course_state or not course_state.get("is_active"):
             return
@@ -821,29 +875,33 @@ async def send_completion_messages(bot: Bot):
     """Отправляет сообщения о завершении курса"""
     try:
         # Получаем всех пользователей, которые завершили курс
-        from database import supabase, TABLE_NAME
+        from database import iter_users
         
-        response = supabase.table(TABLE_NAME).select("*").eq("course_state", CourseState.COMPLETED).execute()
-        users = response.data if response.data else []
+        users = iter_users(
+            columns="telegram_id,penalties",
+            filters=lambda query: query.eq("course_state", CourseState.COMPLETED)
+        )
         
-        for user in users:
+        async def send_to_user(user: dict):
             telegram_id = user.get("telegram_id")
             penalties = user.get("penalties", 0)
             
-            if not telegram_id:
-                continue
+            message_text = messages.MSG_COURSE_COMPLETED.format(penalties=penalties)
+            await bot.send_message(
+                chat_id=telegram_id,
+                text=message_text
+            )
             
-            try:
-                message_text = messages.MSG_COURSE_COMPLETED.format(penalties=penalties)
-                await bot.send_message(
-                    chat_id=telegram_id,
-                    text=message_text
-                )
-                
-                logger.info(f"Сообщение о завершении отправлено пользователю {telegram_id}")
-                
-            except Exception as e:
-                logger.error(f"Ошибка при отправке сообщения о завершении: {e}")
+            logger.info(f"Сообщение о завершении отправлено пользователю {telegram_id}")
+        
+        result = await broadcast("course_completed", users, send_to_user)
+        
+        if result.incomplete:
+            await monitor.report_broadcast_incomplete(bot, result)
+        
+        if result.blocked_ids:
+            from database import mark_users_as_blocked
+            await mark_users_as_blocked(result.blocked_ids)
         
     except Exception as e:
         logger.error(f"Ошибка при отправке сообщений о завершении: {e}")
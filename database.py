@@ -3,23 +3,42 @@
 Модуль для работы с базой данных Supabase
 """
 
+import asyncio
+import logging
 import os
-from supabase import create_client, Client
-from typing import Optional, Dict, Any
+import time
+from collections import OrderedDict
+from supabase import AsyncClient
+from supabase.lib.client_options import AsyncClientOptions
+from gotrue import AsyncMemoryStorage
+from typing import Optional, Dict, Any, AsyncIterator, Callable, Tuple
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Инициализация клиента Supabase
-supabase: Client = create_client(
+logger = logging.getLogger(__name__)
+
+# Таймаут HTTP-запросов к PostgREST (секунды)
+DB_TIMEOUT = int(os.getenv("DB_TIMEOUT", "30"))
+
+# Инициализация асинхронного клиента Supabase
+# Все запросы выполняются через await ... .execute() и не блокируют event loop.
+# Под капотом один общий httpx.AsyncClient (пул соединений + keep-alive, HTTP/2).
+supabase: AsyncClient = AsyncClient(
     os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_KEY")
+    os.getenv("SUPABASE_KEY"),
+    options=AsyncClientOptions(
+        storage=AsyncMemoryStorage(),
+        postgrest_client_timeout=DB_TIMEOUT
+    )
 )
 
 # Названия таблиц
 TABLE_NAME = "users"
 COURSE_STATE_TABLE = "course_state"
 DIGEST_TABLE_PREFIX = "digest_day_"  # digest_day_1, digest_day_2, etc.
+FINAL_MESSAGES_TABLE = "final_messages"
+BROADCAST_JOURNAL_TABLE = "broadcast_journal"
 
 # Возможные состояния пользователя
 class UserState:
@@ -38,6 +57,101 @@ class CourseState:
     LIMITED = "limited"  # Ограниченный участник (опоздал на день 2+, только пишет посты)
 
 
+async def close_database():
+    """Закрывает пул HTTP-соединений с Supabase (вызывается при остановке бота)"""
+    try:
+        await supabase.postgrest.aclose()
+    except Exception as e:
+        print(f"Ошибка при закрытии соединения с БД: {e}")
+
+
+# Признаки запуска нескольких копий бота: явный REPLICA_ID, шардирование рассылки или webhook
+_MULTI_REPLICA = (
+    bool(os.getenv("REPLICA_ID") or os.getenv("TELEGRAM_WEBHOOK_URL"))
+    or int(os.getenv("BROADCAST_SHARDS", "1")) > 1
+)
+
+
+# ============================================================
+# КЭШ СТРОК ПОЛЬЗОВАТЕЛЕЙ
+# ============================================================
+# Один апдейт (нажатие кнопки, сообщение) проверяет пользователя несколько раз:
+# should_ignore_user_input, is_user_blocked, get_user_course_state, get_user_current_task...
+# Строка users кэшируется на USER_CACHE_TTL секунд, поэтому все проверки
+# обходятся одним SELECT. Все функции записи этого модуля обновляют кэш
+# (write-through) или сбрасывают его, так что бот видит собственные изменения сразу.
+#
+# Изменения, записанные другой копией бота, кэш не видит: штрафы в 9:50 и рассылка
+# в 10:00 меняют current_task и course_state на копии с арендой задачи, а остальные
+# отдавали бы старые строки до USER_CACHE_TTL секунд (вчерашнее задание в "Написать
+# пост", отметка выполнения не того дня). Поэтому при нескольких копиях кэш
+# по умолчанию выключен.
+
+# Время жизни строки в кэше (секунды, 0 - кэш выключен)
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "0" if _MULTI_REPLICA else "30"))
+
+if _MULTI_REPLICA and USER_CACHE_TTL > 0:
+    logger.warning(
+        f"USER_CACHE_TTL={USER_CACHE_TTL:g} при нескольких копиях бота: изменения других копий "
+        f"(штрафы, рассылка задания) видны с задержкой до {USER_CACHE_TTL:g} с"
+    )
+
+# Максимальное количество пользователей в кэше (вытесняются давно не использованные)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "5000"))
+
+
+class UserRowCache:
+    """LRU-кэш строк таблицы users с ограничением времени жизни"""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._rows: "OrderedDict[int, tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        """Возвращает копию строки или None (нет в кэше / устарела)"""
+        entry = self._rows.get(telegram_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._rows[telegram_id]
+            self.misses += 1
+            return None
+        self._rows.move_to_end(telegram_id)
+        self.hits += 1
+        return dict(entry[1])
+
+    def set(self, telegram_id: int, row: Dict[str, Any]) -> None:
+        """Кладёт в кэш полную строку, загруженную из БД"""
+        if self.ttl <= 0:
+            return
+        self._rows[telegram_id] = (time.monotonic() + self.ttl, dict(row))
+        self._rows.move_to_end(telegram_id)
+        while len(self._rows) > self.max_size:
+            self._rows.popitem(last=False)
+
+    def update(self, telegram_id: int, fields: Dict[str, Any]) -> None:
+        """Применяет записанные в БД изменения к закэшированной строке (если она есть)"""
+        entry = self._rows.get(telegram_id)
+        if entry is not None:
+            entry[1].update(fields)
+
+    def invalidate(self, telegram_id: int) -> None:
+        """Удаляет строку из кэша (следующее чтение пойдёт в БД)"""
+        self._rows.pop(telegram_id, None)
+
+    def clear(self) -> None:
+        """Очищает кэш (после массовых изменений)"""
+        self._rows.clear()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+
+user_cache = UserRowCache(USER_CACHE_TTL, USER_CACHE_SIZE)
+
+
 async def check_email_exists(email: str) -> bool:
     """
     Проверяет, существует ли email в базе данных
@@ -51,7 +165,7 @@ async def check_email_exists(email: str) -> bool:
     try:
         # Приводим к нижнему регистру для точного совпадения с БД
         email = email.lower().strip()
-        response = supabase.table(TABLE_NAME).select("email").eq("email", email).execute()
+        response = await supabase.table(TABLE_NAME).select("email").eq("email", email).execute()
         return len(response.data) > 0
     except Exception as e:
         print(f"Ошибка при проверке email: {e}")
@@ -68,11 +182,16 @@ async def get_user_by_telegram_id(telegram_id: int) -> Optional[Dict[str, Any]]:
     Returns:
         Словарь с данными пользователя или None
     """
+    cached = user_cache.get(telegram_id)
+    if cached is not None:
+        return cached
+    
     try:
-        response = supabase.table(TABLE_NAME).select("*").eq("telegram_id", telegram_id).execute()
+        response = await supabase.table(TABLE_NAME).select("*").eq("telegram_id", telegram_id).execute()
         if response.data and len(response.data) > 0:
             user_data = response.data[0]
             print(f"[DEBUG] get_user_by_telegram_id({telegram_id}): found, current_task = {user_data.get('current_task')}")
+            user_cache.set(telegram_id, user_data)
             return user_data
         print(f"[DEBUG] get_user_by_telegram_id({telegram_id}): NOT found")
         return None
@@ -104,12 +223,13 @@ async def update_user_data(
     try:
         # Приводим к нижнему регистру для точного совпадения с БД
         email = email.lower().strip()
-        response = supabase.table(TABLE_NAME).update({
+        response = await supabase.table(TABLE_NAME).update({
             "telegram_id": telegram_id,
             "first_name": first_name,
             "username": username,
             "state": state
         }).eq("email", email).execute()
+        user_cache.invalidate(telegram_id)
         return True
     except Exception as e:
         print(f"Ошибка при обновлении данных пользователя: {e}")
@@ -128,10 +248,12 @@ async def update_user_channel(telegram_id: int, channel_link: str) -> bool:
         True если обновление прошло успешно
     """
     try:
-        response = supabase.table(TABLE_NAME).update({
+        data = {
             "channel_link": channel_link,
             "state": UserState.REGISTERED
-        }).eq("telegram_id", telegram_id).execute()
+        }
+        response = await supabase.table(TABLE_NAME).update(data).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, data)
         return True
     except Exception as e:
         print(f"Ошибка при обновлении канала: {e}")
@@ -166,15 +288,160 @@ async def update_user_state(telegram_id: int, state: str) -> bool:
         True если обновление прошло успешно
     """
     try:
-        response = supabase.table(TABLE_NAME).update({
+        response = await supabase.table(TABLE_NAME).update({
             "state": state
         }).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, {"state": state})
         return True
     except Exception as e:
         print(f"Ошибка при обновлении состояния: {e}")
         return False
 
 
+async def update_user_fields(telegram_id: int, fields: Dict[str, Any]) -> bool:
+    """
+    Обновляет произвольные колонки пользователя (с обновлением кэша)
+    
+    Args:
+        telegram_id: Telegram ID пользователя
+        fields: Колонки и новые значения
+        
+    Returns:
+        True если обновление прошло успешно
+    """
+    try:
+        await supabase.table(TABLE_NAME).update(fields).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, fields)
+        return True
+    except Exception as e:
+        print(f"Ошибка при обновлении пользователя {telegram_id}: {e}")
+        return False
+
+
+# ============================================================
+# ПОСТРАНИЧНАЯ ВЫБОРКА ПОЛЬЗОВАТЕЛЕЙ
+# ============================================================
+
+# Размер страницы при выборке пользователей (не больше max-rows PostgREST, по умолчанию 1000)
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "1000"))
+
+
+def _with_columns(columns: str, *required: str) -> str:
+    """Добавляет в список колонок обязательные (если выбираются не все колонки)"""
+    if columns.strip() == "*":
+        return columns
+    selected = [c.strip() for c in columns.split(",") if c.strip()]
+    for column in required:
+        if column not in selected:
+            selected.append(column)
+    return ",".join(selected)
+
+
+class UsersFetchError(Exception):
+    """Страница пользователей не загрузилась: перебор iter_users оборван"""
+
+
+async def _fetch_page(
+    table: str,
+    columns: str,
+    filters: Optional[Callable],
+    after_key: Optional[int],
+    page_size: int,
+    key: str = "telegram_id",
+    rpc_params: Optional[Dict[str, Any]] = None
+) -> list:
+    """
+    Загружает одну страницу таблицы с key > after_key (keyset-пагинация по key)
+
+    Строки с key = NULL пропускаются: по ним нельзя продолжить перебор
+    (Postgres сортирует NULL в конец, и следующий запрос получил бы gt.None).
+
+    Если заданы rpc_params, table - имя RPC, возвращающей строки таблицы
+    (например, users_shard): фильтры, сортировка и limit применяются к её результату.
+    """
+    source = supabase.rpc(table, rpc_params) if rpc_params is not None else supabase.table(table)
+    query = source.select(columns).not_.is_(key, "null")
+    if filters:
+        query = filters(query)
+    if after_key is not None:
+        query = query.gt(key, after_key)
+    response = await query.order(key).limit(page_size).execute()
+    return response.data if response.data else []
+
+
+async def iter_users(
+    columns: str = "*",
+    filters: Optional[Callable] = None,
+    page_size: Optional[int] = None,
+    shard: Optional[Tuple[int, int]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Постранично перебирает пользователей (keyset-пагинация по telegram_id)
+    
+    В отличие от select без range не упирается в лимит строк PostgREST и держит
+    в памяти не больше двух страниц. Следующая страница загружается, пока
+    обрабатывается текущая. Keyset (а не offset) не пропускает строки, если
+    рассылка меняет отфильтрованные колонки во время перебора.
+    
+    Args:
+        columns: Колонки через запятую (telegram_id добавляется автоматически)
+        filters: Функция, добавляющая условия к запросу: lambda q: q.eq(...)
+        page_size: Размер страницы (по умолчанию USERS_PAGE_SIZE)
+        shard: (количество шардов, номер шарда) - только пользователи с
+               telegram_id % шардов = номер. Отбор выполняется в БД (RPC users_shard,
+               migrations/broadcast_shards.sql), каждая копия бота читает только свою часть
+    
+    Yields:
+        Строки таблицы users в порядке telegram_id (без строк с telegram_id = NULL -
+        пользователей, ещё не написавших боту)
+    
+    Raises:
+        UsersFetchError: страница не загрузилась. Перебор не завершается молча,
+            чтобы рассылка не считалась законченной на части пользователей
+    """
+    page_size = page_size or USERS_PAGE_SIZE
+    columns = _with_columns(columns, "telegram_id")
+    source, rpc_params = TABLE_NAME, None
+    if shard is not None:
+        source, rpc_params = "users_shard", {"p_shards": shard[0], "p_shard": shard[1]}
+    
+    def fetch(after_id: Optional[int]):
+        return _fetch_page(source, columns, filters, after_id, page_size, rpc_params=rpc_params)
+    
+    try:
+        page = await fetch(None)
+    except Exception as e:
+        logger.error(f"Ошибка при получении пользователей: {e}")
+        raise UsersFetchError(f"первая страница не загружена: {e}") from e
+    
+    while page:
+        # Неполная страница - последняя
+        next_page = None
+        if len(page) == page_size:
+            next_page = asyncio.create_task(
+                fetch(page[-1]["telegram_id"])
+            )
+        
+        try:
+            for user in page:
+                yield user
+        except BaseException:
+            # Перебор прерван - следующая страница больше не нужна
+            if next_page:
+                next_page.cancel()
+            raise
+        
+        if not next_page:
+            return
+        
+        last_id = page[-1]["telegram_id"]
+        try:
+            page = await next_page
+        except Exception as e:
+            logger.error(f"Ошибка при получении страницы пользователей после telegram_id={last_id}: {e}")
+            raise UsersFetchError(f"страница после telegram_id={last_id} не загружена: {e}") from e
+
+
 # ============================================================
 # ФУНКЦИИ ДЛЯ РАБОТЫ С КУРСОМ
 # ============================================================
@@ -182,7 +449,7 @@ async def update_user_state(telegram_id: int, state: str) -> bool:
 async def get_all_registered_users() -> list:
     """Получает всех зарегистрированных пользователей"""
     try:
-        response = supabase.table(TABLE_NAME).select("*").eq("state", UserState.REGISTERED).execute()
+        response = await supabase.table(TABLE_NAME).select("*").eq("state", UserState.REGISTERED).execute()
         return response.data if response.data else []
     except Exception as e:
         print(f"Ошибка при получении зарегистрированных пользователей: {e}")
@@ -194,41 +461,68 @@ async def start_course_for_users() -> bool:
     try:
         # Обновляем состояние всех зарегистрированных пользователей
         # current_task НЕ устанавливаем сразу - будет установлен при отправке первого задания
-        response = supabase.table(TABLE_NAME).update({
+        response = await supabase.table(TABLE_NAME).update({
             "course_state": CourseState.IN_PROGRESS,
             "current_task": 0,
             "penalties": 0
         }).eq("state", UserState.REGISTERED).execute()
+        user_cache.clear()
         return True
     except Exception as e:
         print(f"Ошибка при запуске курса: {e}")
         return False
 
 
-async def get_global_course_state() -> Optional[Dict[str, Any]]:
-    """Получает глобальное состояние курса"""
+# Снимок глобального состояния курса (строка course_state id=1)
+# Источник истины для процесса: обновляется при каждой записи через
+# update_global_course_state, поэтому горячие обработчики читают его без запросов к БД.
+# Если ботов несколько, снимок периодически перечитывается (COURSE_STATE_POLL_SECONDS).
+_course_state_snapshot: Optional[Dict[str, Any]] = None
+
+# Интервал перечитывания состояния курса из БД (секунды, 0 - не перечитывать).
+# При нескольких копиях по умолчанию раз в минуту: день курса меняет только одна из них
+COURSE_STATE_POLL_SECONDS = int(os.getenv("COURSE_STATE_POLL_SECONDS", "60" if _MULTI_REPLICA else "0"))
+
+
+async def refresh_global_course_state() -> Optional[Dict[str, Any]]:
+    """Перечитывает состояние курса из БД и обновляет снимок"""
+    global _course_state_snapshot
     try:
-        response = supabase.table(COURSE_STATE_TABLE).select("*").eq("id", 1).execute()
+        response = await supabase.table(COURSE_STATE_TABLE).select("*").eq("id", 1).execute()
         if response.data and len(response.data) > 0:
-            return response.data[0]
+            _course_state_snapshot = response.data[0]
+            return dict(_course_state_snapshot)
         return None
     except Exception as e:
         print(f"Ошибка при получении состояния курса: {e}")
         return None
 
 
+async def get_global_course_state(refresh: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Получает глобальное состояние курса (из снимка в памяти)
+    
+    Args:
+        refresh: Перечитать из БД (для операций чтение-изменение-запись, например перехода дня)
+    """
+    if _course_state_snapshot is None or refresh:
+        return await refresh_global_course_state()
+    return dict(_course_state_snapshot)
+
+
 async def ensure_course_state_exists() -> bool:
     """
     Проверяет наличие записи состояния курса и создаёт её, если нет.
     Вызывается при старте бота для гарантии целостности БД.
     """
+    global _course_state_snapshot
     try:
-        response = supabase.table(COURSE_STATE_TABLE).select("*").eq("id", 1).execute()
+        response = await supabase.table(COURSE_STATE_TABLE).select("*").eq("id", 1).execute()
         
         if not response.data or len(response.data) == 0:
             # Записи нет - создаём с дефолтными значениями
             print("⚠️ Запись course_state не найдена, создаём...")
-            supabase.table(COURSE_STATE_TABLE).insert({
+            await supabase.table(COURSE_STATE_TABLE).insert({
                 "id": 1,
                 "is_active": False,
                 "current_day": 0
@@ -238,6 +532,7 @@ async def ensure_course_state_exists() -> bool:
         
         # Запись уже существует
         state = response.data[0]
+        _course_state_snapshot = state
         print(f"✅ Состояние курса загружено из БД: is_active={state.get('is_active')}, current_day={state.get('current_day')}")
         return True
         
@@ -247,7 +542,8 @@ async def ensure_course_state_exists() -> bool:
 
 
 async def update_global_course_state(is_active: bool, current_day: int, start_date: str = None) -> bool:
-    """Обновляет глобальное состояние курса"""
+    """Обновляет глобальное состояние курса (и снимок в памяти)"""
+    global _course_state_snapshot
     try:
         data = {
             "is_active": is_active,
@@ -256,16 +552,127 @@ async def update_global_course_state(is_active: bool, current_day: int, start_da
         if start_date:
             data["start_date"] = start_date
         
-        response = supabase.table(COURSE_STATE_TABLE).update(data).eq("id", 1).execute()
+        response = await supabase.table(COURSE_STATE_TABLE).update(data).eq("id", 1).execute()
+        
+        # Обновляем снимок тем, что записали (или строкой, которую вернула БД)
+        if response.data:
+            _course_state_snapshot = response.data[0]
+        elif _course_state_snapshot is not None:
+            _course_state_snapshot = {**_course_state_snapshot, **data}
         return True
     except Exception as e:
         print(f"Ошибка при обновлении состояния курса: {e}")
         return False
 
 
+# ============================================================
+# КЭШ КОНТЕНТА (задания digest_day_N и финальные сообщения)
+# ============================================================
+# Тексты заданий и финальных сообщений меняются редко, а читаются на каждое
+# нажатие "Написать пост", напоминание и рассылку. Кэш прогревается при старте
+# бота, обновляется командой /reload_content и автоматически раз в CONTENT_CACHE_TTL.
+
+# Время жизни кэша контента (секунды, 0 - без автоматического обновления)
+CONTENT_CACHE_TTL = float(os.getenv("CONTENT_CACHE_TTL", "600"))
+
+
+class ContentCache:
+    """Загруженные задания и финальные сообщения (version растёт при каждом обновлении)"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.course_days = 14
+        self.tasks: Dict[int, Dict[str, Any]] = {}
+        self.final_messages: Dict[tuple, Dict[str, Any]] = {}
+        self.version = 0
+        self.loaded_at = 0.0
+        self.lock = asyncio.Lock()
+
+    @property
+    def is_fresh(self) -> bool:
+        if self.version == 0:
+            return False
+        return self.ttl <= 0 or time.monotonic() - self.loaded_at < self.ttl
+
+
+content_cache = ContentCache(CONTENT_CACHE_TTL)
+
+
+async def _load_task(task_number: int) -> Optional[Dict[str, Any]]:
+    """Загружает задание из таблицы digest_day_X (ошибки пробрасываются)"""
+    table_name = f"{DIGEST_TABLE_PREFIX}{task_number}"
+    response = await supabase.table(table_name).select("*").execute()
+    if response.data and len(response.data) > 0:
+        # Возвращаем первую запись из таблицы
+        return response.data[0]
+    return None
+
+
+async def _reload_content() -> bool:
+    """Перезагружает кэш контента (вызывается под content_cache.lock)"""
+    days = range(1, content_cache.course_days + 1)
+    results = await asyncio.gather(*(_load_task(day) for day in days), return_exceptions=True)
+    
+    tasks = dict(content_cache.tasks)
+    ok = True
+    for day, result in zip(days, results):
+        if isinstance(result, Exception):
+            print(f"Ошибка при загрузке задания из {DIGEST_TABLE_PREFIX}{day}: {result}")
+            ok = False
+        elif result:
+            tasks[day] = result
+        else:
+            tasks.pop(day, None)
+    
+    final_messages = content_cache.final_messages
+    try:
+        response = await supabase.table(FINAL_MESSAGES_TABLE).select("*").execute()
+        final_messages = {
+            (row.get("course_day"), row.get("message_number")): row
+            for row in (response.data or [])
+        }
+    except Exception as e:
+        print(f"Ошибка при загрузке финальных сообщений: {e}")
+        ok = False
+    
+    content_cache.tasks = tasks
+    content_cache.final_messages = final_messages
+    content_cache.version += 1
+    content_cache.loaded_at = time.monotonic()
+    
+    print(f"✅ Кэш контента v{content_cache.version}: заданий {len(tasks)}, финальных сообщений {len(final_messages)}")
+    return ok
+
+
+async def refresh_content_cache(course_days: Optional[int] = None) -> bool:
+    """
+    Загружает все задания и финальные сообщения в кэш (старт бота, /reload_content)
+    
+    Args:
+        course_days: Количество дней курса (по умолчанию - из прошлой загрузки)
+        
+    Returns:
+        True если всё загружено; при ошибках в кэше остаются прежние значения
+    """
+    async with content_cache.lock:
+        if course_days:
+            content_cache.course_days = course_days
+        return await _reload_content()
+
+
+async def _ensure_content_fresh() -> None:
+    """Обновляет кэш контента, если истёк CONTENT_CACHE_TTL (одна загрузка на всех ожидающих)"""
+    if content_cache.is_fresh:
+        return
+    async with content_cache.lock:
+        # Пока ждали блокировку, кэш мог обновить другой обработчик
+        if not content_cache.is_fresh:
+            await _reload_content()
+
+
 async def get_task_by_number(task_number: int) -> Optional[Dict[str, Any]]:
     """
-    Получает задание по номеру из таблицы digest_day_X
+    Получает задание по номеру из таблицы digest_day_X (через кэш контента)
     
     Args:
         task_number: Номер дня (1-14)
@@ -273,34 +680,57 @@ async def get_task_by_number(task_number: int) -> Optional[Dict[str, Any]]:
     Returns:
         Словарь с полями: zadanie, vopros_1, vopros_2, vopros_3, prompt
     """
+    await _ensure_content_fresh()
+    task = content_cache.tasks.get(task_number)
+    if task is not None:
+        return dict(task)
+    
+    # Нет в кэше (например, таблицу создали после загрузки) - читаем из БД
     try:
-        table_name = f"{DIGEST_TABLE_PREFIX}{task_number}"
-        response = supabase.table(table_name).select("*").execute()
-        
-        if response.data and len(response.data) > 0:
-            # Возвращаем первую запись из таблицы
-            return response.data[0]
+        task = await _load_task(task_number)
+        if task:
+            content_cache.tasks[task_number] = task
+            return dict(task)
         return None
     except Exception as e:
-        print(f"Ошибка при получении задания из {table_name}: {e}")
+        print(f"Ошибка при получении задания из {DIGEST_TABLE_PREFIX}{task_number}: {e}")
         return None
 
 
-async def get_users_in_course() -> list:
+async def get_cached_final_message(course_day: int, message_number: int) -> Optional[Dict[str, Any]]:
+    """Финальное сообщение из кэша контента (None - нет в кэше)"""
+    await _ensure_content_fresh()
+    message = content_cache.final_messages.get((course_day, message_number))
+    return dict(message) if message is not None else None
+
+
+def _in_course_filter(query):
+    """Участники курса: любое состояние кроме not_started, excluded, completed"""
+    return (
+        query.neq("course_state", CourseState.NOT_STARTED)
+        .neq("course_state", CourseState.EXCLUDED)
+        .neq("course_state", CourseState.COMPLETED)
+    )
+
+
+def iter_users_in_course(columns: str = "*") -> AsyncIterator[Dict[str, Any]]:
+    """Постранично перебирает пользователей, участвующих в курсе (in_progress, waiting_task_X, limited)"""
+    return iter_users(columns, filters=_in_course_filter)
+
+
+async def get_users_in_course(columns: str = "*") -> list:
     """Получает всех пользователей, участвующих в курсе (любое состояние кроме not_started, excluded, completed)"""
     try:
-        # Получаем всех, кто в курсе (in_progress или waiting_task_X)
-        response = supabase.table(TABLE_NAME).select("*").neq("course_state", CourseState.NOT_STARTED).neq("course_state", CourseState.EXCLUDED).neq("course_state", CourseState.COMPLETED).execute()
-        return response.data if response.data else []
-    except Exception as e:
-        print(f"Ошибка при получении пользователей курса: {e}")
+        return [user async for user in iter_users_in_course(columns)]
+    except UsersFetchError:
+        # Неполный список хуже пустого: вызывающий код решил бы, что это все пользователи
         return []
 
 
 async def get_users_by_current_task(task_number: int) -> list:
     """Получает пользователей на определенном задании"""
     try:
-        response = supabase.table(TABLE_NAME).select("*").eq("current_task", task_number).eq("course_state", CourseState.IN_PROGRESS).execute()
+        response = await supabase.table(TABLE_NAME).select("*").eq("current_task", task_number).eq("course_state", CourseState.IN_PROGRESS).execute()
         return response.data if response.data else []
     except Exception as e:
         print(f"Ошибка при получении пользователей по заданию: {e}")
@@ -313,11 +743,13 @@ async def mark_task_completed(telegram_id: int, task_number: int) -> bool:
         from datetime import datetime
         
         # Обновляем текущее задание и время выполнения
-        response = supabase.table(TABLE_NAME).update({
+        data = {
             "current_task": task_number + 1,
             "last_task_completed_at": datetime.now().isoformat(),
             "course_state": CourseState.WAITING_TASK.format(task_number + 1) if task_number < 14 else CourseState.COMPLETED
-        }).eq("telegram_id", telegram_id).execute()
+        }
+        response = await supabase.table(TABLE_NAME).update(data).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, data)
         return True
     except Exception as e:
         print(f"Ошибка при отметке задания: {e}")
@@ -345,7 +777,8 @@ async def add_penalty(telegram_id: int) -> int:
         # НЕ меняем course_state - пользователь продолжает курс даже с 3+ штрафами
         update_data = {"penalties": new_penalties}
         
-        response = supabase.table(TABLE_NAME).update(update_data).eq("telegram_id", telegram_id).execute()
+        response = await supabase.table(TABLE_NAME).update(update_data).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, update_data)
         
         return new_penalties
     except Exception as e:
@@ -353,6 +786,29 @@ async def add_penalty(telegram_id: int) -> int:
         return 0
 
 
+async def apply_daily_penalties(current_day: int) -> Optional[list]:
+    """
+    Проверка 9:50 одной операцией в БД (RPC apply_daily_penalties, migrations/apply_daily_penalties.sql):
+    штрафует не сдавших задание current_day и переводит их (и не получавших задание) на следующее
+
+    Args:
+        current_day: Текущий день курса
+
+    Returns:
+        Список {telegram_id, penalties, penalized} изменённых пользователей
+        или None, если RPC недоступна
+    """
+    try:
+        response = await supabase.rpc("apply_daily_penalties", {"p_current_day": current_day}).execute()
+        changed = response.data if response.data else []
+        for row in changed:
+            user_cache.update(row["telegram_id"], {"penalties": row["penalties"], "current_task": current_day + 1})
+        return changed
+    except Exception as e:
+        print(f"Ошибка при вызове apply_daily_penalties: {e}")
+        return None
+
+
 async def get_user_penalties(telegram_id: int) -> int:
     """Получает количество штрафов пользователя"""
     user = await get_user_by_telegram_id(telegram_id)
@@ -383,9 +839,10 @@ async def get_user_course_state(telegram_id: int) -> str:
 async def complete_course_for_user(telegram_id: int) -> bool:
     """Завершает курс для пользователя"""
     try:
-        response = supabase.table(TABLE_NAME).update({
+        response = await supabase.table(TABLE_NAME).update({
             "course_state": CourseState.COMPLETED
         }).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, {"course_state": CourseState.COMPLETED})
         return True
     except Exception as e:
         print(f"Ошибка при завершении курса: {e}")
@@ -407,9 +864,10 @@ async def save_post_link(telegram_id: int, task_number: int, post_link: str) ->
     try:
         column_name = f"post_{task_number}"
         
-        response = supabase.table(TABLE_NAME).update({
+        response = await supabase.table(TABLE_NAME).update({
             column_name: post_link
         }).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, {column_name: post_link})
         
         return True
     except Exception as e:
@@ -450,15 +908,35 @@ async def mark_user_as_blocked(telegram_id: int) -> bool:
         True если успешно
     """
     try:
-        response = supabase.table(TABLE_NAME).update({
+        response = await supabase.table(TABLE_NAME).update({
             "is_blocked": True
         }).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, {"is_blocked": True})
         return True
     except Exception as e:
         print(f"Ошибка при отметке пользователя как заблокированного: {e}")
         return False
 
 
+async def mark_users_as_blocked(telegram_ids) -> int:
+    """
+    Отмечает пачку пользователей как заблокировавших бота (после рассылки)
+    
+    Запись идёт через UserUpdateBatch: один RPC на BULK_UPDATE_CHUNK_SIZE
+    пользователей вместо UPDATE на каждого.
+    
+    Args:
+        telegram_ids: Telegram ID пользователей
+        
+    Returns:
+        Количество отмеченных пользователей
+    """
+    async with UserUpdateBatch() as batch:
+        for telegram_id in telegram_ids:
+            await batch.add(telegram_id, is_blocked=True)
+    return batch.flushed_count
+
+
 async def is_user_blocked(telegram_id: int) -> bool:
     """
     Проверяет, заблокирован ли пользователь
@@ -479,9 +957,23 @@ async def is_user_blocked(telegram_id: int) -> bool:
         return False
 
 
-async def get_all_active_users_in_course() -> list:
+def _active_in_course_filter(query):
     """
-    Получает ВСЕХ активных пользователей в курсе (для рассылки в 10:00)
+    Активные участники курса - фильтр выполняется в БД
+    (частичный индекс idx_users_active_course, migrations/add_active_users_index.sql)
+    """
+    return (
+        query.not_.in_("course_state", [CourseState.NOT_STARTED, CourseState.EXCLUDED, CourseState.COMPLETED])
+        .is_("blocked_at", "null")
+    )
+
+
+def iter_active_users_in_course(
+    columns: str = "*",
+    shard: Optional[Tuple[int, int]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Постранично перебирает ВСЕХ активных пользователей в курсе (для рассылки в 10:00)
     
     Включает пользователей с course_state:
     - in_progress (не сдал текущее задание)
@@ -491,42 +983,21 @@ async def get_all_active_users_in_course() -> list:
     - not_started
     - excluded (исключён за штрафы)
     - completed (завершил курс)
+    - заблокировавших бота (blocked_at не NULL)
+    
+    shard - (количество шардов, номер шарда): только пользователи шарда этой копии бота
     """
+    return iter_users(columns, filters=_active_in_course_filter, shard=shard)
+
+
+async def get_all_active_users_in_course(columns: str = "*") -> list:
+    """Получает ВСЕХ активных пользователей в курсе списком (см. iter_active_users_in_course)"""
     try:
-        # Получаем ВСЕХ пользователей
-        print(f"[DEBUG] Запрос всех пользователей для фильтрации")
-        response = supabase.table(TABLE_NAME).select("*").execute()
-        
-        if not response.data:
-            print(f"[DEBUG] Нет пользователей в БД")
-            return []
-        
-        print(f"[DEBUG] Всего пользователей в БД: {len(response.data)}")
-        
-        users = []
-        for user in response.data:
-            course_state = user.get('course_state', CourseState.NOT_STARTED)
-            
-            # Пропускаем неактивных
-            if course_state in [CourseState.NOT_STARTED, CourseState.EXCLUDED, CourseState.COMPLETED]:
-                print(f"[DEBUG] Пропущен {user.get('telegram_id')}: course_state={course_state}")
-                continue
-            
-            # Пропускаем заблокированных
-            if user.get('blocked_at') is not None:
-                print(f"[DEBUG] Пропущен заблокированный {user.get('telegram_id')}")
-                continue
-            
-            # Активный пользователь (in_progress или waiting_task_X)
-            users.append(user)
-            print(f"[DEBUG] ✅ Добавлен {user.get('telegram_id')}: course_state={course_state}, current_task={user.get('current_task')}")
-        
-        print(f"[DEBUG] Активных пользователей: {len(users)}")
-        return users
-        
-    except Exception as e:
-        print(f"Ошибка при получении активных пользователей: {e}")
+        users = [user async for user in iter_active_users_in_course(columns)]
+    except UsersFetchError:
         return []
+    print(f"[DEBUG] Активных пользователей: {len(users)}")
+    return users
 
 
 # ============================================================
@@ -544,15 +1015,106 @@ async def get_user_last_task_message_id(telegram_id: int) -> int:
 async def save_user_last_task_message_id(telegram_id: int, message_id: int) -> bool:
     """Сохраняет ID сообщения с заданием"""
     try:
-        supabase.table(TABLE_NAME).update({
+        await supabase.table(TABLE_NAME).update({
             "last_task_message_id": message_id
         }).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, {"last_task_message_id": message_id})
         return True
     except Exception as e:
         print(f"Ошибка при сохранении last_task_message_id: {e}")
         return False
 
 
+# ============================================================
+# ПАКЕТНЫЕ ОБНОВЛЕНИЯ (для рассылок)
+# ============================================================
+
+# Сколько пользователей обновлять одним запросом
+BULK_UPDATE_CHUNK_SIZE = int(os.getenv("BULK_UPDATE_CHUNK_SIZE", "500"))
+
+# Колонки, которые умеет обновлять RPC bulk_update_users (migrations/bulk_update_users.sql)
+BULK_UPDATE_COLUMNS = {
+    "current_task",
+    "course_state",
+    "penalties",
+    "last_task_message_id",
+    "is_blocked",
+    "final_message_15_sent",
+    "final_message_1_sent",
+    "final_message_2_sent",
+    "final_message_3_sent",
+}
+
+
+class UserUpdateBatch:
+    """
+    Накопитель обновлений пользователей для пакетной записи в БД
+
+    Изменения одного пользователя объединяются, а запись выполняется пачками
+    через RPC bulk_update_users: O(пользователей / chunk) запросов вместо O(пользователей).
+
+    Использование:
+        async with UserUpdateBatch() as batch:
+            await batch.add(telegram_id, current_task=5, course_state="in_progress")
+    """
+
+    def __init__(self, chunk_size: int = BULK_UPDATE_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.pending: Dict[int, Dict[str, Any]] = {}
+        self.flushed_count = 0
+
+    async def add(self, telegram_id: int, **fields) -> None:
+        """Добавляет изменения пользователя (при заполнении пачки - записывает её)"""
+        unknown = set(fields) - BULK_UPDATE_COLUMNS
+        if unknown:
+            raise ValueError(f"Колонки не поддерживаются пакетным обновлением: {unknown}")
+
+        self.pending.setdefault(telegram_id, {}).update(fields)
+        if len(self.pending) >= self.chunk_size:
+            await self.flush()
+
+    async def flush(self) -> int:
+        """
+        Записывает накопленные изменения в БД
+
+        Returns:
+            Количество пользователей, для которых отправлены изменения
+        """
+        if not self.pending:
+            return 0
+
+        # Забираем накопленное сразу, чтобы параллельные add() писали уже в новую пачку
+        pending, self.pending = self.pending, {}
+        rows = [{"telegram_id": telegram_id, **fields} for telegram_id, fields in pending.items()]
+
+        for i in range(0, len(rows), self.chunk_size):
+            chunk = rows[i:i + self.chunk_size]
+            try:
+                await supabase.rpc("bulk_update_users", {"p_updates": chunk}).execute()
+                for row in chunk:
+                    user_cache.update(row["telegram_id"], {k: v for k, v in row.items() if k != "telegram_id"})
+            except Exception as e:
+                # RPC недоступна (миграция не применена) - обновляем по одному
+                print(f"Ошибка пакетного обновления ({len(chunk)} польз.), обновляем по одному: {e}")
+                for row in chunk:
+                    row = dict(row)
+                    telegram_id = row.pop("telegram_id")
+                    try:
+                        await supabase.table(TABLE_NAME).update(row).eq("telegram_id", telegram_id).execute()
+                        user_cache.update(telegram_id, row)
+                    except Exception as row_error:
+                        print(f"Ошибка при обновлении пользователя {telegram_id}: {row_error}")
+
+        self.flushed_count += len(rows)
+        return len(rows)
+
+    async def __aenter__(self) -> "UserUpdateBatch":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.flush()
+
+
 async def set_user_writing_post(telegram_id: int, is_writing: bool) -> bool:
     """
     Устанавливает флаг is_writing_post для пользователя
@@ -565,9 +1127,10 @@ async def set_user_writing_post(telegram_id: int, is_writing: bool) -> bool:
         True если успешно, False если ошибка
     """
     try:
-        supabase.table(TABLE_NAME).update({
+        await supabase.table(TABLE_NAME).update({
             "is_writing_post": is_writing
         }).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, {"is_writing_post": is_writing})
         return True
     except Exception as e:
         print(f"Ошибка при установке is_writing_post для {telegram_id}: {e}")
@@ -585,38 +1148,62 @@ async def is_user_writing_post(telegram_id: int) -> bool:
         True если пользователь в процессе написания поста, False иначе
     """
     try:
-        response = supabase.table(TABLE_NAME).select("is_writing_post").eq("telegram_id", telegram_id).execute()
-        if response.data and len(response.data) > 0:
-            return response.data[0].get("is_writing_post", False) or False
+        user = await get_user_by_telegram_id(telegram_id)
+        if user:
+            return user.get("is_writing_post", False) or False
         return False
     except Exception as e:
         print(f"Ошибка при проверке is_writing_post для {telegram_id}: {e}")
         return False
 
 
+def _parse_message_ids(messages_str: Optional[str]) -> list:
+    """Разбирает список ID сообщений через запятую"""
+    if not messages_str:
+        return []
+    try:
+        return [int(x) for x in messages_str.split(",") if x]
+    except ValueError:
+        return []
+
+
 async def get_user_messages_to_delete(telegram_id: int) -> list:
     """Получает список ID сообщений для удаления"""
     user = await get_user_by_telegram_id(telegram_id)
     if user:
-        messages_str = user.get("messages_to_delete", "") or ""
-        if messages_str:
-            try:
-                return [int(x) for x in messages_str.split(",") if x]
-            except:
-                return []
+        return _parse_message_ids(user.get("messages_to_delete", ""))
     return []
 
 
 async def add_message_to_delete(telegram_id: int, message_id: int) -> bool:
-    """Добавляет ID сообщения в список для удаления"""
+    """
+    Добавляет ID сообщения в список для удаления
+    
+    Один вызов RPC append_message_to_delete (migrations/messages_to_delete_rpc.sql):
+    без чтения строки и без потери ID при параллельных добавлениях
+    """
+    try:
+        response = await supabase.rpc(
+            "append_message_to_delete",
+            {"p_telegram_id": telegram_id, "p_message_id": message_id}
+        ).execute()
+        if isinstance(response.data, str):
+            user_cache.update(telegram_id, {"messages_to_delete": response.data})
+        else:
+            user_cache.invalidate(telegram_id)
+        return True
+    except Exception as e:
+        print(f"RPC append_message_to_delete недоступна, добавляем через UPDATE: {e}")
+    
     try:
         current_messages = await get_user_messages_to_delete(telegram_id)
         current_messages.append(message_id)
         messages_str = ",".join(str(x) for x in current_messages)
         
-        supabase.table(TABLE_NAME).update({
+        await supabase.table(TABLE_NAME).update({
             "messages_to_delete": messages_str
         }).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, {"messages_to_delete": messages_str})
         return True
     except Exception as e:
         print(f"Ошибка при добавлении сообщения для удаления: {e}")
@@ -626,15 +1213,37 @@ async def add_message_to_delete(telegram_id: int, message_id: int) -> bool:
 async def clear_messages_to_delete(telegram_id: int) -> bool:
     """Очищает список сообщений для удаления"""
     try:
-        supabase.table(TABLE_NAME).update({
+        await supabase.table(TABLE_NAME).update({
             "messages_to_delete": ""
         }).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, {"messages_to_delete": ""})
         return True
     except Exception as e:
         print(f"Ошибка при очистке списка сообщений: {e}")
         return False
 
 
+async def take_messages_to_delete(telegram_id: int) -> list:
+    """
+    Забирает список ID сообщений для удаления и очищает его одной операцией
+    (RPC take_messages_to_delete, при её отсутствии - чтение + очистка)
+    
+    Returns:
+        Список ID сообщений
+    """
+    try:
+        response = await supabase.rpc("take_messages_to_delete", {"p_telegram_id": telegram_id}).execute()
+        user_cache.update(telegram_id, {"messages_to_delete": ""})
+        return _parse_message_ids(response.data if isinstance(response.data, str) else "")
+    except Exception as e:
+        print(f"RPC take_messages_to_delete недоступна, читаем и очищаем список отдельно: {e}")
+    
+    message_ids = await get_user_messages_to_delete(telegram_id)
+    if message_ids:
+        await clear_messages_to_delete(telegram_id)
+    return message_ids
+
+
 # ============================================================
 # ФУНКЦИИ ДЛЯ РАБОТЫ С ГРУППАМИ (group1-group5)
 # ============================================================
@@ -656,11 +1265,11 @@ async def get_group_data(group_number: int) -> tuple[list, str]:
     
     try:
         # Получаем список пользователей из таблицы groupN
-        users_response = supabase.table(table_name).select("telegram_id").execute()
+        users_response = await supabase.table(table_name).select("telegram_id").execute()
         telegram_ids = [row.get("telegram_id") for row in users_response.data if row.get("telegram_id")] if users_response.data else []
         
         # Получаем текст из отдельной таблицы group_texts
-        text_response = supabase.table("group_texts").select("text").eq("group_number", group_number).execute()
+        text_response = await supabase.table("group_texts").select("text").eq("group_number", group_number).execute()
         text = text_response.data[0].get("text", "") if text_response.data else ""
         
         return telegram_ids, text
@@ -686,7 +1295,7 @@ async def get_group_users_count(group_number: int) -> int:
     table_name = f"group{group_number}"
     
     try:
-        response = supabase.table(table_name).select("telegram_id").execute()
+        response = await supabase.table(table_name).select("telegram_id").execute()
         return len(response.data) if response.data else 0
     except Exception as e:
         print(f"Ошибка при подсчете пользователей группы {group_number}: {e}")
@@ -706,7 +1315,7 @@ async def get_users_who_finished_task_14() -> list:
     """
     try:
         # current_task >= 15 означает что пользователь ЗАВЕРШИЛ 14 задание
-        response = supabase.table(TABLE_NAME).select("*").gte("current_task", 15).execute()
+        response = await supabase.table(TABLE_NAME).select("*").gte("current_task", 15).execute()
         return response.data if response.data else []
     except Exception as e:
         print(f"Ошибка при получении пользователей, завершивших 14 задание: {e}")
@@ -748,7 +1357,7 @@ async def fix_users_after_task_2() -> tuple[int, list]:
         print(f"[DEBUG] fix_users_after_task_2: начало выполнения")
         
         # Получаем всех пользователей с current_task > 2
-        response = supabase.table(TABLE_NAME).select("*").gt("current_task", 2).execute()
+        response = await supabase.table(TABLE_NAME).select("*").gt("current_task", 2).execute()
         users = response.data
         
         print(f"[DEBUG] fix_users_after_task_2: найдено пользователей с current_task > 2: {len(users) if users else 0}")
@@ -789,7 +1398,8 @@ async def fix_users_after_task_2() -> tuple[int, list]:
             }
             
             print(f"[DEBUG] Обновляю пользователя {telegram_id}: current_task {current_task_before} -> 2")
-            supabase.table(TABLE_NAME).update(update_data).eq("telegram_id", telegram_id).execute()
+            await supabase.table(TABLE_NAME).update(update_data).eq("telegram_id", telegram_id).execute()
+            user_cache.update(telegram_id, update_data)
             fixed_ids.append(telegram_id)
         
         print(f"[DEBUG] fix_users_after_task_2: успешно исправлено {len(fixed_ids)} пользователей")
@@ -800,3 +1410,242 @@ async def fix_users_after_task_2() -> tuple[int, list]:
         import traceback
         traceback.print_exc()
         return 0, []
+
+
+# ============================================================
+# АРЕНДА ЗАДАЧ ПЛАНИРОВЩИКА (несколько копий бота)
+# ============================================================
+# Каждая копия бота запускает свой планировщик, но рассылку 10:00, напоминания,
+# проверку 9:50 и финальные сообщения должна выполнить ровно одна копия.
+# Перед запуском копия берёт аренду на конкретный запуск задачи
+# (например "send_task:2026-10-16 10:00") через RPC try_acquire_job_lease
+# (migrations/job_leases.sql). Аренда не снимается после выполнения, поэтому
+# копия, у которой задача сработала на пару секунд позже, запуск пропустит.
+
+async def try_acquire_job_lease(run_key: str, owner: str, ttl_seconds: int) -> Optional[bool]:
+    """
+    Берёт аренду на запуск задачи планировщика
+
+    Args:
+        run_key: Ключ запуска (id задачи + запланированное время)
+        owner: Идентификатор копии бота
+        ttl_seconds: Через сколько секунд чужая аренда считается брошенной
+
+    Returns:
+        True - аренда получена (задачу выполняет эта копия),
+        False - задачу уже выполняет другая копия,
+        None - RPC недоступна (миграция не применена или ошибка БД)
+    """
+    try:
+        response = await supabase.rpc(
+            "try_acquire_job_lease",
+            {"p_run_key": run_key, "p_owner": owner, "p_ttl_seconds": ttl_seconds}
+        ).execute()
+        return bool(response.data)
+    except Exception as e:
+        print(f"Ошибка при получении аренды задачи {run_key}: {e}")
+        return None
+
+
+# ============================================================
+# ШАРДИРОВАННЫЕ РАССЫЛКИ (итоги шардов)
+# ============================================================
+# При BROADCAST_SHARDS > 1 каждая копия бота рассылает задание своей части
+# пользователей (выборка через RPC users_shard, см. iter_users) и записывает
+# итог шарда через RPC report_broadcast_shard
+# (migrations/broadcast_shards.sql). Копия, записавшая последний итог,
+# получает суммарные цифры и отправляет один общий отчёт в мониторинг.
+
+async def report_broadcast_shard(
+    broadcast_key: str,
+    shard: int,
+    shards: int,
+    success: int,
+    failed: int,
+    elapsed: float
+) -> Optional[Dict[str, Any]]:
+    """
+    Записывает итог рассылки одного шарда
+
+    Args:
+        broadcast_key: Ключ рассылки (одинаковый у всех шардов, например "task_5:2026-10-16")
+        shard: Номер шарда этой копии
+        shards: Всего шардов
+        success, failed: Итог шарда
+        elapsed: Длительность рассылки шарда (секунды)
+
+    Returns:
+        Суммарный итог {shards, success, failed, elapsed}, если это был последний шард;
+        {} - если ещё не все шарды закончили; None - RPC недоступна
+    """
+    try:
+        response = await supabase.rpc("report_broadcast_shard", {
+            "p_broadcast_key": broadcast_key,
+            "p_shard": shard,
+            "p_shards": shards,
+            "p_success": success,
+            "p_failed": failed,
+            "p_elapsed": elapsed,
+        }).execute()
+        rows = response.data or []
+        return rows[0] if rows else {}
+    except Exception as e:
+        print(f"Ошибка при записи итога шарда {shard} рассылки {broadcast_key}: {e}")
+        return None
+
+
+# ============================================================
+# ЖУРНАЛ РАССЫЛОК (возобновление после сбоя)
+# ============================================================
+# Для рассылки задания и финальных сообщений статус доставки каждому
+# получателю пишется пачками в таблицу broadcast_journal
+# (migrations/broadcast_journal.sql), ключ - (broadcast_id, telegram_id).
+# Повторный запуск той же рассылки (тот же broadcast_id) пропускает тех,
+# кому уже отправлено, а с only_failed - повторяет только ошибки.
+#
+# Доставка "хотя бы один раз": если бот упал до записи очередной пачки журнала,
+# её получатели (до BROADCAST_JOURNAL_CHUNK_SIZE человек) получат сообщение повторно.
+# Перед каждой записью журнала сохраняются изменения пользователей (UserUpdateBatch),
+# поэтому журнал никогда не опережает БД: "sent" не записывается раньше
+# current_task, last_task_message_id или final_message_*_sent.
+
+# Статусы, после которых получателю повторно не отправляем
+JOURNAL_DONE_STATUSES = ("sent", "blocked")
+
+# Сколько записей журнала сохранять одним запросом (и сколько сообщений
+# может уйти повторно после сбоя)
+BROADCAST_JOURNAL_CHUNK_SIZE = int(os.getenv("BROADCAST_JOURNAL_CHUNK_SIZE", "100"))
+
+
+class BroadcastJournal:
+    """
+    Журнал одной рассылки: кому уже отправлено и с каким результатом
+
+    Использование:
+        async with UserUpdateBatch() as batch, BroadcastJournal("task_5:2026-10-16", batch) as journal:
+            result = await broadcast(name, users, send, journal=journal)
+
+    state_batch - изменения пользователей, которые пишет рассылка: они сохраняются
+    перед каждой записью журнала.
+    """
+
+    def __init__(
+        self,
+        broadcast_id: str,
+        state_batch: Optional["UserUpdateBatch"] = None,
+        chunk_size: int = BROADCAST_JOURNAL_CHUNK_SIZE
+    ):
+        self.broadcast_id = broadcast_id
+        self.state_batch = state_batch
+        self.chunk_size = chunk_size
+        self.done: set = set()
+        self.pending: Dict[int, Dict[str, Any]] = {}
+        self.enabled = True
+
+    async def load(self) -> int:
+        """
+        Загружает получателей, которым рассылка уже доставлена (при повторном запуске)
+
+        Returns:
+            Сколько получателей будет пропущено
+        """
+        after_id = None
+        try:
+            while True:
+                page = await _fetch_page(
+                    BROADCAST_JOURNAL_TABLE,
+                    "telegram_id",
+                    lambda query: query.eq("broadcast_id", self.broadcast_id).in_("status", list(JOURNAL_DONE_STATUSES)),
+                    after_id,
+                    USERS_PAGE_SIZE
+                )
+                self.done.update(row["telegram_id"] for row in page)
+                if len(page) < USERS_PAGE_SIZE:
+                    break
+                after_id = page[-1]["telegram_id"]
+        except Exception as e:
+            # Таблицы нет (миграция не применена) - рассылка работает без журнала
+            print(f"Журнал рассылок недоступен, {self.broadcast_id} без возобновления: {e}")
+            self.enabled = False
+        return len(self.done)
+
+    def is_done(self, telegram_id: int) -> bool:
+        """Доставлено ли уже этому получателю"""
+        return telegram_id in self.done
+
+    async def record(self, telegram_id: int, status: str, error: Optional[str] = None) -> None:
+        """Записывает результат отправки (при заполнении пачки - сохраняет её в БД)"""
+        if not self.enabled:
+            return
+        self.pending[telegram_id] = {
+            "broadcast_id": self.broadcast_id,
+            "telegram_id": telegram_id,
+            "status": status,
+            "error": error[:500] if error else None,
+        }
+        if status in JOURNAL_DONE_STATUSES:
+            self.done.add(telegram_id)
+        if len(self.pending) >= self.chunk_size:
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Сохраняет накопленные записи журнала одним upsert (после изменений пользователей)"""
+        if not self.pending:
+            return 0
+        # Забираем записи до сохранения пачки пользователей: их изменения уже в ней
+        pending, self.pending = self.pending, {}
+        rows = list(pending.values())
+        if self.state_batch is not None:
+            await self.state_batch.flush()
+        try:
+            await supabase.table(BROADCAST_JOURNAL_TABLE).upsert(
+                rows, on_conflict="broadcast_id,telegram_id"
+            ).execute()
+        except Exception as e:
+            print(f"Ошибка записи журнала рассылки {self.broadcast_id} ({len(rows)} записей): {e}")
+        return len(rows)
+
+    async def __aenter__(self) -> "BroadcastJournal":
+        await self.load()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.flush()
+
+
+async def get_broadcast_failures(broadcast_id: str) -> set:
+    """
+    Получатели рассылки, которым отправка не удалась (status = failed)
+
+    Returns:
+        Множество telegram_id (пустое при ошибке)
+    """
+    failed = set()
+    after_id = None
+    try:
+        while True:
+            page = await _fetch_page(
+                BROADCAST_JOURNAL_TABLE,
+                "telegram_id",
+                lambda query: query.eq("broadcast_id", broadcast_id).eq("status", "failed"),
+                after_id,
+                USERS_PAGE_SIZE
+            )
+            failed.update(row["telegram_id"] for row in page)
+            if len(page) < USERS_PAGE_SIZE:
+                break
+            after_id = page[-1]["telegram_id"]
+    except Exception as e:
+        print(f"Ошибка при получении ошибок рассылки {broadcast_id}: {e}")
+    return failed
+
+
+# ============================================================
+# МЕТРИКИ
+# ============================================================
+
+# Длительность каждой публичной async-функции модуля (bot_db_call_seconds на /metrics).
+# Должно оставаться в самом конце модуля: обёртываются функции, определённые выше.
+from metrics import instrument_async_functions, db_call_seconds  # noqa: E402
+
+instrument_async_functions(globals(), __name__, db_call_seconds)
@@ -8,12 +8,22 @@
 import logging
 from datetime import datetime
 from aiogram import Bot
-from database import supabase, TABLE_NAME
+from database import (
+    supabase,
+    TABLE_NAME,
+    FINAL_MESSAGES_TABLE,
+    UserUpdateBatch,
+    BroadcastJournal,
+    get_broadcast_failures,
+    iter_users,
+    user_cache,
+    get_user_by_telegram_id,
+    get_cached_final_message
+)
+from broadcast import broadcast, filter_recipients, make_broadcast_id
 
 logger = logging.getLogger(__name__)
 
-FINAL_MESSAGES_TABLE = "final_messages"
-
 
 def _sent_column(course_day: int, message_number: int) -> str:
     """Имя колонки в users для отметки отправки."""
@@ -24,14 +34,18 @@ def _sent_column(course_day: int, message_number: int) -> str:
 
 async def get_final_message(course_day: int, message_number: int) -> dict:
     """
-    Получает финальное сообщение из БД по дню и номеру.
+    Получает финальное сообщение по дню и номеру (из кэша контента, иначе из БД).
     
     Args:
         course_day: 15 или 16
         message_number: номер сообщения (для дня 15 всегда 1, для дня 16 — 1, 2, 3)
     """
+    cached = await get_cached_final_message(course_day, message_number)
+    if cached:
+        return cached
+    
     try:
-        response = (
+        response = await (
             supabase.table(FINAL_MESSAGES_TABLE)
             .select("*")
             .eq("course_day", course_day)
@@ -47,65 +61,29 @@ async def get_final_message(course_day: int, message_number: int) -> dict:
         return None
 
 
-async def get_users_for_final_message(course_day: int, message_number: int) -> list:
+def iter_users_for_final_message(course_day: int, message_number: int):
     """
-    Получает пользователей, которым нужно отправить финальное сообщение.
+    Постранично перебирает пользователей, которым нужно отправить финальное сообщение.
     Условия: current_task >= 15 и ещё не отправлено это сообщение.
     """
-    try:
-        col = _sent_column(course_day, message_number)
-        response = (
-            supabase.table(TABLE_NAME)
-            .select("*")
-            .gte("current_task", 15)
-            .eq(col, False)
-            .execute()
-        )
-        if response.data:
-            logger.info(f"Найдено {len(response.data)} пользователей для финального сообщения day={course_day} num={message_number}")
-            return response.data
-        logger.info(f"Нет пользователей для финального сообщения day={course_day} num={message_number}")
-        return []
-    except Exception as e:
-        logger.error(f"Ошибка при получении пользователей для финального сообщения ({course_day}, {message_number}): {e}")
-        return []
+    col = _sent_column(course_day, message_number)
+    return iter_users(
+        columns="telegram_id",
+        filters=lambda query: query.gte("current_task", 15).eq(col, False)
+    )
 
 
-async def mark_final_message_sent(telegram_id: int, course_day: int, message_number: int) -> bool:
-    """Отмечает финальное сообщение как отправленное."""
-    try:
-        col = _sent_column(course_day, message_number)
-        supabase.table(TABLE_NAME).update({col: True}).eq("telegram_id", telegram_id).execute()
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при отметке финального сообщения ({course_day}, {message_number}) для {telegram_id}: {e}")
-        return False
-
-
-async def send_final_message_to_user(
-    bot: Bot, user: dict, message_data: dict, course_day: int, message_number: int
-) -> bool:
-    """Отправляет финальное сообщение пользователю (только текст)."""
-    telegram_id = user.get("telegram_id")
-    try:
-        message_text = message_data.get("message_text", "")
-        await bot.send_message(chat_id=telegram_id, text=message_text)
-        await mark_final_message_sent(telegram_id, course_day, message_number)
-        logger.info(f"✅ Финальное сообщение day={course_day} num={message_number} отправлено пользователю {telegram_id}")
-        return True
-    except Exception as e:
-        logger.error(f"❌ Ошибка при отправке финального сообщения day={course_day} num={message_number} пользователю {telegram_id}: {e}")
-        return False
-
-
-async def send_final_message_to_all(bot: Bot, course_day: int, message_number: int):
+async def send_final_message_to_all(bot: Bot, course_day: int, message_number: int, only_failed: bool = False):
     """
     Отправляет финальное сообщение всем подходящим пользователям.
+    Повторный запуск в тот же день пропускает тех, кому сообщение уже доставлено
+    (журнал рассылок), даже если отметка final_message_*_sent не успела записаться.
     
     Args:
         bot: экземпляр бота
         course_day: 15 или 16
         message_number: 1 для дня 15; 1, 2, 3 для дня 16
+        only_failed: отправить только тем, кому сегодняшняя рассылка не удалась
     """
     logger.info(f"🚀 Начинаем отправку финального сообщения day={course_day} num={message_number}")
     
@@ -114,21 +92,43 @@ async def send_final_message_to_all(bot: Bot, course_day: int, message_number: i
         logger.error(f"Не удалось получить данные финального сообщения day={course_day} num={message_number}")
         return
     
-    users = await get_users_for_final_message(course_day, message_number)
-    if not users:
-        logger.info(f"Нет пользователей для отправки финального сообщения day={course_day} num={message_number}")
-        return
+    # Получатели загружаются постранично во время рассылки
+    users = iter_users_for_final_message(course_day, message_number)
+    
+    broadcast_id = make_broadcast_id(f"final_{course_day}_{message_number}")
+    if only_failed:
+        failed_ids = await get_broadcast_failures(broadcast_id)
+        if not failed_ids:
+            logger.info(f"Нет ошибок рассылки {broadcast_id} для повтора")
+            return
+        users = filter_recipients(users, failed_ids)
+    
+    col = _sent_column(course_day, message_number)
     
-    sent_count = 0
-    failed_count = 0
-    for user in users:
-        success = await send_final_message_to_user(bot, user, message_data, course_day, message_number)
-        if success:
-            sent_count += 1
+    async def send_to_user(user: dict):
+        await bot.send_message(chat_id=user.get("telegram_id"), text=message_data.get("message_text", ""))
+        # Отметки об отправке пишутся пачками
+        await batch.add(user.get("telegram_id"), **{col: True})
+    
+    async with UserUpdateBatch() as batch, BroadcastJournal(broadcast_id, batch) as journal:
+        result = await broadcast(f"final_{course_day}_{message_number}", users, send_to_user, journal=journal)
+        
+        # Отмечаем пользователей, заблокировавших бота
+        for telegram_id in result.blocked_ids:
+            await batch.add(telegram_id, is_blocked=True)
+    
+    if result.incomplete:
+        from monitoring import monitor
+        await monitor.report_broadcast_incomplete(bot, result)
+    
+    if not result.total:
+        if result.resumed:
+            logger.info(f"Финальное сообщение day={course_day} num={message_number} уже доставлено всем ({result.resumed} чел.)")
         else:
-            failed_count += 1
+            logger.info(f"Нет пользователей для отправки финального сообщения day={course_day} num={message_number}")
+        return
     
-    logger.info(f"✅ Финальное сообщение day={course_day} num={message_number}: отправлено {sent_count}, ошибок {failed_count}")
+    logger.info(f"✅ Финальное сообщение day={course_day} num={message_number}: отправлено {result.success}, ошибок {result.failed}")
 
 
 async def is_course_day_15(current_day: int) -> bool:
@@ -142,14 +142,9 @@ async def should_ignore_user_input(telegram_id: int) -> bool:
     но ещё не получил все финальные сообщения 16 дня (третье сообщение в 15:55).
     """
     try:
-        response = (
-            supabase.table(TABLE_NAME)
-            .select("current_task, final_message_3_sent")
-            .eq("telegram_id", telegram_id)
-            .execute()
-        )
-        if response.data and len(response.data) > 0:
-            user = response.data[0]
+        # Строка пользователя берётся из кэша database.py (её же читают остальные проверки апдейта)
+        user = await get_user_by_telegram_id(telegram_id)
+        if user:
             current_task = user.get("current_task", 0)
             final_message_3_sent = user.get("final_message_3_sent", False)
             if current_task >= 15 and not final_message_3_sent:
@@ -163,9 +158,9 @@ async def should_ignore_user_input(telegram_id: int) -> bool:
 async def mark_course_finished(telegram_id: int) -> bool:
     """Отмечает время завершения курса (после 14 задания)."""
     try:
-        supabase.table(TABLE_NAME).update({
-            "course_finished_at": datetime.now().isoformat()
-        }).eq("telegram_id", telegram_id).execute()
+        data = {"course_finished_at": datetime.now().isoformat()}
+        await supabase.table(TABLE_NAME).update(data).eq("telegram_id", telegram_id).execute()
+        user_cache.update(telegram_id, data)
         return True
     except Exception as e:
         logger.error(f"Ошибка при отметке завершения курса для {telegram_id}: {e}")
@@ -5,8 +5,29 @@
 """
 
 import os
+import json
+import asyncio
+import logging
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Dict
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+logger = logging.getLogger(__name__)
+
+# Файл кэша Telegram file_id (в папке media/, которая монтируется как volume)
+FILE_ID_CACHE_PATH = os.getenv("FILE_ID_CACHE_PATH", "media/.file_id_cache.json")
+
+# Ошибки Telegram, означающие, что сам file_id недействителен (остальные ошибки
+# относятся к получателю или подписи и не должны сбрасывать кэш)
+FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference expired",
+    "file_reference_expired",
+)
 
 
 def find_image(base_path: str, extensions: list = None) -> Optional[str]:
@@ -173,3 +194,133 @@ def get_post_accepted_image_path(media_dir: str = "media") -> Optional[str]:
     """
     base_path = f"{media_dir}/post_accepted"
     return find_image(base_path)
+
+
+
+# ============================================================
+# КЭШ TELEGRAM FILE_ID
+# ============================================================
+# После первой загрузки картинки Telegram возвращает file_id,
+# по которому её можно отправлять повторно без загрузки файла.
+# Ключ кэша: путь + mtime + размер (при замене файла кэш сбрасывается).
+
+_file_id_cache: Optional[Dict[str, str]] = None
+_upload_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _load_file_id_cache() -> Dict[str, str]:
+    """Загружает кэш file_id с диска (один раз за процесс)"""
+    global _file_id_cache
+    if _file_id_cache is None:
+        try:
+            with open(FILE_ID_CACHE_PATH, "r", encoding="utf-8") as f:
+                _file_id_cache = json.load(f)
+        except (OSError, ValueError):
+            _file_id_cache = {}
+    return _file_id_cache
+
+
+def _save_file_id_cache():
+    """Сохраняет кэш file_id на диск"""
+    try:
+        os.makedirs(os.path.dirname(FILE_ID_CACHE_PATH) or ".", exist_ok=True)
+        tmp_path = f"{FILE_ID_CACHE_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(_file_id_cache, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, FILE_ID_CACHE_PATH)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить кэш file_id: {e}")
+
+
+def _file_cache_key(file_path: str) -> Optional[str]:
+    """Ключ кэша: абсолютный путь + время изменения + размер файла"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return f"{os.path.abspath(file_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def get_cached_file_id(file_path: str) -> Optional[str]:
+    """
+    Получает закэшированный Telegram file_id для локального файла
+    
+    Args:
+        file_path: Путь к файлу
+        
+    Returns:
+        file_id или None, если файл ещё не загружался (или был изменён)
+    """
+    key = _file_cache_key(file_path)
+    if not key:
+        return None
+    return _load_file_id_cache().get(key)
+
+
+def save_file_id(file_path: str, file_id: str):
+    """Сохраняет Telegram file_id для локального файла"""
+    key = _file_cache_key(file_path)
+    if not key:
+        return
+    cache = _load_file_id_cache()
+    # Удаляем устаревшие ключи этого же файла (старые mtime/размер)
+    prefix = f"{os.path.abspath(file_path)}:"
+    for old_key in [k for k in cache if k.startswith(prefix) and k != key]:
+        del cache[old_key]
+    cache[key] = file_id
+    _save_file_id_cache()
+
+
+def is_file_id_error(error: TelegramBadRequest) -> bool:
+    """Ошибка Telegram относится к file_id (а не к чату, подписи и т.п.)"""
+    text = str(error).lower()
+    return any(marker in text for marker in FILE_ID_ERRORS)
+
+
+def forget_file_id(file_path: str):
+    """Удаляет file_id из кэша (например, если Telegram его не принял)"""
+    key = _file_cache_key(file_path)
+    cache = _load_file_id_cache()
+    if key and key in cache:
+        del cache[key]
+        _save_file_id_cache()
+
+
+async def send_photo_cached(bot: Bot, chat_id: int, photo_path: str, **kwargs) -> Message:
+    """
+    Отправляет картинку по закэшированному file_id (загружает файл только первый раз)
+    
+    Args:
+        bot: Экземпляр бота
+        chat_id: ID чата
+        photo_path: Путь к картинке
+        **kwargs: Параметры send_photo (caption, reply_markup и т.д.)
+        
+    Returns:
+        Отправленное сообщение
+    """
+    file_id = get_cached_file_id(photo_path)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except TelegramBadRequest as e:
+            # Ошибки получателя ("chat not found", длинная подпись) пробрасываем:
+            # кэш сбрасываем только если Telegram не принял сам file_id
+            if not is_file_id_error(e):
+                raise
+            # file_id недействителен (например, сменился токен бота) - загружаем заново
+            logger.warning(f"file_id для {photo_path} не принят Telegram, загружаем файл заново: {e}")
+            forget_file_id(photo_path)
+    
+    # Загружаем файл один раз: остальные отправки ждут и используют полученный file_id
+    lock = _upload_locks.setdefault(photo_path, asyncio.Lock())
+    async with lock:
+        file_id = get_cached_file_id(photo_path)
+        if file_id:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        
+        sent_message = await bot.send_photo(chat_id=chat_id, photo=FSInputFile(photo_path), **kwargs)
+        if sent_message.photo:
+            save_file_id(photo_path, sent_message.photo[-1].file_id)
+            logger.info(f"💾 file_id для {photo_path} сохранён в кэш")
+        return sent_message
@@ -447,6 +447,12 @@ MSG_GENERATION_ERROR = """
 Попробуйте еще раз? Нажмите кнопку "✍️ Напиши пост"
 """
 
+MSG_GENERATION_QUEUED = """
+🕐 <b>Вы в очереди на генерацию: {position}-й</b>
+
+Сейчас много желающих написать пост. Как только подойдёт ваша очередь, я начну генерацию — ничего нажимать не нужно.
+"""
+
 MSG_GENERATION_TIMEOUT = """
 ⏰ <b>Превышено время ожидания</b>
 
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+Метрики бота в формате Prometheus (эндпоинт /metrics веб-сервера)
+
+Без внешних зависимостей: счётчики, гистограммы и показатели, которые
+вычисляются при каждом запросе /metrics.
+
+Что собирается:
+- bot_handler_seconds - длительность обработчиков aiogram (по имени обработчика)
+- bot_db_call_seconds - длительность функций database.py (по имени функции)
+- bot_telegram_request_seconds / bot_telegram_errors_total - запросы к Bot API
+- bot_broadcast_messages_total и показатели последней рассылки
+- bot_n8n_request_seconds, bot_n8n_generation_seconds, bot_whisper_seconds
+- показатели: ожидающие генерации, очередь генераций, состояния диалогов, кэши
+
+При METRICS_ENABLED=false обработчики, запросы к Bot API и функции database.py
+не оборачиваются замерами.
+"""
+
+import functools
+import inspect
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм (секунды)
+FAST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Монотонный счётчик с метками
+
+    function - счётчик ведёт сам модуль бота (например, попадания в кэш),
+    значение читается при запросе /metrics
+    """
+
+    kind = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], float]] = None
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                yield f"{self.name} {_format_value(self.function())}"
+            except Exception as e:
+                logger.warning(f"Не удалось вычислить метрику {self.name}: {e}")
+            return
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge:
+    """
+    Показатель: значение задаётся вручную или вычисляется функцией при запросе /metrics
+
+    Функция может быть async (например, запрос к SQLite в отдельном потоке): тогда
+    значение вычисляется в collect() перед формированием ответа.
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        function: Optional[Callable[[], float]] = None
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self._collected: Optional[float] = None
+
+    async def collect(self):
+        """Вычисляет async-функцию показателя"""
+        if self.function is None or not inspect.iscoroutinefunction(self.function):
+            return
+        try:
+            self._collected = await self.function()
+        except Exception as e:
+            self._collected = None
+            logger.warning(f"Не удалось вычислить метрику {self.name}: {e}")
+
+    def set(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        self.values[key] = value
+
+    def samples(self):
+        if self.function is not None:
+            if inspect.iscoroutinefunction(self.function):
+                if self._collected is not None:
+                    yield f"{self.name} {_format_value(self._collected)}"
+                return
+            try:
+                yield f"{self.name} {_format_value(self.function())}"
+            except Exception as e:
+                logger.warning(f"Не удалось вычислить метрику {self.name}: {e}")
+            return
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    """Гистограмма с метками (корзины накопительные, как в Prometheus)"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = FAST_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # {метки: [счётчики корзин, сумма, количество]}
+        self.values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{labels} {bucket_count}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Registry:
+    """Набор метрик процесса"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Any] = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    async def collect(self):
+        """Вычисляет показатели с async-функциями (перед render)"""
+        for metric in self.metrics.values():
+            if isinstance(metric, Gauge):
+                await metric.collect()
+
+    def render(self) -> str:
+        """Текст в формате Prometheus exposition 0.0.4"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_seconds = registry.register(Histogram(
+    "bot_handler_seconds", "Длительность обработчиков aiogram", ("handler", "status")
+))
+db_call_seconds = registry.register(Histogram(
+    "bot_db_call_seconds", "Длительность функций database.py", ("function", "status")
+))
+telegram_request_seconds = registry.register(Histogram(
+    "bot_telegram_request_seconds", "Длительность запросов к Telegram Bot API", ("method",)
+))
+telegram_errors = registry.register(Counter(
+    "bot_telegram_errors_total", "Ошибки запросов к Telegram Bot API по коду", ("method", "code")
+))
+broadcast_messages = registry.register(Counter(
+    "bot_broadcast_messages_total", "Сообщения рассылок по результату", ("broadcast", "status")
+))
+broadcast_last_rate = registry.register(Gauge(
+    "bot_broadcast_last_rate", "Скорость последней рассылки (успешных сообщений в секунду)", ("broadcast",)
+))
+broadcast_last_duration = registry.register(Gauge(
+    "bot_broadcast_last_duration_seconds", "Длительность последней рассылки (до последней доставки)", ("broadcast",)
+))
+n8n_request_seconds = registry.register(Histogram(
+    "bot_n8n_request_seconds", "Длительность HTTP-запроса к n8n", ("status",)
+))
+n8n_generation_seconds = registry.register(Histogram(
+    "bot_n8n_generation_seconds", "Время генерации поста (запрос в n8n + ожидание ответа)", ("status",), SLOW_BUCKETS
+))
+whisper_seconds = registry.register(Histogram(
+    "bot_whisper_seconds", "Длительность транскрибации в Whisper", ("status",), SLOW_BUCKETS
+))
+
+
+def observe_broadcast(result) -> None:
+    """Учитывает итог рассылки (broadcast.BroadcastResult)"""
+    name = result.name
+    broadcast_messages.inc(result.success, broadcast=name, status="sent")
+    broadcast_messages.inc(result.failed - len(result.blocked_ids), broadcast=name, status="failed")
+    broadcast_messages.inc(len(result.blocked_ids), broadcast=name, status="blocked")
+    broadcast_messages.inc(result.skipped, broadcast=name, status="skipped")
+    broadcast_last_rate.set(result.rate, broadcast=name)
+    broadcast_last_duration.set(result.elapsed, broadcast=name)
+
+
+def register_gauges() -> None:
+    """Показатели и счётчики, которые читаются из модулей бота при каждом запросе /metrics"""
+    from ai_helper import pending_requests, generation_queue, get_http_pool_stats
+    from user_states import count_dialog_states
+    from database import user_cache, content_cache
+
+    for name, documentation, function in [
+        ("bot_pending_generations", "Генерации, ожидающие ответа от n8n", lambda: len(pending_requests)),
+        ("bot_generation_queue_depth", "Генерации в очереди (ждут свободного места)", lambda: generation_queue.depth),
+        ("bot_generation_in_flight", "Генерации, отправленные в n8n", lambda: generation_queue.in_flight),
+        ("bot_n8n_pool_in_use", "Занятые соединения с n8n", lambda: get_http_pool_stats()["in_use"]),
+        ("bot_dialog_states", "Сохранённые состояния диалогов", count_dialog_states),
+        ("bot_user_cache_size", "Строк пользователей в кэше", lambda: len(user_cache)),
+        ("bot_content_cache_version", "Версия кэша заданий и финальных сообщений", lambda: content_cache.version),
+    ]:
+        registry.register(Gauge(name, documentation, function=function))
+
+    for name, documentation, function in [
+        ("bot_user_cache_hits_total", "Попадания в кэш строк пользователей", lambda: user_cache.hits),
+        ("bot_user_cache_misses_total", "Промахи кэша строк пользователей", lambda: user_cache.misses),
+    ]:
+        registry.register(Counter(name, documentation, function=function))
+
+
+async def render() -> str:
+    """Все метрики в формате Prometheus"""
+    await registry.collect()
+    return registry.render()
+
+
+# ============================================================
+# ИНСТРУМЕНТИРОВАНИЕ
+# ============================================================
+
+def instrument_async_functions(namespace: Dict[str, Any], module_name: str, histogram: Histogram) -> int:
+    """
+    Оборачивает все публичные async-функции модуля замером длительности
+
+    Вызывается в конце модуля: instrument_async_functions(globals(), __name__, db_call_seconds).
+    Модули, импортирующие функции после этого, получают обёрнутые версии.
+    При METRICS_ENABLED=false функции не оборачиваются.
+
+    Returns:
+        Количество обёрнутых функций
+    """
+    if not config.METRICS_ENABLED:
+        return 0
+    count = 0
+    for name, function in list(namespace.items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(function):
+            continue
+        if getattr(function, "__module__", None) != module_name:
+            continue
+        namespace[name] = _timed(function, histogram)
+        count += 1
+    return count
+
+
+def _timed(function: Callable[..., Awaitable[Any]], histogram: Histogram):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        started_at = time.perf_counter()
+        status = "ok"
+        try:
+            return await function(*args, **kwargs)
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started_at, function=function.__name__, status=status)
+    return wrapper
+
+
+def telegram_error_code(error: BaseException) -> str:
+    """Код ошибки Bot API для метки метрики"""
+    if isinstance(error, TelegramRetryAfter):
+        return "429"
+    if isinstance(error, TelegramForbiddenError):
+        return "403"
+    if isinstance(error, TelegramNotFound):
+        return "404"
+    if isinstance(error, TelegramBadRequest):
+        return "400"
+    if isinstance(error, TelegramServerError):
+        return "5xx"
+    if isinstance(error, TelegramNetworkError):
+        return "network"
+    if isinstance(error, TelegramAPIError):
+        return "api"
+    return "other"
+
+
+class TelegramRequestMetrics(BaseRequestMiddleware):
+    """Middleware сессии бота: длительность и ошибки каждого запроса к Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        api_method = getattr(method, "__api_method__", type(method).__name__)
+        started_at = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            telegram_errors.inc(method=api_method, code=telegram_error_code(e))
+            raise
+        finally:
+            telegram_request_seconds.observe(time.perf_counter() - started_at, method=api_method)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Middleware диспетчера: длительность каждого обработчика (по имени функции)"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        callback = getattr(handler_object, "callback", None)
+        name = getattr(callback, "__name__", type(event).__name__)
+        started_at = time.perf_counter()
+        status = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started_at, handler=name, status=status)
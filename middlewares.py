@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Middleware aiogram: контекст пользователя на один апдейт
+
+Строка пользователя из БД и глобальное состояние курса загружаются один раз
+(параллельно) до вызова обработчика и передаются в него аргументом ctx.
+Проверки "курс завершён", "заблокирован", "пишет пост", состояние в курсе
+и регистрации становятся проверками полей в памяти, без запросов к БД.
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, TelegramObject
+
+from database import UserState, CourseState, get_user_by_telegram_id, get_global_course_state
+from user_states import UserDialogState, get_user_state as get_dialog_state
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class UserContext:
+    """Данные пользователя для обработки одного апдейта"""
+    telegram_id: int
+    user: Optional[Dict[str, Any]]  # Строка из users (None - пользователя нет в БД)
+    course: Optional[Dict[str, Any]]  # Глобальное состояние курса (course_state)
+    dialog: UserDialogState  # Состояние диалога (вопросы, ожидание ссылки на пост)
+
+    def _field(self, name: str, default: Any = None) -> Any:
+        if not self.user:
+            return default
+        value = self.user.get(name)
+        return default if value is None else value
+
+    @property
+    def state(self) -> str:
+        """Состояние регистрации (как database.get_user_state)"""
+        return self._field("state", UserState.NEW)
+
+    @property
+    def course_state(self) -> str:
+        """Состояние пользователя в курсе (как database.get_user_course_state)"""
+        return self._field("course_state", CourseState.NOT_STARTED)
+
+    @property
+    def current_task(self) -> int:
+        return self._field("current_task", 0)
+
+    @property
+    def is_blocked(self) -> bool:
+        return bool(self._field("is_blocked", False))
+
+    @property
+    def is_writing_post(self) -> bool:
+        return bool(self._field("is_writing_post", False))
+
+    @property
+    def should_ignore_input(self) -> bool:
+        """
+        Завершил 14 задание, но ещё не получил все финальные сообщения 16 дня
+        (как final_messages_handlers.should_ignore_user_input)
+        """
+        return self.current_task >= 15 and not self._field("final_message_3_sent", False)
+
+    @property
+    def course_is_active(self) -> bool:
+        return bool(self.course and self.course.get("is_active"))
+
+    @property
+    def current_day(self) -> int:
+        return (self.course or {}).get("current_day", 0) or 0
+
+
+async def load_user_context(telegram_id: int) -> UserContext:
+    """Загружает контекст пользователя (строка users, состояние курса и диалога - параллельно)"""
+    user, course, dialog = await asyncio.gather(
+        get_user_by_telegram_id(telegram_id),
+        get_global_course_state(),
+        get_dialog_state(telegram_id)
+    )
+    return UserContext(
+        telegram_id=telegram_id,
+        user=user,
+        course=course,
+        dialog=dialog
+    )
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """
+    Outer middleware: кладёт UserContext в data["ctx"] для сообщений из личных
+    чатов и нажатий кнопок. Для групповых чатов ctx = None (обработчики их игнорируют).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        from_user = data.get("event_from_user")
+        is_group_message = isinstance(event, Message) and event.chat.type != "private"
+
+        if from_user is None or is_group_message:
+            data["ctx"] = None
+        else:
+            try:
+                data["ctx"] = await load_user_context(from_user.id)
+            except Exception as e:
+                logger.error(f"Не удалось загрузить контекст пользователя {from_user.id}: {e}")
+                try:
+                    dialog = await get_dialog_state(from_user.id)
+                except Exception:
+                    dialog = UserDialogState()
+                data["ctx"] = UserContext(
+                    telegram_id=from_user.id,
+                    user=None,
+                    course=None,
+                    dialog=dialog
+                )
+
+        return await handler(event, data)
@@ -0,0 +1,43 @@
+-- ============================================================
+-- Частичный индекс для выборки активных участников курса
+-- ============================================================
+-- Используется database.iter_active_users_in_course (рассылка 10:00,
+-- проверка 9:50, /stop): фильтр по course_state и blocked_at выполняется
+-- в БД, а не в боте, поэтому объём выборки зависит только от числа
+-- активных участников, а не от размера всей таблицы users.
+--
+-- Запрос бота:
+--   SELECT ... FROM users
+--   WHERE telegram_id IS NOT NULL
+--     AND course_state NOT IN ('not_started', 'excluded', 'completed')
+--     AND blocked_at IS NULL
+--     AND telegram_id > :last_id          -- keyset-пагинация
+--   ORDER BY telegram_id LIMIT :page_size;
+--
+-- Индекс строится по telegram_id, а оба условия отбора стоят в WHERE индекса:
+-- страница читается подряд в порядке пагинации, без сортировки и без
+-- просмотра неактивных строк. Индекс с ведущим course_state для NOT IN
+-- не подходит: Postgres не может читать его в порядке telegram_id.
+--
+-- Условие WHERE должно совпадать с фильтром _active_in_course_filter в database.py,
+-- иначе планировщик не сможет использовать индекс.
+
+DROP INDEX IF EXISTS idx_users_active_course_state;
+
+CREATE INDEX IF NOT EXISTS idx_users_active_course
+    ON users (telegram_id)
+    WHERE blocked_at IS NULL
+      AND course_state NOT IN ('not_started', 'excluded', 'completed');
+
+COMMENT ON INDEX idx_users_active_course IS 'Активные участники курса (не заблокировавшие бота) для рассылок';
+
+-- Проверка (должен использоваться idx_users_active_course, без Sort):
+-- EXPLAIN SELECT telegram_id, course_state FROM users
+-- WHERE telegram_id IS NOT NULL
+--   AND course_state NOT IN ('not_started', 'excluded', 'completed') AND blocked_at IS NULL
+--   AND telegram_id > 500000
+-- ORDER BY telegram_id LIMIT 1000;
+--
+--  Limit  (cost=0.28..35.48 rows=1000 width=26)
+--    ->  Index Scan using idx_users_active_course on users  (cost=0.28..329.47 rows=9353 width=26)
+--          Index Cond: ((telegram_id IS NOT NULL) AND (telegram_id > 500000))
@@ -0,0 +1,40 @@
+-- ============================================================
+-- Проверка 9:50 одним запросом: штрафы + перевод на следующее задание
+-- ============================================================
+-- Раньше бот загружал всех активных пользователей и для каждого делал
+-- SELECT + UPDATE штрафа и ещё один UPDATE current_task.
+-- Теперь всё выполняется одной атомарной операцией в БД, а бот только
+-- рассылает сообщения о штрафах и исключает из чата.
+--
+-- Логика (совпадает с course.check_tasks_completion):
+-- - current_task = p_current_day  → НЕ сдал → penalties + 1, current_task = p_current_day + 1
+-- - current_task = 0 (или NULL)   → не получал задание → current_task = p_current_day + 1 (без штрафа)
+-- - current_task > p_current_day  → уже сдал → без изменений
+-- LIMITED, заблокированные и неактивные (not_started/excluded/completed) не затрагиваются.
+--
+-- Возвращает изменённых пользователей:
+--   telegram_id, penalties (новое значение), penalized (TRUE = получил штраф)
+
+CREATE OR REPLACE FUNCTION apply_daily_penalties(p_current_day INTEGER)
+RETURNS TABLE (telegram_id BIGINT, penalties INTEGER, penalized BOOLEAN) AS $$
+    WITH targets AS (
+        SELECT u.id, COALESCE(u.current_task, 0) = p_current_day AS is_penalized
+        FROM users u
+        WHERE u.blocked_at IS NULL
+          AND u.course_state NOT IN ('not_started', 'excluded', 'completed', 'limited')
+          AND COALESCE(u.current_task, 0) IN (0, p_current_day)
+        FOR UPDATE
+    )
+    UPDATE users u SET
+        penalties = CASE WHEN t.is_penalized
+            THEN COALESCE(u.penalties, 0) + 1 ELSE u.penalties END,
+        current_task = p_current_day + 1
+    FROM targets t
+    WHERE u.id = t.id
+    RETURNING u.telegram_id, u.penalties, t.is_penalized;
+$$ LANGUAGE sql;
+
+COMMENT ON FUNCTION apply_daily_penalties(INTEGER) IS 'Проверка 9:50: штрафы и перевод на следующее задание одной операцией';
+
+-- Проверка (осторожно: изменяет данные!):
+-- SELECT * FROM apply_daily_penalties(1);
@@ -0,0 +1,45 @@
+-- ============================================================
+-- Журнал рассылок (возобновление после сбоя)
+-- ============================================================
+-- Рассылка задания и финальных сообщений пишет статус доставки каждому
+-- получателю (пачками, upsert). Повторный запуск рассылки с тем же
+-- broadcast_id (например "task_5:2026-10-16" или "final_16_2:2026-10-17")
+-- пропускает тех, у кого статус sent или blocked, а команда
+-- /resume_broadcast ... failed повторяет только ошибки.
+--
+-- Статусы: sent, failed, blocked (пользователь заблокировал бота), skipped
+--
+-- Старые записи можно периодически удалять:
+--   DELETE FROM broadcast_journal WHERE updated_at < NOW() - INTERVAL '30 days';
+
+CREATE TABLE IF NOT EXISTS broadcast_journal (
+    broadcast_id TEXT NOT NULL,
+    telegram_id BIGINT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (broadcast_id, telegram_id)
+);
+
+-- Выборка ошибок рассылки (/resume_broadcast ... failed)
+CREATE INDEX IF NOT EXISTS idx_broadcast_journal_status
+    ON broadcast_journal (broadcast_id, status, telegram_id);
+
+-- updated_at обновляется при повторной записи статуса (upsert)
+CREATE OR REPLACE FUNCTION broadcast_journal_touch()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated_at = NOW();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_broadcast_journal_touch ON broadcast_journal;
+CREATE TRIGGER trg_broadcast_journal_touch
+    BEFORE UPDATE ON broadcast_journal
+    FOR EACH ROW EXECUTE FUNCTION broadcast_journal_touch();
+
+COMMENT ON TABLE broadcast_journal IS 'Статус доставки рассылок по получателям (возобновление и повтор ошибок)';
+
+-- Проверка:
+-- SELECT status, COUNT(*) FROM broadcast_journal WHERE broadcast_id = 'task_5:2026-10-16' GROUP BY status;
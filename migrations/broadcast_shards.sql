@@ -0,0 +1,85 @@
+-- ============================================================
+-- Шардированная рассылка (несколько копий бота)
+-- ============================================================
+-- При BROADCAST_SHARDS > 1 каждая копия бота рассылает задание пользователям
+-- с telegram_id % BROADCAST_SHARDS = BROADCAST_SHARD_INDEX и записывает итог
+-- своего шарда.
+--
+-- Пользователей шарда бот читает через users_shard: отбор по остатку
+-- выполняется в БД, каждая копия загружает только свою часть. Функция возвращает суммарный итог ровно одному вызову -
+-- тому, который записал последний недостающий шард. Эта копия и отправляет
+-- общий отчёт в мониторинг.
+--
+-- Повторная запись того же шарда (перезапуск копии) заменяет его итог.
+--
+-- Старые записи можно периодически удалять:
+--   DELETE FROM broadcast_shard_results WHERE finished_at < NOW() - INTERVAL '30 days';
+
+-- Пользователи одного шарда. Функция на SQL (STABLE) встраивается в запрос
+-- PostgREST, поэтому фильтры, ORDER BY telegram_id и LIMIT бота применяются
+-- к таблице users и используют idx_users_active_course (add_active_users_index.sql)
+CREATE OR REPLACE FUNCTION users_shard(p_shards INTEGER, p_shard INTEGER)
+RETURNS SETOF users AS $$
+    SELECT * FROM users WHERE telegram_id % p_shards = p_shard;
+$$ LANGUAGE sql STABLE;
+
+COMMENT ON FUNCTION users_shard(INTEGER, INTEGER)
+    IS 'Пользователи шарда рассылки: telegram_id % p_shards = p_shard';
+
+CREATE TABLE IF NOT EXISTS broadcast_shard_results (
+    broadcast_key TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    success INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    elapsed DOUBLE PRECISION NOT NULL DEFAULT 0,
+    finished_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (broadcast_key, shard)
+);
+
+CREATE OR REPLACE FUNCTION report_broadcast_shard(
+    p_broadcast_key TEXT,
+    p_shard INTEGER,
+    p_shards INTEGER,
+    p_success INTEGER,
+    p_failed INTEGER,
+    p_elapsed DOUBLE PRECISION
+)
+RETURNS TABLE (shards INTEGER, success INTEGER, failed INTEGER, elapsed DOUBLE PRECISION) AS $$
+#variable_conflict use_column
+DECLARE
+    was_complete BOOLEAN;
+BEGIN
+    -- Шарды одной рассылки записываются по очереди, чтобы итог получил ровно один вызов
+    PERFORM pg_advisory_xact_lock(hashtext('broadcast_shards:' || p_broadcast_key));
+
+    SELECT COUNT(*) >= p_shards INTO was_complete
+    FROM broadcast_shard_results r
+    WHERE r.broadcast_key = p_broadcast_key;
+
+    INSERT INTO broadcast_shard_results AS r (broadcast_key, shard, success, failed, elapsed, finished_at)
+    VALUES (p_broadcast_key, p_shard, p_success, p_failed, p_elapsed, NOW())
+    ON CONFLICT (broadcast_key, shard) DO UPDATE SET
+        success = EXCLUDED.success,
+        failed = EXCLUDED.failed,
+        elapsed = EXCLUDED.elapsed,
+        finished_at = EXCLUDED.finished_at;
+
+    IF was_complete THEN
+        RETURN;
+    END IF;
+
+    RETURN QUERY
+        SELECT COUNT(*)::INTEGER, SUM(r.success)::INTEGER, SUM(r.failed)::INTEGER, MAX(r.elapsed)
+        FROM broadcast_shard_results r
+        WHERE r.broadcast_key = p_broadcast_key
+        HAVING COUNT(*) >= p_shards;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMENT ON FUNCTION report_broadcast_shard(TEXT, INTEGER, INTEGER, INTEGER, INTEGER, DOUBLE PRECISION)
+    IS 'Итог шарда рассылки; возвращает сумму по всем шардам последнему из них';
+
+-- Проверка:
+-- SELECT telegram_id FROM users_shard(2, 1) ORDER BY telegram_id LIMIT 5;  -- только нечётные telegram_id
+-- SELECT * FROM report_broadcast_shard('test:2026-01-01', 0, 2, 100, 1, 12.5);  -- пусто
+-- SELECT * FROM report_broadcast_shard('test:2026-01-01', 1, 2, 98, 2, 13.0);   -- 2, 198, 3, 13.0
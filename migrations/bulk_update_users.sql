@@ -0,0 +1,53 @@
+-- ============================================================
+-- Пакетное обновление пользователей одним запросом (RPC)
+-- ============================================================
+-- Используется рассылками (10:00, 9:50, финальные сообщения):
+-- вместо UPDATE на каждого пользователя бот отправляет пачку изменений
+-- (до BULK_UPDATE_CHUNK_SIZE пользователей) одним вызовом функции.
+--
+-- Формат параметра p_updates (JSONB массив):
+-- [
+--   {"telegram_id": 123, "current_task": 5, "course_state": "in_progress", "last_task_message_id": 777},
+--   {"telegram_id": 456, "penalties": 2, "current_task": 6}
+-- ]
+-- Обновляются только переданные ключи, остальные колонки не меняются.
+
+CREATE OR REPLACE FUNCTION bulk_update_users(p_updates JSONB)
+RETURNS INTEGER AS $$
+DECLARE
+    updated_count INTEGER;
+BEGIN
+    UPDATE users u SET
+        current_task = CASE WHEN r.data ? 'current_task'
+            THEN (r.data->>'current_task')::INTEGER ELSE u.current_task END,
+        course_state = CASE WHEN r.data ? 'course_state'
+            THEN r.data->>'course_state' ELSE u.course_state END,
+        penalties = CASE WHEN r.data ? 'penalties'
+            THEN (r.data->>'penalties')::INTEGER ELSE u.penalties END,
+        last_task_message_id = CASE WHEN r.data ? 'last_task_message_id'
+            THEN (r.data->>'last_task_message_id')::BIGINT ELSE u.last_task_message_id END,
+        is_blocked = CASE WHEN r.data ? 'is_blocked'
+            THEN (r.data->>'is_blocked')::BOOLEAN ELSE u.is_blocked END,
+        final_message_15_sent = CASE WHEN r.data ? 'final_message_15_sent'
+            THEN (r.data->>'final_message_15_sent')::BOOLEAN ELSE u.final_message_15_sent END,
+        final_message_1_sent = CASE WHEN r.data ? 'final_message_1_sent'
+            THEN (r.data->>'final_message_1_sent')::BOOLEAN ELSE u.final_message_1_sent END,
+        final_message_2_sent = CASE WHEN r.data ? 'final_message_2_sent'
+            THEN (r.data->>'final_message_2_sent')::BOOLEAN ELSE u.final_message_2_sent END,
+        final_message_3_sent = CASE WHEN r.data ? 'final_message_3_sent'
+            THEN (r.data->>'final_message_3_sent')::BOOLEAN ELSE u.final_message_3_sent END
+    FROM (
+        SELECT (e->>'telegram_id')::BIGINT AS telegram_id, e AS data
+        FROM jsonb_array_elements(p_updates) AS e
+    ) AS r
+    WHERE u.telegram_id = r.telegram_id;
+
+    GET DIAGNOSTICS updated_count = ROW_COUNT;
+    RETURN updated_count;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMENT ON FUNCTION bulk_update_users(JSONB) IS 'Пакетное обновление состояния пользователей (рассылки, проверка 9:50)';
+
+-- Проверка:
+-- SELECT bulk_update_users('[{"telegram_id": 123456789, "current_task": 1}]'::jsonb);
@@ -0,0 +1,46 @@
+-- ============================================================
+-- Аренда задач планировщика (несколько копий бота)
+-- ============================================================
+-- Если запущено несколько копий бота (например за балансировщиком в режиме
+-- webhook), планировщик срабатывает в каждой. Перед запуском рассылки,
+-- напоминаний, проверки 9:50 и финальных сообщений копия вызывает
+-- try_acquire_job_lease с ключом конкретного запуска ("send_task:2026-10-16 10:00").
+-- Аренду получает только первая копия, остальные запуск пропускают.
+--
+-- Аренда не снимается после выполнения задачи: повторный вызов с тем же
+-- ключом от другой копии вернёт FALSE, пока аренда не истечёт (p_ttl_seconds).
+-- Та же копия может взять аренду повторно.
+--
+-- Старые записи можно периодически удалять:
+--   DELETE FROM job_leases WHERE expires_at < NOW() - INTERVAL '7 days';
+
+CREATE TABLE IF NOT EXISTS job_leases (
+    run_key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    acquired_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION try_acquire_job_lease(p_run_key TEXT, p_owner TEXT, p_ttl_seconds INTEGER)
+RETURNS BOOLEAN AS $$
+DECLARE
+    acquired_owner TEXT;
+BEGIN
+    INSERT INTO job_leases (run_key, owner, acquired_at, expires_at)
+    VALUES (p_run_key, p_owner, NOW(), NOW() + make_interval(secs => p_ttl_seconds))
+    ON CONFLICT (run_key) DO UPDATE SET
+        owner = EXCLUDED.owner,
+        acquired_at = EXCLUDED.acquired_at,
+        expires_at = EXCLUDED.expires_at
+    WHERE job_leases.expires_at < NOW() OR job_leases.owner = EXCLUDED.owner
+    RETURNING owner INTO acquired_owner;
+
+    RETURN acquired_owner IS NOT NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMENT ON FUNCTION try_acquire_job_lease(TEXT, TEXT, INTEGER) IS 'Аренда запуска задачи планировщика: выполняет только одна копия бота';
+
+-- Проверка:
+-- SELECT try_acquire_job_lease('test:2026-01-01 10:00', 'host-a:1', 3600);  -- TRUE
+-- SELECT try_acquire_job_lease('test:2026-01-01 10:00', 'host-b:1', 3600);  -- FALSE
@@ -0,0 +1,45 @@
+-- ============================================================
+-- Атомарная работа со списком messages_to_delete (RPC)
+-- ============================================================
+-- Раньше бот на каждое промежуточное сообщение делал SELECT строки
+-- пользователя, дописывал ID в строку и делал UPDATE. Два быстрых
+-- сообщения подряд могли затереть друг друга, и ID терялся.
+--
+-- Колонка остаётся TEXT со списком через запятую (migrate_message_ids.sql),
+-- поэтому уже сохранённые списки читаются как раньше.
+--
+-- append_message_to_delete - дописывает ID одним UPDATE (без чтения строки)
+-- take_messages_to_delete  - возвращает накопленный список и очищает его
+--                            одной операцией (ничего не теряется между чтением и очисткой)
+
+CREATE OR REPLACE FUNCTION append_message_to_delete(p_telegram_id BIGINT, p_message_id BIGINT)
+RETURNS TEXT AS $$
+    UPDATE users SET messages_to_delete =
+        CASE WHEN COALESCE(messages_to_delete, '') = ''
+            THEN p_message_id::TEXT
+            ELSE messages_to_delete || ',' || p_message_id::TEXT
+        END
+    WHERE telegram_id = p_telegram_id
+    RETURNING messages_to_delete;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION take_messages_to_delete(p_telegram_id BIGINT)
+RETURNS TEXT AS $$
+    WITH old AS (
+        SELECT id, messages_to_delete FROM users
+        WHERE telegram_id = p_telegram_id
+        FOR UPDATE
+    )
+    UPDATE users u SET messages_to_delete = ''
+    FROM old
+    WHERE u.id = old.id
+    RETURNING old.messages_to_delete;
+$$ LANGUAGE sql;
+
+COMMENT ON FUNCTION append_message_to_delete(BIGINT, BIGINT) IS 'Дописывает ID сообщения в messages_to_delete';
+COMMENT ON FUNCTION take_messages_to_delete(BIGINT) IS 'Возвращает и очищает messages_to_delete';
+
+-- Проверка:
+-- SELECT append_message_to_delete(123456789, 1001);
+-- SELECT append_message_to_delete(123456789, 1002);
+-- SELECT take_messages_to_delete(123456789);  -- '1001,1002'
@@ -3,6 +3,8 @@
 Модуль для мониторинга работы бота и отправки отчетов в админский чат
 """
 
+import bisect
+import html
 import logging
 from datetime import datetime
 from aiogram import Bot
@@ -13,6 +15,9 @@ import monitoring_messages as mon_msg
 
 logger = logging.getLogger(__name__)
 
+# Границы корзин гистограммы задержки транскрибации (секунды), последняя корзина - всё, что больше
+TRANSCRIPTION_LATENCY_BUCKETS = (1, 3, 10, 30)
+
 
 class BotMonitor:
     """Класс для сбора и отправки статистики работы бота"""
@@ -33,6 +38,18 @@ class BotMonitor:
             'penalties_4': 0,
             'n8n_timeouts': [],  # Список telegram_id пользователей
             'n8n_errors': [],
+            'n8n_queue_jobs': 0,  # Генераций через очередь
+            'n8n_queue_waited': 0,  # Из них ждали в очереди
+            'n8n_queue_total_wait': 0.0,
+            'n8n_queue_max_wait': 0.0,
+            'n8n_queue_max_depth': 0,
+            'transcriptions': 0,  # Запросов на распознавание голосовых
+            'transcription_cached': 0,  # Из них взято из кэша
+            'transcription_errors': 0,
+            'transcription_retries': 0,  # Повторов после 429
+            'transcription_total_latency': 0.0,
+            'transcription_max_latency': 0.0,
+            'transcription_latency_buckets': [0] * (len(TRANSCRIPTION_LATENCY_BUCKETS) + 1),
         }
         self.last_reset = datetime.now()
     
@@ -53,11 +70,23 @@ class BotMonitor:
             'penalties_4': 0,
             'n8n_timeouts': [],
             'n8n_errors': [],
+            'n8n_queue_jobs': 0,
+            'n8n_queue_waited': 0,
+            'n8n_queue_total_wait': 0.0,
+            'n8n_queue_max_wait': 0.0,
+            'n8n_queue_max_depth': 0,
+            'transcriptions': 0,  # Запросов на распознавание голосовых
+            'transcription_cached': 0,  # Из них взято из кэша
+            'transcription_errors': 0,
+            'transcription_retries': 0,  # Повторов после 429
+            'transcription_total_latency': 0.0,
+            'transcription_max_latency': 0.0,
+            'transcription_latency_buckets': [0] * (len(TRANSCRIPTION_LATENCY_BUCKETS) + 1),
         }
         self.last_reset = datetime.now()
     
-    async def report_task_sent(self, bot: Bot, day: int, success_count: int, failed_count: int):
-        """Отчет о рассылке задания"""
+    async def report_task_sent(self, bot: Bot, day: int, success_count: int, failed_count: int, elapsed: float = 0.0):
+        """Отчет о рассылке задания (elapsed - длительность рассылки в секундах)"""
         self.daily_stats['task_sent'] += success_count
         self.daily_stats['task_failed'] += failed_count
         
@@ -67,14 +96,31 @@ class BotMonitor:
                     day=day,
                     success=success_count,
                     failed=failed_count,
+                    elapsed=elapsed,
+                    rate=success_count / elapsed if elapsed > 0 else 0.0,
                     time=datetime.now().strftime("%H:%M")
                 )
                 await bot.send_message(chat_id=config.MONITORING_CHAT_ID, text=message)
             except Exception as e:
                 logger.error(f"Ошибка отправки отчета о рассылке: {e}")
     
-    async def report_reminder_sent(self, bot: Bot, reminder_num: int, time: str, success_count: int, failed_count: int):
-        """Отчет о рассылке напоминания"""
+    async def report_broadcast_incomplete(self, bot: Bot, result):
+        """Отчет о прерванной рассылке (result - broadcast.BroadcastResult с заполненным incomplete)"""
+        if config.MONITORING_CHAT_ID:
+            try:
+                message = mon_msg.MSG_REPORT_BROADCAST_INCOMPLETE.format(
+                    name=result.name,
+                    success=result.success,
+                    failed=result.failed,
+                    error=html.escape(result.incomplete),
+                    time=datetime.now().strftime("%H:%M")
+                )
+                await bot.send_message(chat_id=config.MONITORING_CHAT_ID, text=message)
+            except Exception as e:
+                logger.error(f"Ошибка отправки отчета о прерванной рассылке: {e}")
+    
+    async def report_reminder_sent(self, bot: Bot, reminder_num: int, time: str, success_count: int, failed_count: int, elapsed: float = 0.0):
+        """Отчет о рассылке напоминания (elapsed - длительность рассылки в секундах)"""
         self.daily_stats[f'reminder_{reminder_num}_sent'] += success_count
         self.daily_stats[f'reminder_{reminder_num}_failed'] += failed_count
         
@@ -85,6 +131,8 @@ class BotMonitor:
                     time=time,
                     success=success_count,
                     failed=failed_count,
+                    elapsed=elapsed,
+                    rate=success_count / elapsed if elapsed > 0 else 0.0,
                     actual_time=datetime.now().strftime("%H:%M")
                 )
                 await bot.send_message(chat_id=config.MONITORING_CHAT_ID, text=message)
@@ -155,12 +203,48 @@ class BotMonitor:
             except Exception as e:
                 logger.error(f"Ошибка отправки отчета об ошибке n8n: {e}")
     
+    def record_generation_queue(self, wait_time: float, depth: int):
+        """Учитывает генерацию поста, прошедшую через очередь (wait_time - ожидание, depth - длина очереди)"""
+        self.daily_stats['n8n_queue_jobs'] += 1
+        self.daily_stats['n8n_queue_max_depth'] = max(self.daily_stats['n8n_queue_max_depth'], depth)
+        if wait_time > 0:
+            self.daily_stats['n8n_queue_waited'] += 1
+            self.daily_stats['n8n_queue_total_wait'] += wait_time
+            self.daily_stats['n8n_queue_max_wait'] = max(self.daily_stats['n8n_queue_max_wait'], wait_time)
+    
+    def record_transcription(self, latency: float, ok: bool, cached: bool = False, retries: int = 0):
+        """Учитывает распознавание голосового (latency - длительность запроса к Whisper в секундах)"""
+        self.daily_stats['transcriptions'] += 1
+        if not ok:
+            self.daily_stats['transcription_errors'] += 1
+        if cached:
+            self.daily_stats['transcription_cached'] += 1
+            return
+        self.daily_stats['transcription_retries'] += retries
+        self.daily_stats['transcription_total_latency'] += latency
+        self.daily_stats['transcription_max_latency'] = max(self.daily_stats['transcription_max_latency'], latency)
+        
+        bucket = bisect.bisect_left(TRANSCRIPTION_LATENCY_BUCKETS, latency)
+        self.daily_stats['transcription_latency_buckets'][bucket] += 1
+    
+    def _format_transcription_histogram(self) -> str:
+        """Гистограмма задержек транскрибации одной строкой: ≤1с: 5, ≤3с: 2, ..."""
+        counts = self.daily_stats['transcription_latency_buckets']
+        labels = [f"≤{bound}с" for bound in TRANSCRIPTION_LATENCY_BUCKETS]
+        labels.append(f">{TRANSCRIPTION_LATENCY_BUCKETS[-1]}с")
+        return ", ".join(f"{label}: {count}" for label, count in zip(labels, counts))
+    
     async def send_daily_summary(self, bot: Bot):
-        """Отправляет ежедневную сводку"""
+        """Отправляет ежедневную сводку (счётчики этой копии бота: сводку отправляет каждая копия)"""
         if config.MONITORING_CHAT_ID:
             try:
+                from ai_helper import get_http_pool_stats
+                pool = get_http_pool_stats()
+                transcribed = self.daily_stats['transcriptions'] - self.daily_stats['transcription_cached']
+                
                 message = mon_msg.MSG_DAILY_SUMMARY.format(
                     date=datetime.now().strftime("%d.%m.%Y"),
+                    replica=html.escape(config.REPLICA_ID),
                     task_sent=self.daily_stats['task_sent'],
                     task_failed=self.daily_stats['task_failed'],
                     reminder_1_sent=self.daily_stats['reminder_1_sent'],
@@ -177,7 +261,32 @@ class BotMonitor:
                     penalty_3=self.daily_stats['penalties_3'],
                     penalty_4=self.daily_stats['penalties_4'],
                     n8n_timeouts=len(self.daily_stats['n8n_timeouts']),
-                    n8n_errors=len(self.daily_stats['n8n_errors'])
+                    n8n_errors=len(self.daily_stats['n8n_errors']),
+                    n8n_requests=pool['requests'],
+                    n8n_http_errors=pool['errors'],
+                    n8n_avg_latency=pool['avg_latency'],
+                    n8n_max_latency=pool['max_latency'],
+                    n8n_pool_in_use=pool['in_use'],
+                    n8n_pool_limit=pool['limit'],
+                    n8n_pool_idle=pool['idle'],
+                    queue_jobs=self.daily_stats['n8n_queue_jobs'],
+                    queue_waited=self.daily_stats['n8n_queue_waited'],
+                    queue_avg_wait=(
+                        self.daily_stats['n8n_queue_total_wait'] / self.daily_stats['n8n_queue_waited']
+                        if self.daily_stats['n8n_queue_waited'] else 0.0
+                    ),
+                    queue_max_wait=self.daily_stats['n8n_queue_max_wait'],
+                    queue_max_depth=self.daily_stats['n8n_queue_max_depth'],
+                    transcriptions=self.daily_stats['transcriptions'],
+                    transcription_cached=self.daily_stats['transcription_cached'],
+                    transcription_errors=self.daily_stats['transcription_errors'],
+                    transcription_retries=self.daily_stats['transcription_retries'],
+                    transcription_avg_latency=(
+                        self.daily_stats['transcription_total_latency'] / transcribed
+                        if transcribed else 0.0
+                    ),
+                    transcription_max_latency=self.daily_stats['transcription_max_latency'],
+                    transcription_histogram=self._format_transcription_histogram()
                 )
                 await bot.send_message(chat_id=config.MONITORING_CHAT_ID, text=message)
             except Exception as e:
@@ -10,16 +10,33 @@ MSG_REPORT_TASK_SENT = """
 
 ✅ Отправлено: <b>{success}</b>
 ❌ Не отправлено: <b>{failed}</b>
+⚡ Скорость: {rate:.1f} сообщ/сек ({elapsed:.0f} сек)
 
 ⏰ Время: {time}
 """
 
+# Рассылка прервана: список получателей не загрузился до конца
+MSG_REPORT_BROADCAST_INCOMPLETE = """
+🔴 <b>РАССЫЛКА ПРЕРВАНА: {name}</b>
+
+Получатели загрузились не полностью, рассылка остановлена на середине.
+
+✅ Отправлено: <b>{success}</b>
+❌ Не отправлено: <b>{failed}</b>
+
+Ошибка: <code>{error}</code>
+
+Повторный запуск продолжит с места остановки.
+⏰ Время: {time}
+"""
+
 # Отчет о напоминании
 MSG_REPORT_REMINDER_SENT = """
 ⏰ <b>НАПОМИНАНИЕ {number} ({time})</b>
 
 ✅ Отправлено: <b>{success}</b>
 ❌ Не отправлено: <b>{failed}</b>
+⚡ Скорость: {rate:.1f} сообщ/сек ({elapsed:.0f} сек)
 
 ⏰ Фактическое время: {actual_time}
 """
@@ -67,6 +84,7 @@ MSG_REPORT_N8N_ERROR = """
 MSG_DAILY_SUMMARY = """
 📈 <b>ДНЕВНАЯ СВОДКА</b>
 Дата: {date}
+Копия бота: {replica}
 
 ━━━━━━━━━━━━━━━━━━━━
 
@@ -101,6 +119,15 @@ MSG_DAILY_SUMMARY = """
 
 Таймауты (>5 мин): {n8n_timeouts}
 Ошибки: {n8n_errors}
+HTTP-запросов: {n8n_requests} (ошибок {n8n_http_errors}), задержка: ср. {n8n_avg_latency:.2f}с / макс. {n8n_max_latency:.2f}с
+Пул соединений: занято {n8n_pool_in_use} из {n8n_pool_limit}, свободных keep-alive: {n8n_pool_idle}
+Очередь генераций: {queue_jobs} постов, ждали {queue_waited} (ср. {queue_avg_wait:.0f}с, макс. {queue_max_wait:.0f}с), макс. длина {queue_max_depth}
+
+<b>🎙 Транскрибация:</b>
+
+Голосовых: {transcriptions} (из кэша {transcription_cached}, ошибок {transcription_errors}, повторов после 429: {transcription_retries})
+Задержка: ср. {transcription_avg_latency:.1f}с / макс. {transcription_max_latency:.1f}с
+Распределение: {transcription_histogram}
 
 ━━━━━━━━━━━━━━━━━━━━
 """
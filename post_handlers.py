@@ -3,16 +3,18 @@
 Обработчики для логики выполнения заданий (посты)
 """
 
+import io
 import logging
-import os
+import tempfile
 from datetime import datetime
+from typing import BinaryIO
 from aiogram import Bot
-from aiogram.types import Message, FSInputFile
+from aiogram.types import Message, Voice
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 import config
 import messages
-from media_helper import get_post_accepted_image_path
+from media_helper import get_post_accepted_image_path, send_photo_cached
 from database import (
     get_user_by_telegram_id,
     get_task_by_number,
@@ -21,13 +23,13 @@ from database import (
     save_post_link,
     get_user_post_link,
     add_message_to_delete,
-    get_user_messages_to_delete,
-    clear_messages_to_delete,
+    take_messages_to_delete,
     get_user_last_task_message_id,
     save_user_last_task_message_id
 )
 from post_validator import validate_post_link
-from ai_helper import transcribe_voice, generate_post_with_ai
+from broadcast import delete_messages_batched
+from ai_helper import transcribe_voice, get_cached_transcription, generate_post_with_ai
 from user_states import (
     get_user_state,
     set_user_state,
@@ -42,17 +44,11 @@ logger = logging.getLogger(__name__)
 async def delete_intermediate_messages(bot: Bot, user_id: int):
     """Удаляет все промежуточные сообщения (вопросы, ответы пользователя)"""
     try:
-        message_ids = await get_user_messages_to_delete(user_id)
+        # Забираем и очищаем список одной операцией
+        message_ids = await take_messages_to_delete(user_id)
         
-        for msg_id in message_ids:
-            try:
-                await bot.delete_message(chat_id=user_id, message_id=msg_id)
-            except Exception as e:
-                logger.warning(f"Не удалось удалить сообщение {msg_id} у {user_id}: {e}")
-        
-        # Очищаем список
-        await clear_messages_to_delete(user_id)
-        logger.info(f"🗑️ Удалено {len(message_ids)} промежуточных сообщений у {user_id}")
+        deleted = await delete_messages_batched(bot, user_id, message_ids)
+        logger.info(f"🗑️ Удалено {deleted} промежуточных сообщений у {user_id}")
         
     except Exception as e:
         logger.error(f"Ошибка при удалении промежуточных сообщений: {e}")
@@ -86,7 +82,7 @@ async def handle_submit_task_button(user_id: int, message: Message, bot: Bot):
     user_channel = user.get('channel_link')
     
     # Устанавливаем состояние ожидания ссылки
-    set_user_state(user_id, "waiting_post_link", current_task=current_task)
+    await set_user_state(user_id, "waiting_post_link", current_task=current_task)
     
     # Просим ссылку и сохраняем ID сообщения для удаления
     sent_msg = await message.answer(
@@ -106,7 +102,7 @@ async def handle_post_link(message: Message, bot: Bot):
     await add_message_to_delete(user_id, message.message_id)
     
     # Получаем состояние пользователя
-    user_state = get_user_state(user_id)
+    user_state = await get_user_state(user_id)
     current_task = user_state.current_task
     
     # Получаем канал пользователя
@@ -172,7 +168,7 @@ async def handle_post_link(message: Message, bot: Bot):
             logger.warning(f"⚠️ Не удалось удалить сообщение с заданием {task_message_id}: {e}")
     
     # Очищаем состояние
-    clear_user_state(user_id)
+    await clear_user_state(user_id)
     
     # Удаляем все промежуточные сообщения (вопросы, запросы ссылок)
     await delete_intermediate_messages(bot, user_id)
@@ -181,9 +177,10 @@ async def handle_post_link(message: Message, bot: Bot):
     post_accepted_image = get_post_accepted_image_path()
     if post_accepted_image:
         try:
-            photo = FSInputFile(post_accepted_image)
-            await message.answer_photo(
-                photo=photo,
+            await send_photo_cached(
+                bot,
+                message.chat.id,
+                post_accepted_image,
                 caption=messages.MSG_POST_ACCEPTED
             )
         except Exception as e:
@@ -220,7 +217,7 @@ async def handle_write_post_button(user_id: int, message: Message, bot: Bot):
         return
     
     # Сохраняем данные в состоянии пользователя
-    set_user_state(
+    await set_user_state(
         user_id,
         "question_1",
         current_task=current_task,
@@ -239,12 +236,36 @@ async def handle_write_post_button(user_id: int, message: Message, bot: Bot):
     await add_message_to_delete(user_id, q1_msg.message_id)
 
 
+async def download_voice(bot: Bot, voice: Voice) -> BinaryIO:
+    """
+    Скачивает голосовое сообщение без временного файла на диске
+    
+    Небольшие файлы (до VOICE_MEMORY_LIMIT) скачиваются в BytesIO,
+    большие или без известного размера - в SpooledTemporaryFile, который
+    уходит на диск только при превышении лимита.
+    
+    Returns:
+        Файловый объект с позицией в начале (закрыть после использования)
+    """
+    if voice.file_size and voice.file_size <= config.VOICE_MEMORY_LIMIT:
+        buffer = io.BytesIO()
+    else:
+        buffer = tempfile.SpooledTemporaryFile(max_size=config.VOICE_MEMORY_LIMIT)
+    
+    try:
+        await bot.download(voice, destination=buffer)
+    except Exception:
+        buffer.close()
+        raise
+    return buffer
+
+
 async def handle_question_answer(message: Message, bot: Bot):
     """
     Обработчик ответов на вопросы (текст или голосовое)
     """
     user_id = message.from_user.id
-    user_state = get_user_state(user_id)
+    user_state = await get_user_state(user_id)
     
     # Определяем, на каком вопросе мы
     if user_state.state not in ["question_1", "question_2", "question_3"]:
@@ -263,19 +284,18 @@ async def handle_question_answer(message: Message, bot: Bot):
         trans_msg = await message.answer(messages.MSG_VOICE_TRANSCRIBING)
         await add_message_to_delete(user_id, trans_msg.message_id)
         
-        # Скачиваем голосовое сообщение
-        voice_file = await bot.get_file(message.voice.file_id)
-        voice_path = f"/tmp/voice_{user_id}_{message.voice.file_id}.ogg"
-        await bot.download_file(voice_file.file_path, voice_path)
-        
-        # Транскрибируем
-        answer_text = await transcribe_voice(voice_path)
-        
-        # Удаляем файл
-        try:
-            os.remove(voice_path)
-        except:
-            pass
+        # Уже распознанное голосовое (повторная обработка) не скачиваем заново
+        answer_text = get_cached_transcription(message.voice.file_unique_id)
+        if answer_text is None:
+            # Скачиваем голосовое сообщение в память и транскрибируем
+            try:
+                with await download_voice(bot, message.voice) as voice_buffer:
+                    answer_text = await transcribe_voice(
+                        voice_buffer, file_unique_id=message.voice.file_unique_id
+                    )
+            except Exception as e:
+                logger.error(f"Ошибка при скачивании голосового сообщения пользователя {user_id}: {e}")
+                answer_text = None
         
         if not answer_text:
             err_msg = await message.answer(messages.MSG_VOICE_TRANSCRIPTION_ERROR)
@@ -287,7 +307,7 @@ async def handle_question_answer(message: Message, bot: Bot):
     
     # Сохраняем ответ
     question_num = int(user_state.state.split("_")[1])
-    save_answer(user_id, question_num, answer_text)
+    await save_answer(user_id, question_num, answer_text)
     
     # Переходим к следующему вопросу
     if question_num < 3:
@@ -295,7 +315,7 @@ async def handle_question_answer(message: Message, bot: Bot):
         await add_message_to_delete(user_id, acc_msg.message_id)
         
         next_question_num = question_num + 1
-        set_user_state(user_id, f"question_{next_question_num}")
+        await set_user_state(user_id, f"question_{next_question_num}")
         
         # Задаем следующий вопрос (сохраняем для удаления)
         digest_data = user_state.digest_data
@@ -317,21 +337,26 @@ async def generate_post(message: Message, bot: Bot):
     Генерирует пост с помощью AI
     """
     user_id = message.from_user.id
-    user_state = get_user_state(user_id)
+    user_state = await get_user_state(user_id)
     
     # Получаем все ответы
-    answers = get_answers(user_id)
+    answers = await get_answers(user_id)
     answer_1 = answers.get('answer_1', '')
     answer_2 = answers.get('answer_2', '')
     answer_3 = answers.get('answer_3', '')
     
     # Устанавливаем состояние генерации
-    set_user_state(user_id, "generating_post")
+    await set_user_state(user_id, "generating_post")
     
     # Сообщаем пользователю (сохраняем для удаления)
     gen_msg = await message.answer(messages.MSG_GENERATING_POST)
     await add_message_to_delete(user_id, gen_msg.message_id)
     
+    # Если все места генерации заняты - сообщаем номер в очереди (сохраняем для удаления)
+    async def notify_queued(position: int):
+        queue_msg = await message.answer(messages.MSG_GENERATION_QUEUED.format(position=position))
+        await add_message_to_delete(user_id, queue_msg.message_id)
+    
     # Генерируем пост
     generated_text = await generate_post_with_ai(
         digest_data=user_state.digest_data,
@@ -339,12 +364,13 @@ async def generate_post(message: Message, bot: Bot):
         answer_2=answer_2,
         answer_3=answer_3,
         chat_id=user_id,
-        task_number=user_state.current_task or 0
+        task_number=user_state.current_task or 0,
+        on_queued=notify_queued
     )
     
     if not generated_text:
         # Ошибка или таймаут
-        clear_user_state(user_id)
+        await clear_user_state(user_id)
         
         # Сбрасываем флаг "пишет пост" при ошибке
         from database import set_user_writing_post
@@ -385,5 +411,5 @@ async def generate_post(message: Message, bot: Bot):
     logger.info(f"🔓 Пользователь {user_id} завершил писать пост (успешно, is_writing_post = FALSE)")
     
     # Очищаем состояние (но оставляем в ожидании ссылки)
-    clear_user_state(user_id)
+    await clear_user_state(user_id)
 
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Общие фикстуры тестов
+
+FakeSupabase (tests/fake_supabase.py) - подмена клиента Supabase в памяти,
+которая считает каждый запрос к БД. FakeBot, FakeMessage и FakeCallback -
+минимальные заглушки Telegram для вызова обработчиков напрямую.
+"""
+
+import os
+import time
+from types import SimpleNamespace
+from typing import Any, List, Optional
+
+import pytest
+
+from fake_supabase import FakeSupabase
+
+# Переменные окружения нужны config.py и database.py при импорте
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN")
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.test")
+
+
+# ============================================================
+# ЗАГЛУШКИ TELEGRAM
+# ============================================================
+
+class FakeBot:
+    """Бот, запоминающий отправленные и удалённые сообщения"""
+
+    def __init__(self):
+        self.sent: List[tuple] = []
+        self.deleted: List[tuple] = []
+        self._next_message_id = 1000
+
+    def _message(self):
+        self._next_message_id += 1
+        return SimpleNamespace(message_id=self._next_message_id, photo=None)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return self._message()
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        self.sent.append((chat_id, kwargs.get("caption")))
+        return self._message()
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        self.deleted.append((chat_id, message_id))
+        return True
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs):
+        self.deleted.extend((chat_id, message_id) for message_id in message_ids)
+        return True
+
+
+class FakeMessage:
+    """Входящее сообщение из личного чата"""
+
+    def __init__(self, bot: FakeBot, user_id: int, text: Optional[str] = None, voice=None, message_id: int = 1):
+        self.bot = bot
+        self.message_id = message_id
+        self.text = text
+        self.voice = voice
+        self.from_user = SimpleNamespace(id=user_id, first_name="Тест", username="test")
+        self.chat = SimpleNamespace(id=user_id, type="private")
+
+    async def answer(self, text, **kwargs):
+        return await self.bot.send_message(self.chat.id, text, **kwargs)
+
+    async def answer_video(self, video, **kwargs):
+        return await self.bot.send_message(self.chat.id, "<video>", **kwargs)
+
+    async def delete(self, **kwargs):
+        return await self.bot.delete_message(self.chat.id, self.message_id)
+
+
+class FakeCallback:
+    """Нажатие inline-кнопки под сообщением бота"""
+
+    def __init__(self, bot: FakeBot, user_id: int, data: str):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id, first_name="Тест", username="test")
+        self.message = FakeMessage(bot, user_id, message_id=500)
+        self.answers: List[Any] = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+        return True
+
+
+# ============================================================
+# ФИКСТУРЫ
+# ============================================================
+
+@pytest.fixture
+def db(monkeypatch):
+    """
+    Подменяет клиент Supabase на FakeSupabase
+
+    Кэш строк пользователей пуст (худший случай для обработчика), снимок
+    состояния курса и кэш заданий загружены, как после старта бота.
+    """
+    import database
+    import final_messages_handlers
+    from user_states import dialog_storage
+
+    fake = FakeSupabase()
+    monkeypatch.setattr(database, "supabase", fake)
+    monkeypatch.setattr(final_messages_handlers, "supabase", fake, raising=False)
+
+    database.user_cache.clear()
+    monkeypatch.setattr(database, "_course_state_snapshot", {"id": 1, "is_active": False, "current_day": 0})
+
+    tasks = {
+        day: {"zadanie": f"Задание {day}", "vopros_1": "В1", "vopros_2": "В2", "vopros_3": "В3", "prompt": "{answer_1}"}
+        for day in range(1, 15)
+    }
+    monkeypatch.setattr(database.content_cache, "tasks", tasks)
+    monkeypatch.setattr(database.content_cache, "version", 1)
+    monkeypatch.setattr(database.content_cache, "loaded_at", time.monotonic())
+
+    getattr(dialog_storage, "_states", {}).clear()
+
+    yield fake
+
+    database.user_cache.clear()
+
+
+@pytest.fixture
+def fake_bot(monkeypatch):
+    """FakeBot вместо бота в модулях с обработчиками; картинки из media/ не отправляются"""
+    import bot as bot_module
+    import post_handlers
+
+    fake = FakeBot()
+    monkeypatch.setattr(bot_module, "bot", fake)
+    for name in (
+        "get_welcome_image_path",
+        "get_channel_request_image_path",
+        "get_final_image_path",
+        "get_instruction_video_path",
+    ):
+        monkeypatch.setattr(bot_module, name, lambda *args, **kwargs: None)
+    monkeypatch.setattr(post_handlers, "get_post_accepted_image_path", lambda *args, **kwargs: None)
+    return fake
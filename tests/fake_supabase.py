@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Клиент Supabase в памяти, считающий обращения к БД
+
+Поддерживает запросы к таблицам и RPC, которые использует бот. Каждый
+execute() записывается в queries как (таблица или "rpc", операция).
+Используется тестами бюджета запросов (tests/) и бенчмарком рассылок
+(benchmarks/), поэтому выборки по telegram_id идут через индекс - чтобы
+когорты в десятки тысяч пользователей обрабатывались быстро.
+"""
+
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+
+class FakeQuery:
+    """Запрос к таблице (поддерживает фильтры, которые использует бот)"""
+
+    def __init__(self, db: "FakeSupabase", table: str, recorded_as: Optional[tuple] = None):
+        self.db = db
+        self.table = table
+        self.recorded_as = recorded_as or (table, None)  # RPC, возвращающая строки таблицы
+        self.operation = "select"
+        self.payload: Any = None
+        self.columns = "*"
+        self.on_conflict: Optional[str] = None
+        self.filters: List[Callable[[Dict[str, Any]], bool]] = []
+        self.telegram_id: Optional[Any] = None  # eq("telegram_id", ...) - выборка через индекс
+        self.order_by: Optional[tuple] = None
+        self.row_limit: Optional[int] = None
+        self._negate = False
+
+    def select(self, columns: str = "*", **kwargs):
+        self.operation, self.columns = "select", columns
+        return self
+
+    def insert(self, payload, **kwargs):
+        self.operation, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload, on_conflict: Optional[str] = None, **kwargs):
+        self.operation, self.payload, self.on_conflict = "upsert", payload, on_conflict
+        return self
+
+    def update(self, payload, **kwargs):
+        self.operation, self.payload = "update", payload
+        return self
+
+    def delete(self, **kwargs):
+        self.operation = "delete"
+        return self
+
+    def _filter(self, predicate: Callable[[Dict[str, Any]], bool]):
+        if self._negate:
+            self._negate = False
+            self.filters.append(lambda row: not predicate(row))
+        else:
+            self.filters.append(predicate)
+        return self
+
+    @property
+    def not_(self):
+        self._negate = True
+        return self
+
+    def eq(self, column, value):
+        if column == "telegram_id" and not self._negate and self.telegram_id is None:
+            self.telegram_id = value
+        return self._filter(lambda row: row.get(column) == value)
+
+    def neq(self, column, value):
+        return self._filter(lambda row: row.get(column) != value)
+
+    def gt(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row.get(column) > value)
+
+    def gte(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row.get(column) >= value)
+
+    def lt(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row.get(column) < value)
+
+    def lte(self, column, value):
+        return self._filter(lambda row: row.get(column) is not None and row.get(column) <= value)
+
+    def in_(self, column, values):
+        return self._filter(lambda row: row.get(column) in values)
+
+    def is_(self, column, value):
+        if value in ("null", None):
+            return self._filter(lambda row: row.get(column) is None)
+        return self._filter(lambda row: row.get(column) == value)
+
+    def order(self, column, desc: bool = False, **kwargs):
+        self.order_by = (column, desc)
+        return self
+
+    def limit(self, count: int, **kwargs):
+        self.row_limit = count
+        return self
+
+    def _matched(self) -> List[Dict[str, Any]]:
+        if self.telegram_id is not None:
+            candidates = self.db.rows_by_telegram_id(self.table, self.telegram_id)
+        else:
+            candidates = self.db.tables.setdefault(self.table, [])
+        return [row for row in candidates if all(predicate(row) for predicate in self.filters)]
+
+    async def execute(self):
+        self.db.record(self.recorded_as[0], self.recorded_as[1] or self.operation)
+        rows = self.db.tables.setdefault(self.table, [])
+
+        if self.operation == "select":
+            matched = self._matched()
+            if self.order_by:
+                column, desc = self.order_by
+                matched.sort(key=lambda row: row.get(column) or 0, reverse=desc)
+            if self.row_limit is not None:
+                matched = matched[:self.row_limit]
+            if self.columns.strip() != "*":
+                columns = [c.strip() for c in self.columns.split(",")]
+                return SimpleNamespace(data=[{c: row.get(c) for c in columns} for row in matched])
+            return SimpleNamespace(data=[dict(row) for row in matched])
+
+        if self.operation == "update":
+            matched = self._matched()
+            for row in matched:
+                row.update(self.payload)
+            if "telegram_id" in self.payload:
+                self.db.invalidate_index(self.table)
+            return SimpleNamespace(data=[dict(row) for row in matched])
+
+        if self.operation == "delete":
+            matched = self._matched()
+            removed = {id(row) for row in matched}
+            rows[:] = [row for row in rows if id(row) not in removed]
+            self.db.invalidate_index(self.table)
+            return SimpleNamespace(data=matched)
+
+        payload = self.payload if isinstance(self.payload, list) else [self.payload]
+        if self.operation == "insert":
+            rows.extend(dict(item) for item in payload)
+        else:
+            keys = [k.strip() for k in (self.on_conflict or "id").split(",")]
+            existing = {tuple(row.get(k) for k in keys): row for row in rows}
+            for item in payload:
+                row = existing.get(tuple(item.get(k) for k in keys))
+                if row is not None:
+                    row.update(item)
+                else:
+                    row = dict(item)
+                    rows.append(row)
+                    existing[tuple(row.get(k) for k in keys)] = row
+        self.db.invalidate_index(self.table)
+        return SimpleNamespace(data=payload)
+
+
+class FakeRpc:
+    def __init__(self, db: "FakeSupabase", name: str, params: Dict[str, Any]):
+        self.db = db
+        self.name = name
+        self.params = params
+
+    async def execute(self):
+        self.db.record("rpc", self.name)
+        return SimpleNamespace(data=self.db.rpcs[self.name](self.db, **self.params))
+
+
+# ============================================================
+# RPC (повторяют migrations/*.sql)
+# ============================================================
+
+def _rpc_append_message_to_delete(db, p_telegram_id, p_message_id):
+    for row in db.rows_by_telegram_id("users", p_telegram_id):
+        current = row.get("messages_to_delete") or ""
+        row["messages_to_delete"] = f"{current},{p_message_id}" if current else str(p_message_id)
+        return row["messages_to_delete"]
+    return None
+
+
+def _rpc_take_messages_to_delete(db, p_telegram_id):
+    for row in db.rows_by_telegram_id("users", p_telegram_id):
+        taken = row.get("messages_to_delete") or ""
+        row["messages_to_delete"] = ""
+        return taken
+    return None
+
+
+def _rpc_bulk_update_users(db, p_updates):
+    updated = 0
+    for update in p_updates:
+        fields = {k: v for k, v in update.items() if k != "telegram_id"}
+        for row in db.rows_by_telegram_id("users", update["telegram_id"]):
+            row.update(fields)
+            updated += 1
+    return updated
+
+
+def _rpc_apply_daily_penalties(db, p_current_day):
+    changed = []
+    for row in db.tables.get("users", []):
+        current_task = row.get("current_task") or 0
+        if row.get("blocked_at") is not None or current_task not in (0, p_current_day):
+            continue
+        if row.get("course_state") in ("not_started", "excluded", "completed", "limited"):
+            continue
+        penalized = current_task == p_current_day
+        if penalized:
+            row["penalties"] = (row.get("penalties") or 0) + 1
+        row["current_task"] = p_current_day + 1
+        changed.append({"telegram_id": row["telegram_id"], "penalties": row.get("penalties"), "penalized": penalized})
+    return changed
+
+
+# RPC, возвращающие строки таблицы (к результату применяются select, фильтры, limit):
+# имя -> (таблица, условие отбора строк по параметрам RPC)
+TABLE_RPCS: Dict[str, tuple] = {
+    "users_shard": ("users", lambda row, p_shards, p_shard: (
+        row.get("telegram_id") is not None and row["telegram_id"] % p_shards == p_shard
+    )),
+}
+
+
+class FakeSupabase:
+    """Клиент Supabase в памяти, считающий обращения к БД"""
+
+    def __init__(self):
+        self.tables: Dict[str, List[Dict[str, Any]]] = {}
+        self.queries: List[tuple] = []
+        self.rpcs: Dict[str, Callable] = {
+            "append_message_to_delete": _rpc_append_message_to_delete,
+            "take_messages_to_delete": _rpc_take_messages_to_delete,
+            "bulk_update_users": _rpc_bulk_update_users,
+            "apply_daily_penalties": _rpc_apply_daily_penalties,
+        }
+        self._indexes: Dict[str, Dict[Any, List[Dict[str, Any]]]] = {}
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    from_ = table
+
+    def rpc(self, name: str, params: Dict[str, Any], **kwargs):
+        if name in TABLE_RPCS:
+            table, predicate = TABLE_RPCS[name]
+            query = FakeQuery(self, table, recorded_as=("rpc", name))
+            query.filters.append(lambda row: predicate(row, **params))
+            return query
+        if name not in self.rpcs:
+            raise Exception(f"RPC {name} не найдена")
+        return FakeRpc(self, name, params)
+
+    def record(self, table: str, operation: str):
+        self.queries.append((table, operation))
+
+    def rows_by_telegram_id(self, table: str, telegram_id: Any) -> List[Dict[str, Any]]:
+        """Строки таблицы с заданным telegram_id (индекс строится при первом обращении)"""
+        index = self._indexes.get(table)
+        if index is None:
+            index = {}
+            for row in self.tables.setdefault(table, []):
+                index.setdefault(row.get("telegram_id"), []).append(row)
+            self._indexes[table] = index
+        return index.get(telegram_id, [])
+
+    def invalidate_index(self, table: str):
+        self._indexes.pop(table, None)
+
+    @property
+    def round_trips(self) -> int:
+        return len(self.queries)
+
+    def summary(self) -> Dict[str, int]:
+        """Количество запросов по видам: {"users.select": 3, "rpc.bulk_update_users": 2, ...}"""
+        return dict(Counter(f"{table}.{operation}" for table, operation in self.queries))
+
+    def reset_counter(self):
+        self.queries.clear()
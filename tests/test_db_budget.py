@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Бюджет запросов к БД на одно действие пользователя
+
+Каждый тест проходит один апдейт так же, как в боте: UserContextMiddleware
+загружает контекст пользователя, затем вызывается обработчик. FakeSupabase
+считает все запросы к БД (включая RPC) за апдейт. Если изменение добавляет
+запрос в путь обработчика, тест падает - бюджет нужно поднять осознанно,
+вместе с изменением QUERY_BUDGETS.
+
+Кэш строк пользователей перед каждым апдейтом пуст (худший случай),
+состояние курса и задания уже загружены в память (как после старта бота).
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from conftest import FakeCallback, FakeMessage
+
+USER_ID = 555000111
+
+# Максимум запросов к БД на один апдейт
+QUERY_BUDGETS = {
+    "cmd_start_new_user": 3,
+    "cmd_start_registered": 1,
+    "email_input": 3,
+    "channel_input": 2,
+    "callback_write_post": 4,
+    "callback_submit_task": 2,
+    "post_link": 6,
+    "question_answer_text": 4,
+    "question_answer_voice": 5,
+    "question_answer_last": 5,
+}
+
+
+def add_user(db, **fields):
+    """Добавляет пользователя-участника курса (поля можно переопределить)"""
+    row = {
+        "telegram_id": USER_ID,
+        "email": "user@example.com",
+        "state": "registered",
+        "course_state": "in_progress",
+        "current_task": 3,
+        "channel_link": "@my_channel",
+        "is_blocked": False,
+        "is_writing_post": False,
+        "messages_to_delete": "",
+        "last_task_message_id": 0,
+        "final_message_3_sent": False,
+    }
+    row.update(fields)
+    db.tables.setdefault("users", []).append(row)
+    return row
+
+
+def run_update(db, event, handler):
+    """
+    Проводит апдейт через UserContextMiddleware и обработчик
+
+    Returns:
+        Список запросов к БД за апдейт [(таблица или "rpc", операция)]
+    """
+    from middlewares import UserContextMiddleware
+
+    async def call_handler(event, data):
+        return await handler(event, data["ctx"])
+
+    db.reset_counter()
+    asyncio.run(UserContextMiddleware()(call_handler, event, {"event_from_user": event.from_user}))
+    return list(db.queries)
+
+
+def assert_budget(path: str, queries: list):
+    budget = QUERY_BUDGETS[path]
+    assert len(queries) <= budget, (
+        f"{path}: {len(queries)} запросов к БД при бюджете {budget}:\n"
+        + "\n".join(f"  {table}.{operation}" for table, operation in queries)
+    )
+
+
+# ============================================================
+# РЕГИСТРАЦИЯ
+# ============================================================
+
+def test_cmd_start_new_user(db, fake_bot):
+    from bot import cmd_start
+
+    message = FakeMessage(fake_bot, USER_ID, text="/start")
+    queries = run_update(db, message, lambda event, ctx: cmd_start(event))
+
+    assert fake_bot.sent
+    assert_budget("cmd_start_new_user", queries)
+
+
+def test_cmd_start_registered(db, fake_bot):
+    from bot import cmd_start
+    import messages
+
+    add_user(db)
+    message = FakeMessage(fake_bot, USER_ID, text="/start")
+    queries = run_update(db, message, lambda event, ctx: cmd_start(event))
+
+    assert fake_bot.sent == [(USER_ID, messages.MSG_ALREADY_REGISTERED)]
+    assert_budget("cmd_start_registered", queries)
+
+
+def test_email_input(db, fake_bot):
+    from bot import handle_text_message
+
+    # Строка из списка оплативших: email есть, telegram_id ещё нет
+    add_user(db, telegram_id=None, state="new", course_state="not_started", current_task=0, channel_link=None)
+    message = FakeMessage(fake_bot, USER_ID, text="User@Example.com")
+    queries = run_update(db, message, handle_text_message)
+
+    assert db.tables["users"][0]["telegram_id"] == USER_ID
+    assert db.tables["users"][0]["state"] == "waiting_channel"
+    assert_budget("email_input", queries)
+
+
+def test_channel_input(db, fake_bot):
+    from bot import handle_text_message
+
+    add_user(db, state="waiting_channel", course_state="not_started", current_task=0, channel_link=None)
+    message = FakeMessage(fake_bot, USER_ID, text="https://t.me/my_channel")
+    queries = run_update(db, message, handle_text_message)
+
+    assert db.tables["users"][0]["state"] == "registered"
+    assert db.tables["users"][0]["channel_link"] == "@my_channel"
+    assert_budget("channel_input", queries)
+
+
+# ============================================================
+# КНОПКИ
+# ============================================================
+
+def test_callback_write_post(db, fake_bot):
+    from bot import callback_write_post
+    from user_states import get_user_state
+
+    add_user(db)
+    callback = FakeCallback(fake_bot, USER_ID, "write_post")
+    queries = run_update(db, callback, callback_write_post)
+
+    assert asyncio.run(get_user_state(USER_ID)).state == "question_1"
+    assert db.tables["users"][0]["is_writing_post"] is True
+    assert_budget("callback_write_post", queries)
+
+
+def test_callback_submit_task(db, fake_bot):
+    from bot import callback_submit_task
+    from user_states import get_user_state
+
+    add_user(db)
+    callback = FakeCallback(fake_bot, USER_ID, "submit_task")
+    queries = run_update(db, callback, callback_submit_task)
+
+    assert asyncio.run(get_user_state(USER_ID)).state == "waiting_post_link"
+    assert_budget("callback_submit_task", queries)
+
+
+# ============================================================
+# ПОСТЫ
+# ============================================================
+
+def test_post_link(db, fake_bot):
+    from bot import handle_text_message
+    from user_states import set_user_state
+
+    add_user(db, last_task_message_id=777, messages_to_delete="10,11")
+    asyncio.run(set_user_state(USER_ID, "waiting_post_link", current_task=3))
+    message = FakeMessage(fake_bot, USER_ID, text="https://t.me/my_channel/42", message_id=12)
+    queries = run_update(db, message, handle_text_message)
+
+    user = db.tables["users"][0]
+    assert user["post_3"] == "https://t.me/my_channel/42"
+    assert user["current_task"] == 4
+    assert (USER_ID, 777) in fake_bot.deleted
+    assert_budget("post_link", queries)
+
+
+def test_question_answer_text(db, fake_bot):
+    from bot import handle_text_message
+    from user_states import get_user_state, set_user_state
+
+    add_user(db, is_writing_post=True)
+    asyncio.run(set_user_state(USER_ID, "question_1", current_task=3, digest_data={"vopros_2": "В2", "vopros_3": "В3"}))
+    message = FakeMessage(fake_bot, USER_ID, text="Мой ответ")
+    queries = run_update(db, message, handle_text_message)
+
+    assert asyncio.run(get_user_state(USER_ID)).state == "question_2"
+    assert_budget("question_answer_text", queries)
+
+
+def test_question_answer_voice(db, fake_bot, monkeypatch):
+    import post_handlers
+    from bot import handle_voice_message
+    from user_states import get_user_state, set_user_state
+
+    async def fake_transcribe(audio, filename="voice.ogg", file_unique_id=None):
+        return "Распознанный ответ"
+
+    async def fake_download(voice, destination=None):
+        destination.write(b"OggS")
+
+    monkeypatch.setattr(post_handlers, "transcribe_voice", fake_transcribe)
+    monkeypatch.setattr(fake_bot, "download", fake_download, raising=False)
+
+    add_user(db, is_writing_post=True)
+    asyncio.run(set_user_state(USER_ID, "question_2", current_task=3, digest_data={"vopros_3": "В3"}))
+    voice = SimpleNamespace(file_id="VOICE", file_unique_id="voice-1", file_size=1024)
+    message = FakeMessage(fake_bot, USER_ID, voice=voice)
+    queries = run_update(db, message, handle_voice_message)
+
+    assert asyncio.run(get_user_state(USER_ID)).answers["answer_2"] == "Распознанный ответ"
+    assert_budget("question_answer_voice", queries)
+
+
+def test_question_answer_last(db, fake_bot, monkeypatch):
+    import post_handlers
+    from bot import handle_text_message
+    from user_states import get_user_state, set_user_state
+
+    async def fake_generate(**kwargs):
+        return "Готовый пост"
+
+    monkeypatch.setattr(post_handlers, "generate_post_with_ai", fake_generate)
+
+    add_user(db, is_writing_post=True)
+    asyncio.run(set_user_state(USER_ID, "question_3", current_task=3, digest_data={"prompt": "{answer_1}"}))
+    message = FakeMessage(fake_bot, USER_ID, text="Последний ответ")
+    queries = run_update(db, message, handle_text_message)
+
+    assert asyncio.run(get_user_state(USER_ID)).state == "idle"
+    assert db.tables["users"][0]["is_writing_post"] is False
+    assert_budget("question_answer_last", queries)
+
@@ -1,58 +1,246 @@
 # -*- coding: utf-8 -*-
 """
 Модуль для управления состояниями пользователей в диалоге
+
+Хранилище состояний выбирается переменной DIALOG_STATE_BACKEND:
+- memory (по умолчанию) - в памяти процесса, состояния удаляются через DIALOG_STATE_TTL
+- sqlite - файл DIALOG_STATE_DB: переживает перезапуск бота посреди вопросов
+  и общий для нескольких процессов бота на одном сервере
+
+Файл SQLite локальный: копии бота на разных серверах его не видят. При
+нескольких серверах апдейты одного пользователя должны приходить на одну
+копию (sticky-маршрутизация по chat_id), иначе диалог теряется.
+
+Функции модуля асинхронные: запросы к SQLite выполняются в отдельном потоке
+и не блокируют event loop.
 """
 
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from typing import Dict, Any, Optional
-from dataclasses import dataclass, field
 
+logger = logging.getLogger(__name__)
 
-@dataclass
-class UserDialogState:
-    """Состояние диалога пользователя"""
-    state: str = "idle"  # idle, question_1, question_2, question_3, waiting_post_link, generating_post
-    current_task: int = 0
-    answers: Dict[str, str] = field(default_factory=dict)  # {answer_1: "текст", answer_2: "текст", answer_3: "текст"}
-    digest_data: Optional[Dict[str, Any]] = None  # Данные из digest_day_X
-    request_id: Optional[str] = None  # ID запроса к n8n
-
+# Хранилище состояний: memory или sqlite
+DIALOG_STATE_BACKEND = os.getenv("DIALOG_STATE_BACKEND", "memory").lower()
 
-# Глобальный словарь состояний пользователей {telegram_id: UserDialogState}
-user_dialog_states: Dict[int, UserDialogState] = {}
+# Через сколько секунд бездействия состояние диалога удаляется (по умолчанию сутки)
+DIALOG_STATE_TTL = int(os.getenv("DIALOG_STATE_TTL", "86400"))
 
+# Файл базы SQLite (для DIALOG_STATE_BACKEND=sqlite)
+DIALOG_STATE_DB = os.getenv("DIALOG_STATE_DB", "media/.dialog_states.db")
 
-def get_user_state(telegram_id: int) -> UserDialogState:
-    """Получает состояние пользователя"""
-    if telegram_id not in user_dialog_states:
-        user_dialog_states[telegram_id] = UserDialogState()
-    return user_dialog_states[telegram_id]
 
+class UserDialogState:
+    """Состояние диалога пользователя"""
 
-def set_user_state(telegram_id: int, state: str, **kwargs):
+    __slots__ = ("state", "current_task", "answers", "digest_data", "request_id")
+
+    def __init__(
+        self,
+        state: str = "idle",  # idle, question_1, question_2, question_3, waiting_post_link, generating_post
+        current_task: int = 0,
+        answers: Optional[Dict[str, str]] = None,  # {answer_1: "текст", answer_2: "текст", answer_3: "текст"}
+        digest_data: Optional[Dict[str, Any]] = None,  # Данные из digest_day_X
+        request_id: Optional[str] = None  # ID запроса к n8n
+    ):
+        self.state = state
+        self.current_task = current_task
+        self.answers = answers if answers is not None else {}
+        self.digest_data = digest_data
+        self.request_id = request_id
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "UserDialogState":
+        return cls(**{name: data.get(name) for name in cls.__slots__ if name in data})
+
+    def __repr__(self) -> str:
+        return f"UserDialogState(state={self.state!r}, current_task={self.current_task}, answers={len(self.answers)})"
+
+
+class MemoryDialogStorage:
+    """Состояния в памяти процесса с удалением по времени бездействия"""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._states: "OrderedDict[int, tuple[float, UserDialogState]]" = OrderedDict()
+
+    async def get(self, telegram_id: int) -> Optional[UserDialogState]:
+        entry = self._states.get(telegram_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._states[telegram_id]
+            return None
+        return entry[1]
+
+    async def save(self, telegram_id: int, user_state: UserDialogState):
+        self._states[telegram_id] = (time.monotonic() + self.ttl, user_state)
+        self._states.move_to_end(telegram_id)
+        self._evict_expired()
+
+    async def delete(self, telegram_id: int):
+        self._states.pop(telegram_id, None)
+
+    def _evict_expired(self):
+        # Записи упорядочены по времени последнего сохранения - устаревшие в начале
+        now = time.monotonic()
+        while self._states:
+            telegram_id, (expires_at, _) = next(iter(self._states.items()))
+            if expires_at >= now:
+                break
+            del self._states[telegram_id]
+
+    async def open(self):
+        pass
+
+    async def count(self) -> int:
+        """Количество действующих (не устаревших) состояний - для /metrics"""
+        self._evict_expired()
+        return len(self._states)
+
+
+class SqliteDialogStorage:
+    """
+    Состояния в файле SQLite (переживают перезапуск, общие для процессов на одном сервере)
+
+    Запросы выполняются через asyncio.to_thread, соединение одно на процесс
+    и защищено блокировкой. Файл открывается в open() (тоже в отдельном потоке).
+    """
+
+    def __init__(self, path: str, ttl: int):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    async def open(self):
+        """Открывает файл и создаёт таблицу (при старте бота)"""
+        await asyncio.to_thread(self._open)
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS dialog_states ("
+            "telegram_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS dialog_states_updated_at ON dialog_states (updated_at)")
+        self._db.execute("DELETE FROM dialog_states WHERE updated_at < ?", (time.time() - self.ttl,))
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchone()
+
+    async def get(self, telegram_id: int) -> Optional[UserDialogState]:
+        row = await asyncio.to_thread(
+            self._execute,
+            "SELECT data FROM dialog_states WHERE telegram_id = ? AND updated_at >= ?",
+            (telegram_id, time.time() - self.ttl)
+        )
+        if row is None:
+            return None
+        return UserDialogState.from_dict(json.loads(row[0]))
+
+    async def save(self, telegram_id: int, user_state: UserDialogState):
+        data = json.dumps(user_state.to_dict(), ensure_ascii=False, default=str)
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO dialog_states (telegram_id, data, updated_at) VALUES (?, ?, ?)",
+            (telegram_id, data, time.time())
+        )
+
+    async def delete(self, telegram_id: int):
+        await asyncio.to_thread(self._execute, "DELETE FROM dialog_states WHERE telegram_id = ?", (telegram_id,))
+
+    async def count(self) -> int:
+        """Количество действующих (не устаревших) состояний - для /metrics"""
+        row = await asyncio.to_thread(
+            self._execute,
+            "SELECT COUNT(*) FROM dialog_states WHERE updated_at >= ?",
+            (time.time() - self.ttl,)
+        )
+        return row[0]
+
+
+# Хранилище состояний пользователей {telegram_id: UserDialogState}.
+# До init_dialog_storage() - в памяти: файл SQLite открывается при старте бота,
+# а не при импорте модуля (в отдельном потоке, без блокировки event loop)
+dialog_storage = MemoryDialogStorage(DIALOG_STATE_TTL)
+
+
+async def init_dialog_storage():
+    """Подключает хранилище DIALOG_STATE_BACKEND (вызывается при старте бота)"""
+    global dialog_storage
+    if DIALOG_STATE_BACKEND != "sqlite":
+        return
+    storage = SqliteDialogStorage(DIALOG_STATE_DB, DIALOG_STATE_TTL)
+    try:
+        await storage.open()
+    except Exception as e:
+        logger.error(f"Не удалось открыть {DIALOG_STATE_DB}, состояния диалогов будут в памяти: {e}")
+        return
+    dialog_storage = storage
+    logger.info(f"Состояния диалогов хранятся в SQLite: {DIALOG_STATE_DB}")
+
+
+async def count_dialog_states() -> int:
+    """Количество сохранённых состояний диалогов (для /metrics)"""
+    return await dialog_storage.count()
+
+
+async def get_user_state(telegram_id: int) -> UserDialogState:
+    """
+    Получает состояние пользователя
+
+    Если диалога нет, возвращается новое состояние idle (в хранилище не записывается,
+    чтобы каждое текстовое сообщение не создавало запись)
+    """
+    user_state = await dialog_storage.get(telegram_id)
+    if user_state is None:
+        return UserDialogState()
+    return user_state
+
+
+async def set_user_state(telegram_id: int, state: str, **kwargs):
     """Устанавливает состояние пользователя"""
-    user_state = get_user_state(telegram_id)
+    user_state = await get_user_state(telegram_id)
     user_state.state = state
-    
+
     # Обновляем дополнительные поля
     for key, value in kwargs.items():
         if hasattr(user_state, key):
             setattr(user_state, key, value)
 
+    await dialog_storage.save(telegram_id, user_state)
 
-def clear_user_state(telegram_id: int):
+
+async def clear_user_state(telegram_id: int):
     """Очищает состояние пользователя"""
-    if telegram_id in user_dialog_states:
-        del user_dialog_states[telegram_id]
+    await dialog_storage.delete(telegram_id)
 
 
-def save_answer(telegram_id: int, question_num: int, answer: str):
+async def save_answer(telegram_id: int, question_num: int, answer: str):
     """Сохраняет ответ пользователя на вопрос"""
-    user_state = get_user_state(telegram_id)
+    user_state = await get_user_state(telegram_id)
     user_state.answers[f"answer_{question_num}"] = answer
+    await dialog_storage.save(telegram_id, user_state)
 
 
-def get_answers(telegram_id: int) -> Dict[str, str]:
+async def get_answers(telegram_id: int) -> Dict[str, str]:
     """Получает все ответы пользователя"""
-    user_state = get_user_state(telegram_id)
+    user_state = await get_user_state(telegram_id)
     return user_state.answers
-
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 """
-Веб-сервер для приема вебхуков от n8n
+Веб-сервер для приема вебхуков от n8n, обновлений Telegram (в режиме webhook)
+и отдачи метрик Prometheus (/metrics)
 """
 
+import hmac
 import logging
 from aiohttp import web
+
+import config
+import metrics
 from ai_helper import handle_n8n_response
 
 logger = logging.getLogger(__name__)
@@ -43,16 +48,60 @@ async def handle_n8n_webhook(request):
         return web.Response(text="Internal error", status=500)
 
 
-async def start_webhook_server(host='0.0.0.0', port=8080):
+async def handle_metrics(request):
+    """Метрики бота в формате Prometheus (если задан METRICS_TOKEN - только с ним)"""
+    if config.METRICS_TOKEN:
+        expected = f"Bearer {config.METRICS_TOKEN}".encode()
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), expected):
+            return web.Response(text="Unauthorized", status=401)
+    
+    return web.Response(
+        text=await metrics.render(),
+        content_type="text/plain",
+        charset="utf-8",
+        headers={"X-Content-Type-Options": "nosniff"}
+    )
+
+
+def create_webhook_app(bot=None, dispatcher=None) -> web.Application:
+    """
+    Создаёт веб-приложение с вебхуками
+    
+    Args:
+        bot: Экземпляр бота (вместе с dispatcher - принимать обновления Telegram)
+        dispatcher: Диспетчер aiogram
+    """
+    app = web.Application()
+    app.router.add_post('/webhook/n8n', handle_n8n_webhook)
+    
+    if bot is not None and dispatcher is not None:
+        from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+        
+        # Запросы без верного X-Telegram-Bot-Api-Secret-Token отклоняются (401)
+        SimpleRequestHandler(
+            dispatcher=dispatcher,
+            bot=bot,
+            secret_token=config.TELEGRAM_WEBHOOK_SECRET
+        ).register(app, path=config.TELEGRAM_WEBHOOK_PATH)
+        setup_application(app, dispatcher, bot=bot)
+    
+    if config.METRICS_ENABLED:
+        app.router.add_get(config.METRICS_PATH, handle_metrics)
+    
+    return app
+
+
+async def start_webhook_server(host='0.0.0.0', port=8080, bot=None, dispatcher=None):
     """
     Запускает веб-сервер для приема вебхуков
     
     Args:
         host: Хост для прослушивания
         port: Порт для прослушивания
+        bot: Экземпляр бота (если передан вместе с dispatcher - принимаются и обновления Telegram)
+        dispatcher: Диспетчер aiogram
     """
-    app = web.Application()
-    app.router.add_post('/webhook/n8n', handle_n8n_webhook)
+    app = create_webhook_app(bot, dispatcher)
     
     runner = web.AppRunner(app)
     await runner.setup()
@@ -60,6 +109,8 @@ async def start_webhook_server(host='0.0.0.0', port=8080):
     await site.start()
     
     logger.info(f"Webhook сервер запущен на http://{host}:{port}/webhook/n8n")
+    if bot is not None and dispatcher is not None:
+        logger.info(f"Обновления Telegram принимаются на http://{host}:{port}{config.TELEGRAM_WEBHOOK_PATH}")
     
     return runner
 